@@ -1,6 +1,8 @@
 #%% Print version and license information
+import os as _os
 from .version import __version__, __versiondate__, __license__
-print(__license__)
+if not _os.environ.get('COVASIM_QUIET'): # Set this environment variable to skip printing, e.g. for batch workers
+    print(__license__)
 
 #%% Check that requirements are met
 from . import requirements
@@ -13,5 +15,7 @@ from .parameters    import *
 from .person        import *
 from .population    import *
 from .sim           import *
+from .executors     import *
+from .ensemble      import *
 from .run           import *
 from .interventions import *
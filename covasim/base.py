@@ -6,7 +6,6 @@ Base classes for Covasim.
 import datetime as dt
 import numpy as np # Needed for a few things not provided by pl
 import sciris as sc
-import pandas as pd
 from . import utils as cov_ut
 
 # Specify all externally visible functions this file defines
@@ -306,6 +305,7 @@ class BaseSim(ParsObj):
             An sc.Spreadsheet with an Excel file, or writes the file to disk
 
         """
+        import pandas as pd # Only needed for exporting
         resdict = self._make_resdict(for_json=False)
         result_df = pd.DataFrame.from_dict(resdict)
         result_df.index = self.tvec
@@ -6,7 +6,16 @@ import numpy as np
 import sciris as sc
 
 # Specify all externally visible functions this file defines
-__all__ = ['result_stocks', 'result_flows', 'default_age_data', 'default_colors', 'default_sim_plots', 'default_scen_plots', 'default_scenario']
+__all__ = ['person_states', 'person_dates', 'result_stocks', 'result_flows', 'default_age_data', 'default_colors', 'default_sim_plots', 'default_scen_plots', 'default_scenario']
+
+
+# The boolean states and the dates of each person -- used in interventions.py for array views of people
+person_states = ['susceptible', 'exposed', 'infectious', 'symptomatic', 'severe', 'critical',
+                 'tested', 'diagnosed', 'recovered', 'dead', 'known_contact', 'quarantined']
+
+person_dates = ['date_exposed', 'date_infectious', 'date_symptomatic', 'date_severe', 'date_critical',
+                'date_diagnosed', 'date_recovered', 'date_dead', 'date_known_contact', 'date_quarantined',
+                'end_quarantine']
 
 
 result_stocks = {
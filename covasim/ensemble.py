@@ -0,0 +1,380 @@
+'''
+Defines the Ensemble class, which runs many replicates of the same sim at once as
+a single vectorized simulation.
+'''
+
+#%% Imports
+import numpy as np
+import sciris as sc
+from . import utils as cvu
+from . import defaults as cvd
+from . import parameters as cvpars
+from . import population as cvpop
+
+# Specify all externally visible things this file defines
+__all__ = ['Ensemble']
+
+
+class Ensemble(sc.prettyobj):
+    '''
+    Run K replicates of a sim as one simulation. Each state (e.g. susceptible) and
+    date (e.g. date_recovered) is stored as an array of shape (pop_size, K), and all
+    replicates share the sim's population (ages and contacts), which is only created
+    once. Each day, progression, transmission, and the counting of results are done
+    for all people in all replicates at once, so the cost per replicate is much
+    lower than running the sims one at a time with multi_run(). The results are
+    arrays of shape (npts, K), as used by Scenarios to compute quantiles.
+
+    The replicates follow the same rules as Sim.next(), but are not numerically
+    identical to separate sims: they use a single random number stream, the
+    transmission on each day is based on the states at the start of the day, and
+    community contacts are drawn with replacement. Interventions, custom
+    intervention and stopping functions, dynamic rescaling, and common random
+    numbers are not supported.
+
+    Args:
+        sim (Sim): the sim to run replicates of (not modified); its population is used if it has one, otherwise one is created
+        n_runs (int): the number of replicates
+        noise (float): the amount of noise to add to beta in each replicate, as for single_run()
+        noisepar (str): the parameter to add noise to; only 'beta' is supported
+        verbose (int): level of detail to print (default: from the sim)
+
+    **Example**::
+
+        sim = cv.Sim(pop_size=20e3)
+        ens = cv.Ensemble(sim, n_runs=100)
+        ens.run()
+        median = np.median(ens.results['cum_infections'].values, axis=1)
+    '''
+
+    def __init__(self, sim, n_runs=10, noise=0.0, noisepar=None, verbose=None):
+        self.sim         = sc.dcp(sim.shrink(skip_attrs=['popdict', 'people'], in_place=False)) # Copy the sim, without its people...
+        self.sim.popdict = sim.popdict # ...but with its population, if it has one
+        self.sim.people  = []
+        self.n_runs      = int(n_runs)
+        self.noise       = noise
+        self.noisepar    = noisepar if noisepar is not None else 'beta'
+        self.verbose     = verbose if verbose is not None else sim['verbose']
+        self.results     = None
+        self.initialized = False
+        return
+
+
+    @property
+    def npts(self):
+        return self.sim.npts
+
+
+    @property
+    def reskeys(self):
+        return self.sim.reskeys
+
+
+    def check(self):
+        ''' Raise an error if the sim uses features that the ensemble can't run '''
+        sim = self.sim
+        unsupported = []
+        if sim['interventions']:
+            unsupported.append('interventions')
+        if sim['interv_func'] is not None:
+            unsupported.append('interv_func')
+        if sim['stopping_func'] is not None:
+            unsupported.append('stopping_func')
+        if sim['rescale']:
+            unsupported.append('rescale')
+        if sim['crn']:
+            unsupported.append('crn')
+        if self.noise and self.noisepar != 'beta':
+            unsupported.append(f'noisepar="{self.noisepar}"')
+        if unsupported:
+            errormsg = f'Ensembles cannot be run with {", ".join(unsupported)}; use multi_run() instead'
+            raise NotImplementedError(errormsg)
+        return
+
+
+    def initialize(self):
+        ''' Create the population, the state arrays, and the results '''
+        sim = self.sim
+        sim.validate_pars()
+        self.check()
+        sim.set_seed()
+        sim.results = {}
+        sim.init_results() # Only used as a template for the ensemble results
+        sim.popdict = cvpop.make_popdict(sim)
+        if sim['prognoses'] is None:
+            sim['prognoses'] = cvpars.get_prognoses(sim['prog_by_age'])
+        sim.contact_keys = sim.popdict['contact_keys']
+        rng = cvu.get_rng()
+
+        # The population, shared by all replicates
+        N = int(sim['pop_size'])
+        K = self.n_runs
+        self.contacts = cvpop.CSRContacts.from_list(sim.popdict['contacts'], sim.contact_keys)
+        ages = np.asarray(sim.popdict['age'], dtype=np.float64)
+        prognoses = sim['prognoses']
+        idx = np.searchsorted(prognoses['age_cutoffs'], ages, side='right') # Same as np.argmax(age_cutoffs > age) for each person...
+        idx[idx == len(prognoses['age_cutoffs'])] = 0 # ...including people older than the last cutoff
+        self.symp_prob   = sim['rel_symp_prob']   * prognoses['symp_probs'][idx]
+        self.severe_prob = sim['rel_severe_prob'] * prognoses['severe_probs'][idx]
+        self.crit_prob   = sim['rel_crit_prob']   * prognoses['crit_probs'][idx]
+        self.death_prob  = sim['rel_death_prob']  * prognoses['death_probs'][idx]
+
+        # The beta of each replicate, with noise as in single_run()
+        noisevals = self.noise*rng.normal(size=K) if self.noise else np.zeros(K)
+        noisefactors = np.where(noisevals > 0, 1 + noisevals, 1/(1 - noisevals))
+        self.beta = sim['beta']*noisefactors
+
+        # The states and dates of each person in each replicate
+        self.states = sc.objdict()
+        for key in ['susceptible', 'exposed', 'infectious', 'symptomatic', 'severe', 'critical', 'recovered', 'dead']:
+            self.states[key] = np.zeros((N, K), dtype=bool)
+        self.states.susceptible[:] = True
+        self.dates = sc.objdict()
+        for key in ['date_exposed', 'date_infectious', 'date_symptomatic', 'date_severe', 'date_critical', 'date_recovered', 'date_dead']:
+            self.dates[key] = np.full((N, K), np.nan, dtype=np.float32)
+        self.n_infected = np.zeros((N, K), dtype=np.int32) # The number of people each person infected, for r_eff
+
+        # The results, as (npts, K) arrays
+        self.results = sc.objdict()
+        for key in self.reskeys:
+            result = sc.dcp(sim.results[key])
+            result.values = np.zeros((self.npts, K))
+            self.results[key] = result
+        self.results['t']    = sim.results['t']
+        self.results['date'] = sim.results['date']
+        self.results_ready   = False
+
+        # Create the seed infections
+        n_infected = int(sim['pop_infected'])
+        inds = np.tile(np.arange(n_infected), K)
+        reps = np.repeat(np.arange(K), n_infected)
+        self.infect(inds, reps, t=0)
+
+        self.t = 0
+        self.initialized = True
+        return
+
+
+    def sample_dur(self, key, n):
+        ''' Draw n durations from the sim's duration distributions '''
+        return cvu.sample(**self.sim['dur'][key], size=n)
+
+
+    def infect(self, inds, reps, t, bed_constraint=None):
+        '''
+        Infect people and determine their outcomes, as for Person.infect().
+
+        Args:
+            inds (array): the indices of the people to infect
+            reps (array): the replicate each person is infected in
+            t (int): the timestep
+            bed_constraint (array): for each replicate, whether beds have run out
+
+        Returns:
+            count (array): the number of people infected in each replicate
+        '''
+        sim = self.sim
+        states, dates = self.states, self.dates
+        rng = cvu.get_rng()
+        n = len(inds)
+
+        states.susceptible[inds, reps] = False
+        states.exposed[inds, reps]     = True
+        dates.date_exposed[inds, reps] = t
+        date_infectious = t + self.sample_dur('exp2inf', n)
+        dates.date_infectious[inds, reps] = date_infectious
+
+        # Case 1: asymptomatic
+        symp = rng.random_sample(n) < self.symp_prob[inds]
+        asymp = ~symp
+        dates.date_recovered[inds[asymp], reps[asymp]] = date_infectious[asymp] + self.sample_dur('asym2rec', asymp.sum())
+
+        # Case 2: symptomatic
+        s_inds, s_reps = inds[symp], reps[symp]
+        date_symptomatic = date_infectious[symp] + self.sample_dur('inf2sym', len(s_inds))
+        dates.date_symptomatic[s_inds, s_reps] = date_symptomatic
+        sev = rng.random_sample(len(s_inds)) < self.severe_prob[s_inds]
+
+        # Case 2a: mild
+        mild = ~sev
+        dates.date_recovered[s_inds[mild], s_reps[mild]] = date_symptomatic[mild] + self.sample_dur('mild2rec', mild.sum())
+
+        # Case 2b: severe
+        v_inds, v_reps = s_inds[sev], s_reps[sev]
+        date_severe = date_symptomatic[sev] + self.sample_dur('sym2sev', len(v_inds))
+        dates.date_severe[v_inds, v_reps] = date_severe
+        crit = rng.random_sample(len(v_inds)) < self.crit_prob[v_inds]
+        noncrit = ~crit
+        dates.date_recovered[v_inds[noncrit], v_reps[noncrit]] = date_severe[noncrit] + self.sample_dur('sev2rec', noncrit.sum())
+
+        # Case 2c: critical
+        c_inds, c_reps = v_inds[crit], v_reps[crit]
+        date_critical = date_severe[crit] + self.sample_dur('sev2crit', len(c_inds))
+        dates.date_critical[c_inds, c_reps] = date_critical
+        death_prob = self.death_prob[c_inds]
+        if bed_constraint is not None:
+            death_prob = death_prob * np.where(bed_constraint[c_reps], sim['OR_no_treat'], 1.0)
+        death = rng.random_sample(len(c_inds)) < death_prob
+        alive = ~death
+        dates.date_dead[c_inds[death], c_reps[death]] = date_critical[death] + self.sample_dur('crit2die', death.sum())
+        dates.date_recovered[c_inds[alive], c_reps[alive]] = date_critical[alive] + self.sample_dur('crit2rec', alive.sum())
+
+        return np.bincount(reps, minlength=self.n_runs)
+
+
+    def transmit(self, t, bed_constraint):
+        '''
+        Find who infectious people infect in each replicate, and infect them.
+
+        Returns:
+            count (array): the number of new infections in each replicate
+        '''
+        sim = self.sim
+        states = self.states
+        rng = cvu.get_rng()
+        N, K = states.susceptible.shape
+
+        # The infectious people in each replicate, and their relative transmissibility
+        src, reps = np.nonzero(states.infectious)
+        beta = self.beta[reps]*np.where(states.symptomatic[src, reps], 1.0, sim['asymp_factor'])
+        n_comm = sim['contacts'].get('c', 0) if 'c' in sim.contact_keys else 0
+
+        # Draw the transmissions in each layer
+        targets = []
+        pairs = []
+        for key in sim.contact_keys:
+            if key == 'c' and n_comm:
+                layer_targets = rng.randint(N, size=len(src)*n_comm)
+                layer_pairs = np.repeat(np.arange(len(src)), n_comm)
+            else:
+                indptr, _ = self.contacts.layer(key)
+                layer_targets = self.contacts.find_contacts(key, src)
+                layer_pairs = np.repeat(np.arange(len(src)), indptr[src+1] - indptr[src])
+            hits = (rng.random_sample(len(layer_targets)) < beta[layer_pairs]*sim['beta_layers'][key]).nonzero()[0]
+            targets.append(layer_targets[hits])
+            pairs.append(layer_pairs[hits])
+        targets = np.concatenate(targets).astype(np.int64)
+        pairs = np.concatenate(pairs)
+        target_reps = reps[pairs]
+
+        # Infect each susceptible person at most once, crediting the first source found
+        sus = states.susceptible[targets, target_reps].nonzero()[0]
+        _, first = np.unique(targets[sus]*K + target_reps[sus], return_index=True)
+        infections = sus[first]
+        np.add.at(self.n_infected, (src[pairs[infections]], target_reps[infections]), 1)
+        return self.infect(targets[infections], target_reps[infections], t, bed_constraint=bed_constraint)
+
+
+    def next(self):
+        ''' Step all replicates forward in time '''
+        t = self.t
+        if t >= self.npts:
+            return
+        sim = self.sim
+        states, dates = self.states, self.dates
+        res = self.results
+        N, K = states.susceptible.shape
+
+        # Imported infections
+        new_infections = np.zeros(K)
+        if sim['n_imports']:
+            n_imports = cvu.get_rng().poisson(sim['n_imports'], size=K)
+            inds = np.concatenate([cvu.choose(max_n=N, n=n) for n in n_imports]).astype(np.int64)
+            reps = np.repeat(np.arange(K), n_imports)
+            sus = states.susceptible[inds, reps]
+            new_infections += self.infect(inds[sus], reps[sus], t)
+
+        # Progression: becoming infectious, then death or recovery, then symptoms
+        res.n_exposed[t] = states.exposed.sum(axis=0)
+        states.infectious |= states.exposed & (t >= dates.date_infectious)
+        new_deaths = states.infectious & (t >= dates.date_dead)
+        new_recoveries = states.infectious & (t >= dates.date_recovered)
+        for key in ['exposed', 'infectious', 'symptomatic', 'severe', 'critical']:
+            states[key][new_deaths | new_recoveries] = False
+        states.dead |= new_deaths
+        states.recovered |= new_recoveries
+        res.new_deaths[t] = new_deaths.sum(axis=0)
+        res.new_recoveries[t] = new_recoveries.sum(axis=0)
+        for key in ['symptomatic', 'severe', 'critical']:
+            new = states.infectious & ~states[key] & (t >= dates[f'date_{key}'])
+            states[key] |= new
+            res[f'new_{key}'][t] = new.sum(axis=0)
+        res.n_infectious[t]  = states.infectious.sum(axis=0)
+        res.n_symptomatic[t] = states.symptomatic.sum(axis=0)
+        res.n_severe[t]      = states.severe.sum(axis=0)
+        res.n_critical[t]    = states.critical.sum(axis=0)
+        n_beds = sim['n_beds']
+        res.bed_capacity[t] = res.n_severe[t]/n_beds if n_beds > 0 else np.nan
+
+        # Transmission
+        new_infections += self.transmit(t, bed_constraint=res.n_severe[t] > n_beds)
+        res.new_infections[t] = new_infections
+        res.n_susceptible[t] = states.susceptible.sum(axis=0)
+
+        self.t += 1
+        return
+
+
+    def run(self, verbose=None):
+        '''
+        Run all the replicates.
+
+        Args:
+            verbose (int): level of detail to print
+
+        Returns:
+            results (objdict): the results, each with values of shape (npts, n_runs)
+        '''
+        T = sc.tic()
+        if verbose is None:
+            verbose = self.verbose
+        if not self.initialized:
+            self.initialize()
+        for t in range(self.t, self.npts):
+            if verbose >= 1:
+                print(f'  Running day {t:0.0f} of {self.sim["n_days"]} for {self.n_runs} replicates ({sc.toc(T, output=True):0.2f} s elapsed)...')
+            self.next()
+        self.finalize()
+        sc.printv(f'\nEnsemble of {self.n_runs} runs finished after {sc.toc(T, output=True):0.1f} s.\n', 1, verbose)
+        return self.results
+
+
+    def finalize(self):
+        ''' Scale the results and compute the cumulative results, doubling time, and r_eff, as for Sim.finalize() '''
+        sim = self.sim
+        res = self.results
+        for key in self.reskeys:
+            if res[key].scale in ['dynamic', 'static']: # Without rescaling, both are scaled by pop_scale
+                res[key].values *= sim['pop_scale']
+        for key in cvd.result_flows.keys():
+            res[f'cum_{key}'].values = np.cumsum(res[f'new_{key}'].values, axis=0)
+        res.cum_infections.values += sim['pop_infected']*sim['pop_scale']
+        self.compute_doubling()
+        self.compute_r_eff()
+        self.results_ready = True
+        return
+
+
+    def compute_doubling(self, window=7, max_doubling_time=50):
+        ''' Compute the doubling time of each replicate, as for Sim.compute_doubling() '''
+        cum_infections = self.results.cum_infections.values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = cum_infections[window:]/cum_infections[:-window]
+            doubling_time = np.minimum(window*np.log(2)/np.log(r), max_doubling_time)
+        self.results.doubling_time.values[window:] = np.where(r > 1, doubling_time, 0)
+        return
+
+
+    def compute_r_eff(self):
+        ''' Compute the effective reproductive number of each replicate, as for Sim.compute_r_eff() '''
+        dates = self.dates
+        npts = self.npts
+        K = self.n_runs
+        outcome = np.where(np.isnan(dates.date_recovered), dates.date_dead, dates.date_recovered)
+        inds, reps = np.nonzero(~np.isnan(dates.date_exposed) & (outcome < npts))
+        flat = outcome[inds, reps].astype(np.int64)*K + reps
+        sources = np.bincount(flat, minlength=npts*K).reshape(npts, K)
+        targets = np.bincount(flat, weights=self.n_infected[inds, reps], minlength=npts*K).reshape(npts, K)
+        has_sources = sources > 0
+        self.results.r_eff.values[has_sources] = targets[has_sources]/sources[has_sources]
+        return
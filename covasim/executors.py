@@ -0,0 +1,408 @@
+'''
+Executors for running many jobs, e.g. the runs of multi_run(), in series, in
+threads, in local processes, or on remote workers.
+
+Every executor has the same interface: map(func, items, shared=None) returns
+[func(item, shared) for item in items] (or [func(item) ...] if there's nothing
+shared), and imap() and imap_unordered() return the same results as they become
+available. The shared object (e.g. the base sim) is only sent to each worker
+once per batch (or chunk of jobs), so the items themselves can be small.
+'''
+
+#%% Imports
+import os
+import sys
+import queue
+import functools
+import threading
+import traceback
+import multiprocessing as mp
+import concurrent.futures as cf
+import sciris as sc
+
+
+# Specify all externally visible functions this file defines
+__all__ = ['set_threads', 'Executor', 'SerialExecutor', 'ThreadExecutor', 'ProcessExecutor', 'SocketExecutor', 'serve']
+
+
+thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def set_threads(n_threads):
+    '''
+    Limit the number of threads used by Numba and by numerical libraries (BLAS,
+    OpenMP) in this process, so that worker processes running side by side don't
+    oversubscribe the CPUs. Libraries that are already loaded are limited with
+    threadpoolctl, if it's installed; the environment variables set here cover
+    libraries loaded later, and any child processes.
+
+    Args:
+        n_threads (int): the number of threads to allow
+    '''
+    n_threads = max(1, int(n_threads))
+    for var in thread_vars:
+        os.environ[var] = str(n_threads)
+
+    import numba as nb # Imported here to keep this module light
+    nb.set_num_threads(min(n_threads, nb.config.NUMBA_NUM_THREADS))
+
+    try:
+        import threadpoolctl # Optional import
+        threadpoolctl.threadpool_limits(n_threads)
+    except ImportError:
+        pass
+
+    return
+
+
+def _init_process(n_threads, initializer, initargs):
+    ''' Set up a ProcessExecutor worker '''
+    set_threads(n_threads)
+    if initializer is not None:
+        initializer(*initargs)
+    return
+
+
+def _apply(func, shared, item):
+    ''' Call the function on an item, with the shared object if there is one '''
+    if shared is None:
+        return func(item)
+    else:
+        return func(item, shared)
+
+
+class Executor(sc.prettyobj):
+    '''
+    Base class for executors. Subclasses need to define imap_unordered(), which
+    yields (index, result) pairs in any order; the other methods are built on it.
+    Executors can be used as context managers, which closes them at the end.
+    '''
+
+    def imap_unordered(self, func, items, shared=None):
+        raise NotImplementedError
+
+
+    def imap(self, func, items, shared=None):
+        ''' Yield the results in order, as they become available '''
+        pending = {}
+        index = 0
+        for i,result in self.imap_unordered(func, items, shared=shared):
+            pending[i] = result
+            while index in pending:
+                yield pending.pop(index)
+                index += 1
+        return
+
+
+    def map(self, func, items, shared=None):
+        ''' Return the list of results, in order '''
+        return list(self.imap(func, items, shared=shared))
+
+
+    def close(self):
+        ''' Release any resources held by the executor '''
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+
+
+class SerialExecutor(Executor):
+    ''' Run each job in turn in this process; mainly for debugging '''
+
+    def imap_unordered(self, func, items, shared=None):
+        for i,item in enumerate(items):
+            yield i, _apply(func, shared, item)
+        return
+
+
+
+class ThreadExecutor(Executor):
+    '''
+    Run jobs in a pool of threads in this process. Nothing needs to be pickled or
+    copied between processes: the shared object (e.g. the base sim and its
+    population) is passed to each thread as is. Each thread has its own random
+    number streams (see get_rng()), so the results are the same as for any other
+    executor. The Numba functions release the GIL, but much of each sim is still
+    Python code, so threads help most when the runs are short or the population is
+    large relative to the work done each day.
+
+    Args:
+        n_workers (int): the number of threads (default: the number of CPUs)
+    '''
+
+    def __init__(self, n_workers=None):
+        self.n_workers = n_workers if n_workers else mp.cpu_count()
+        self.pool = cf.ThreadPoolExecutor(max_workers=self.n_workers)
+        return
+
+
+    def imap_unordered(self, func, items, shared=None):
+        futures = {self.pool.submit(_apply, func, shared, item):i for i,item in enumerate(items)}
+        for future in cf.as_completed(futures):
+            yield futures[future], future.result()
+        return
+
+
+    def close(self):
+        self.pool.shutdown()
+        return
+
+
+
+class ProcessExecutor(Executor):
+    '''
+    Run jobs in a pool of local worker processes, which stays alive until the
+    executor is closed. Jobs are sent in chunks (by default, about four per worker
+    per batch), and the shared object is sent once per chunk rather than once per
+    job. Each worker's Numba and BLAS threads are limited (see set_threads()) so
+    that together the workers use each CPU once.
+
+    Args:
+        ncpus (int): the number of worker processes (default: the number of CPUs)
+        threads_per_worker (int): the number of threads each worker can use (default: the number of CPUs divided by the number of workers)
+        chunks_per_worker (int): the number of chunks to split each batch into, per worker; more chunks balance the load better, but send the shared object more times
+        initializer (func): passed to multiprocessing.Pool()
+        initargs (tuple): passed to multiprocessing.Pool()
+    '''
+
+    def __init__(self, ncpus=None, threads_per_worker=None, chunks_per_worker=4, initializer=None, initargs=()):
+        self.ncpus = ncpus if ncpus else mp.cpu_count()
+        self.threads_per_worker = threads_per_worker if threads_per_worker else max(1, mp.cpu_count()//self.ncpus)
+        self.chunks_per_worker = chunks_per_worker
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+        self.start()
+        return
+
+
+    def start(self):
+        ''' Start the worker processes, if they're not running already '''
+        if self.pool is None:
+            initargs = (self.threads_per_worker, self.initializer, self.initargs)
+            self.pool = mp.Pool(processes=self.ncpus, initializer=_init_process, initargs=initargs)
+        return
+
+
+    def close(self):
+        ''' Stop the worker processes once they've finished their current jobs '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return
+
+
+    def _check(self):
+        if self.pool is None:
+            raise RuntimeError(f'This {self.__class__.__name__} has been closed; call start() to restart it')
+        return
+
+
+    def _chunksize(self, n_items):
+        return max(1, n_items//(self.ncpus*self.chunks_per_worker))
+
+
+    def imap_unordered(self, func, items, shared=None):
+        self._check()
+        items = list(items)
+        call = functools.partial(_apply_indexed, func, shared)
+        yield from self.pool.imap_unordered(call, enumerate(items), chunksize=self._chunksize(len(items)))
+        return
+
+
+    def imap(self, func, items, shared=None):
+        self._check()
+        items = list(items)
+        call = functools.partial(_apply, func, shared)
+        yield from self.pool.imap(call, items, chunksize=self._chunksize(len(items)))
+        return
+
+
+def _apply_indexed(func, shared, indexed_item):
+    ''' Helper for ProcessExecutor.imap_unordered() '''
+    index, item = indexed_item
+    return index, _apply(func, shared, item)
+
+
+
+#%% Socket-based remote workers
+
+def _get_authkey(authkey=None):
+    ''' Use the supplied key, or the COVASIM_AUTHKEY environment variable, to authenticate workers; there's no default '''
+    if authkey is None:
+        authkey = os.environ.get('COVASIM_AUTHKEY')
+    if not authkey:
+        errormsg = 'Socket workers need a shared key to authenticate connections: supply authkey, or set the COVASIM_AUTHKEY environment variable'
+        raise ValueError(errormsg)
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    return authkey
+
+
+def serve(address=('localhost', 0), authkey=None, n_threads=None, ready=None, verbose=True):
+    '''
+    Run a worker for a SocketExecutor, e.g. on a remote machine. The worker waits
+    for an executor to connect, runs the jobs it sends one at a time, and waits
+    for the next connection once the executor disconnects, until it's told to shut
+    down. Jobs and results are pickled, so the worker needs the same version of
+    Covasim as the executor, and since unpickling can run arbitrary code, workers
+    should only be reachable from trusted machines; connections are authenticated
+    with a shared key.
+
+    Args:
+        address (tuple): the (host, port) to listen on; port 0 picks a free port
+        authkey (str or bytes): the shared key (default: the COVASIM_AUTHKEY environment variable; one of these is required)
+        n_threads (int): if supplied, limit the number of Numba and BLAS threads used by the worker (see set_threads())
+        ready (Queue): if supplied, the address actually used is put on this queue once the worker is listening
+        verbose (bool): whether to print when the worker starts and stops
+
+    **Example**::
+
+        # On each worker machine
+        python -c "import covasim as cv; cv.serve(('0.0.0.0', 6000), authkey='secret')"
+
+        # On the main machine
+        executor = cv.SocketExecutor([('worker1', 6000), ('worker2', 6000)], authkey='secret')
+        sims = cv.multi_run(sim, n_runs=20, executor=executor)
+    '''
+    from multiprocessing.connection import Listener # Only needed for workers
+
+    if n_threads is not None:
+        set_threads(n_threads)
+    with Listener(address, authkey=_get_authkey(authkey)) as listener:
+        if ready is not None:
+            ready.put(listener.address)
+        if verbose:
+            print(f'Covasim worker listening on {listener.address}')
+        while True:
+            with listener.accept() as conn:
+                func, shared = None, None
+                while True:
+                    try:
+                        message = conn.recv()
+                    except EOFError: # The executor disconnected
+                        break
+                    kind = message[0]
+                    if kind == 'batch': # Store the function and shared object for the following jobs
+                        func, shared = message[1:]
+                    elif kind == 'job':
+                        index, item = message[1:]
+                        try:
+                            conn.send((index, True, _apply(func, shared, item)))
+                        except Exception:
+                            conn.send((index, False, traceback.format_exc()))
+                    elif kind == 'shutdown':
+                        if verbose:
+                            print(f'Covasim worker on {listener.address} shutting down')
+                        return
+                    else:
+                        raise ValueError(f'Message "{kind}" not understood')
+
+
+class SocketExecutor(Executor):
+    '''
+    Run jobs on workers started with serve(), which may be on other machines. Each
+    batch of jobs opens one connection to each worker, sends it the function and
+    shared object once, and then hands out jobs one at a time to whichever worker
+    is free. If a job raises an exception, the remote traceback is included in the
+    RuntimeError raised here.
+
+    Args:
+        addresses (list): the (host, port) address of each worker
+        authkey (str or bytes): the shared key used by the workers (default: the COVASIM_AUTHKEY environment variable; one of these is required)
+
+    **Example**::
+
+        with cv.SocketExecutor.local(n_workers=2) as executor: # Start workers on this machine for testing
+            sims = cv.multi_run(sim, n_runs=4, executor=executor)
+    '''
+
+    def __init__(self, addresses, authkey=None):
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey = _get_authkey(authkey)
+        self.processes = [] # Workers started by local()
+        return
+
+
+    @classmethod
+    def local(cls, n_workers=None, authkey=None):
+        '''
+        Start workers in new processes on this machine, which are stopped when the
+        executor is closed. Unless a key is supplied, they use a new random one.
+        '''
+        n_workers = n_workers if n_workers else mp.cpu_count()
+        authkey = _get_authkey(authkey) if authkey is not None else os.urandom(32)
+        ready = mp.Queue()
+        n_threads = max(1, mp.cpu_count()//n_workers)
+        processes = [mp.Process(target=serve, kwargs=dict(authkey=authkey, n_threads=n_threads, ready=ready, verbose=False), daemon=True) for w in range(n_workers)]
+        for process in processes:
+            process.start()
+        addresses = [ready.get(timeout=60) for process in processes]
+        executor = cls(addresses, authkey=authkey)
+        executor.processes = processes
+        return executor
+
+
+    def _work(self, address, func, shared, jobs, results):
+        ''' Send jobs to one worker until there are none left; runs in a thread '''
+        from multiprocessing.connection import Client
+        try:
+            with Client(address, authkey=self.authkey) as conn:
+                conn.send(('batch', func, shared))
+                while True:
+                    try:
+                        index, item = jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    conn.send(('job', index, item))
+                    results.put(conn.recv())
+        except Exception:
+            results.put((None, False, f'Could not run jobs on worker {address}:\n{traceback.format_exc()}'))
+        return
+
+
+    def imap_unordered(self, func, items, shared=None):
+        jobs = queue.Queue()
+        n_items = 0
+        for i,item in enumerate(items):
+            jobs.put((i, item))
+            n_items += 1
+        results = queue.Queue()
+        threads = [threading.Thread(target=self._work, args=(address, func, shared, jobs, results), daemon=True) for address in self.addresses]
+        for thread in threads:
+            thread.start()
+        for i in range(n_items):
+            index, success, result = results.get()
+            if not success:
+                with jobs.mutex: # Stop the other workers from starting new jobs
+                    jobs.queue.clear()
+                raise RuntimeError(f'Job failed on a remote worker:\n{result}')
+            yield index, result
+        for thread in threads:
+            thread.join()
+        return
+
+
+    def close(self):
+        ''' Stop any workers started by local() '''
+        if self.processes:
+            from multiprocessing.connection import Client
+            for address in self.addresses:
+                try:
+                    with Client(address, authkey=self.authkey) as conn:
+                        conn.send(('shutdown',))
+                except Exception as E: # pragma: no cover
+                    print(f'Could not stop worker {address}: {E}', file=sys.stderr)
+            for process in self.processes:
+                process.join()
+            self.processes = []
+        return
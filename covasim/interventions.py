@@ -1,11 +1,9 @@
 import numpy as np
-import pandas as pd
-import pylab as pl
 import sciris as sc
 import covasim as cv
 
 
-__all__ = ['Intervention', 'dynamic_pars', 'sequence', 'change_beta', 'test_num', 'test_prob', 'test_historical', 'contact_tracing']
+__all__ = ['Intervention', 'ArrayIntervention', 'dynamic_pars', 'sequence', 'change_beta', 'test_num', 'test_prob', 'test_historical', 'contact_tracing']
 
 
 #%% Generic intervention classes
@@ -17,6 +15,43 @@ class Intervention:
     """
     def __init__(self):
         self.results = {}  #: All interventions are guaranteed to have results, so `Sim` can safely iterate over this dict
+        self.initialized = False
+
+
+    def initialize(self, sim):
+        """
+        Initialize the intervention for a sim
+
+        This method gets called by `Sim.initialize()` (and `Sim.reset()`) before the
+        simulation runs, so derived classes can do any setup that needs the sim, or
+        reset any state from a previous run
+
+        Args:
+            sim: The Sim instance
+
+        Returns:
+            None
+        """
+        self.initialized = True
+        return
+
+
+    def get_days(self, sim):
+        """
+        Return the days on which the intervention needs to be applied
+
+        The sim uses this to compile a schedule of interventions when it's
+        initialized, so that on each day only the interventions with something
+        to do are applied. By default, interventions are applied every day;
+        derived classes that only act on certain days should override this
+
+        Args:
+            sim: The Sim instance
+
+        Returns:
+            An array of days, or None to be applied every day
+        """
+        return None
 
 
     def apply(self, sim):
@@ -59,18 +94,125 @@ class Intervention:
 
         Custom classes can't be directly represented in JSON. This method is a
         one-way export to produce a JSON-compatible representation of the
-        intervention. In the first instance, the object dict will be returned.
+        intervention. In the first instance, the object dict will be returned,
+        except for private attributes (e.g. caches), which start with an underscore.
         However, if an intervention itself contains non-standard variables as
         attributes, then its `to_json` method will need to handle those
 
         Returns: JSON-serializable representation (typically a dict, but could be anything else)
 
         """
-        d = sc.dcp(self.__dict__)
+        d = sc.dcp({k:v for k,v in self.__dict__.items() if not k.startswith('_')})
         d['InterventionType'] = self.__class__.__name__
         return d
 
 
+class ArrayIntervention(Intervention):
+    """
+    Base class for interventions that work on arrays of people's states, rather
+    than looping over the people in the sim
+
+    Derived classes list the attributes of people they need in `reads`, and the
+    ones they change in `writes`, and implement `apply_arrays()` instead of
+    `apply()`. On each day the intervention is applied, it's given an array of
+    each attribute: booleans for states (e.g. `diagnosed`), floats for dates
+    (NaN if the event hasn't happened) and other numbers (e.g. `age`). It's also
+    given the events for each state it reads, i.e. the indices of the people who
+    have entered the state since the intervention was last applied (e.g. the
+    newly diagnosed).
+
+    The attributes stored in arrays on the people (see `People.arrays`) are passed
+    as those arrays themselves, so changes to them take effect directly. Any
+    other attribute is extracted from the people, and for the attributes in
+    `writes`, the entries changed are then written back to the people.
+
+    Example:
+        class quarantine_symptomatic(cv.ArrayIntervention):
+            reads  = ['symptomatic']
+            writes = ['date_known_contact']
+
+            def apply_arrays(self, sim, arrays, events):
+                arrays.date_known_contact[events.symptomatic] = sim.t
+    """
+
+    reads  = [] #: Attributes of people to read
+    writes = [] #: Attributes of people to change
+
+    def initialize(self, sim):
+        ''' Store the states read, so the first events are relative to the start of the sim '''
+        self._prev_states = {attr:self.get_array(sim, attr).copy() for attr in self.reads if attr in cv.person_states}
+        self.initialized = True
+        return
+
+
+    @staticmethod
+    def get_array(sim, attr):
+        ''' Return the people's array of an attribute if they store one, or else extract a copy '''
+        array = sim.people._array(attr)
+        if array is not None:
+            return array
+        elif attr in cv.person_states:
+            return sim.people.extract_array(attr, dtype=bool, fill=False)
+        else:
+            return sim.people.extract_array(attr)
+
+
+    def get_arrays(self, sim):
+        ''' Get the attributes read and written, and the events since the intervention was last applied '''
+        arrays = sc.objdict()
+        events = sc.objdict()
+        for attr in self.reads + [attr for attr in self.writes if attr not in self.reads]:
+            arrays[attr] = self.get_array(sim, attr)
+        for attr,prev in self._prev_states.items():
+            current = arrays[attr]
+            events[attr] = (current & ~prev).nonzero()[0]
+            prev[:] = current
+        return arrays, events
+
+
+    def set_arrays(self, sim, arrays, orig):
+        ''' Write the entries that have changed in extracted copies back to the people '''
+        for attr,old in orig.items():
+            new = arrays[attr]
+            changed = (new != old)
+            if new.dtype.kind == 'f':
+                changed &= ~(np.isnan(new) & np.isnan(old)) # NaN != NaN, but isn't a change
+            inds = changed.nonzero()[0]
+            values = new[inds]
+            if attr in cv.person_states:
+                values = values.astype(bool).tolist()
+            elif attr in cv.person_dates:
+                values = [None if np.isnan(value) else int(value) for value in values]
+            sim.people.set_attr(attr, inds, values)
+        return
+
+
+    def apply(self, sim):
+        ''' Get the arrays, apply the intervention to them, and write back any changes to copies '''
+        if not self.initialized:
+            self.initialize(sim)
+        arrays, events = self.get_arrays(sim)
+        orig = {attr:arrays[attr].copy() for attr in self.writes if sim.people._array(attr) is None} # Only copies need writing back
+        self.apply_arrays(sim, arrays, events)
+        self.set_arrays(sim, arrays, orig)
+        return
+
+
+    def apply_arrays(self, sim, arrays, events):
+        """
+        Apply the intervention to the arrays; must be implemented by derived classes
+
+        Args:
+            sim: The Sim instance
+            arrays: an objdict of the arrays of each attribute in `reads` and `writes`
+            events: an objdict of the indices of people who entered each state in `reads` since the intervention was last applied
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+
 class dynamic_pars(Intervention):
     '''
     A generic intervention that modifies a set of parameters at specified points
@@ -104,23 +246,38 @@ class dynamic_pars(Intervention):
             if len_days != len_vals:
                 raise ValueError(f'Length of days ({len_days}) does not match length of values ({len_vals}) for parameter {parkey}')
         self.pars = pars
+        self._changes = None # The changes to make on each day, compiled on initialization
         return
 
 
-    def apply(self, sim):
-        ''' Loop over the parameters, and then loop over the days, applying them if any are found '''
-        t = sim.t
+    def initialize(self, sim):
+        ''' Loop over the parameters, and then loop over the days, compiling the changes to make on each day '''
+        self._changes = {}
         for parkey,parval in self.pars.items():
-            inds = sc.findinds(parval['days'], t) # Look for matches
-            if len(inds):
-                if len(inds)>1:
-                    raise ValueError(f'Duplicate days are not allowed for Dynamic interventions (day={t}, indices={inds})')
-                else:
-                    val = parval['vals'][inds[0]]
-                    if isinstance(val, dict):
-                        sim[parkey].update(val) # Set the parameter if a nested dict
-                    else:
-                        sim[parkey] = val # Set the parameter if not a dict
+            days = sc.promotetoarray(parval['days'])
+            unique_days, counts = np.unique(days, return_counts=True)
+            if np.any(counts > 1):
+                dups = unique_days[counts > 1].tolist()
+                raise ValueError(f'Duplicate days are not allowed for Dynamic interventions (parameter={parkey}, days={dups})')
+            for day,val in zip(days.tolist(), parval['vals']):
+                self._changes.setdefault(day, []).append((parkey, val))
+        self.initialized = True
+        return
+
+
+    def get_days(self, sim):
+        return np.array(sorted(self._changes.keys()))
+
+
+    def apply(self, sim):
+        ''' Apply any parameter changes scheduled for this day '''
+        if not self.initialized:
+            self.initialize(sim)
+        for parkey,val in self._changes.get(sim.t, []):
+            if isinstance(val, dict):
+                sim[parkey].update(val) # Set the parameter if a nested dict
+            else:
+                sim[parkey] = val # Set the parameter if not a dict
         return
 
 
@@ -149,6 +306,28 @@ class sequence(Intervention):
         return
 
 
+    def initialize(self, sim):
+        for intervention in self.interventions:
+            if hasattr(intervention, 'initialize'): # Only apply() is required
+                intervention.initialize(sim)
+        self.initialized = True
+        return
+
+
+    def get_days(self, sim):
+        ''' The days on which the intervention in effect on that day needs to be applied '''
+        all_days = np.arange(sim.npts)
+        inds = np.array([np.argmax(self._cum_days > t) for t in all_days], dtype=int) # Index of the intervention to apply on each day
+        days = []
+        for idx,intervention in enumerate(self.interventions):
+            int_days = intervention.get_days(sim) if hasattr(intervention, 'get_days') else None # None means every day
+            this_days = all_days[inds == idx]
+            if int_days is not None:
+                this_days = np.intersect1d(this_days, int_days)
+            days.append(this_days)
+        return np.unique(np.concatenate(days))
+
+
     def apply(self, sim: cv.Sim):
         idx = np.argmax(self._cum_days > sim.t)  # Index of the intervention to apply on this day
         self.interventions[idx].apply(sim)
@@ -179,26 +358,41 @@ class change_beta(Intervention):
             errormsg = f'Number of days supplied ({len(self.days)}) does not match number of changes in beta ({len(self.changes)})'
             raise ValueError(errormsg)
         self.orig_betas = None
+        self._changes = None # The change to make on each day, compiled on initialization
         return
 
 
+    def initialize(self, sim):
+        ''' Store the original betas, and compile the change to make on each day '''
+        self.orig_betas = {}
+        for layer in self.layers:
+            if layer is None:
+                self.orig_betas['overall'] = sim['beta']
+            else:
+                self.orig_betas[layer] = sim['beta_layers'][layer]
+
+        self._changes = {}
+        for day in np.unique(self.days).tolist():
+            change = np.prod(self.changes[self.days == day]) # If a day is given more than once, apply all of its changes
+            self._changes[day] = change
+        self.initialized = True
+        return
+
+
+    def get_days(self, sim):
+        return np.array(sorted(self._changes.keys()))
+
+
     def apply(self, sim):
 
-        # If this is the first time it's being run, store beta
-        if self.orig_betas is None:
-            self.orig_betas = {}
-            for layer in self.layers:
-                if layer is None:
-                    self.orig_betas['overall'] = sim['beta']
-                else:
-                    self.orig_betas[layer] = sim['beta_layers'][layer]
+        if not self.initialized:
+            self.initialize(sim)
 
-        # If this day is found in the list, apply the intervention
-        inds = sc.findinds(self.days, sim.t)
-        if len(inds):
-            for layer,new_beta in self.orig_betas.items():
-                for ind in inds:
-                    new_beta = new_beta * self.changes[ind]
+        # If this day is scheduled, apply the intervention
+        change = self._changes.get(sim.t)
+        if change is not None:
+            for layer,orig_beta in self.orig_betas.items():
+                new_beta = orig_beta * change
                 if layer == 'overall':
                     sim['beta'] = new_beta
                 else:
@@ -210,7 +404,7 @@ class change_beta(Intervention):
         ''' Plot vertical lines for when changes in beta '''
         ylims = ax.get_ylim()
         for day in self.days:
-            pl.plot([day]*2, ylims, '--', c=[0,0,0])
+            ax.plot([day]*2, ylims, '--', c=[0,0,0])
         return
 
 
@@ -235,94 +429,158 @@ class test_num(Intervention):
         self.quar_test = quar_test
         self.sensitivity = sensitivity
         self.test_delay = test_delay
+        self._sampler = cv.AliasSampler() # For choosing who to test; only rebuilt when the testing probabilities change
 
         return
 
 
-    def apply(self, sim):
-
-        t = sim.t
-
-        # Process daily tests -- has to be here rather than init so have access to the sim object
+    def initialize(self, sim):
+        ''' Align the daily tests with the sim's days -- has to be here rather than in __init__ so have access to the sim object '''
+        import pandas as pd # Only needed if the tests are supplied as a dated series
         if isinstance(self.daily_tests, (pd.Series, pd.DataFrame)):
             start_date = sim['start_day']
             end_date = self.daily_tests.index[-1]
             dateindex = pd.date_range(start_date, end_date)
             self.daily_tests = self.daily_tests.reindex(dateindex, fill_value=0).to_numpy()
+        self.initialized = True
+        return
+
+
+    def get_days(self, sim):
+        ''' The days with tests '''
+        daily_tests = np.array(self.daily_tests, dtype=np.float64).reshape(len(self.daily_tests), -1)[:,0]
+        return (np.isfinite(daily_tests) & (daily_tests != 0)).nonzero()[0]
+
+
+    def apply(self, sim):
+
+        t = sim.t
+        if not self.initialized:
+            self.initialize(sim)
 
         # Check that there are still tests
         if t < len(self.daily_tests):
             n_tests = self.daily_tests[t]  # Number of tests for this day
-            if not (n_tests and pl.isfinite(n_tests)): # If there are no tests today, abort early
+            if not (n_tests and np.isfinite(n_tests)): # If there are no tests today, abort early
                 return
             else:
                 sim.results['new_tests'][t] += n_tests
         else:
             return
 
+        # Adjust testing probability based on what's happened to each person
+        # NB, these are applied separately, because a person can be both diagnosed and infectious/symptomatic
+        people = sim.people
+        new_diagnoses = people.check_diagnosed(t)
         test_probs = np.ones(sim.n)
-        new_diagnoses = 0
-
-        for i,person in enumerate(sim.people):
-
-            new_diagnoses += person.check_diagnosed(t)
+        test_probs[people.extract_array('symptomatic', dtype=bool)] *= self.sympt_test # They're symptomatic
+        test_probs[people.extract_array('quarantined', dtype=bool)] *= self.quar_test # They're in quarantine
+        test_probs[people.extract_array('diagnosed', dtype=bool)] = 0.0
 
-            # Adjust testing probability based on what's happened to the person
-            # NB, these need to be separate if statements, because a person can be both diagnosed and infectious/symptomatic
-            if person.symptomatic:
-                test_probs[i] *= self.sympt_test  # They're symptomatic
-            if person.quarantine:
-                test_probs[i] *= self.quar_test  # They're in quarantine
-            if person.diagnosed:
-                test_probs[i] = 0.0
-
-        test_inds = cv.choose_weighted(probs=test_probs, n=n_tests, normalize=True, unique=False)
+        test_inds = self._sampler.sample(n=n_tests, weights=test_probs)
         sim.results['new_diagnoses'][t] += new_diagnoses
-
-        for test_ind in test_inds:
-            person = sim.people[test_ind]
-            person.test(t, self.sensitivity, test_delay=self.test_delay)
+        people.test(test_inds, t, self.sensitivity, test_delay=self.test_delay)
 
         return
 
 
 class contact_tracing(Intervention):
     '''
-    Contact tracing of positives
+    Contact tracing of positives. The contacts of people diagnosed the day before
+    are found for all of them at once, in each static layer (e.g. home, school,
+    work) and in the community contacts they made recently, and the ones that are
+    reached are queued by the day they'll be notified. On each day, the
+    notifications due by the next day are passed on to the people, who go into
+    quarantine when the sim checks for known contacts.
+
+    Args:
+        trace_probs (dict): probability of tracing a contact, for each layer
+        trace_time (dict): number of days it takes to trace a contact, for each layer
+        start_day (int): when to start the intervention
+        contact_reduction (dict): not used yet
+        history_window (int): number of days of community contacts to trace (default: trace_time['c'])
     '''
-    def __init__(self, trace_probs, trace_time, start_day=0, contact_reduction=None):
+    def __init__(self, trace_probs, trace_time, start_day=0, contact_reduction=None, history_window=None):
         super().__init__()
         self.trace_probs = trace_probs
         self.trace_time = trace_time
         self.contact_reduction = contact_reduction # Not using this yet, but could potentially scale contact in this intervention
         self.start_day = start_day
+        self.history_window = history_window
+        self._contacts = None # The static contacts in CSR format, created on first use
+        self._people_id = None # Which people the contacts belong to
+        self._notifications = {} # Indices of traced people, by the day they're notified
         return
 
+
+    def initialize(self, sim):
+        ''' Clear any queued notifications, and ask the sim to store community contacts if they're traced '''
+        self._notifications = {}
+        if 'c' in self.trace_probs:
+            window = self.history_window if self.history_window is not None else self.trace_time['c']
+            if sim.contact_history is None or sim.contact_history.window < window:
+                sim.contact_history = cv.ContactHistory(window)
+        self.initialized = True
+        return
+
+
+    def get_contacts(self, sim):
+        ''' Get the static contacts of the sim's people in CSR format, converting them the first time '''
+        if self._contacts is None or self._people_id != id(sim.people):
+            popdict_contacts = sim.popdict['contacts'] if sim.popdict else None
+            if isinstance(popdict_contacts, cv.CSRContacts) and len(popdict_contacts) == sim.n:
+                contacts = popdict_contacts
+            else:
+                contacts = [person.contacts for person in sim.people]
+            keys = contacts.keys if isinstance(contacts, cv.CSRContacts) else list(contacts[0].keys()) if len(contacts) else []
+            keys = [key for key in keys if key != 'c'] # Community contacts change every timestep, so are traced from the sim's contact history instead
+            contacts = cv.CSRContacts.from_list(contacts, keys)
+            self._contacts = cv.CSRContacts({key:contacts.layer(key) for key in keys}, n=len(contacts))
+            self._people_id = id(sim.people)
+        return self._contacts
+
+
+    def get_days(self, sim):
+        return np.arange(self.start_day, sim.npts)
+
+
+    def notify(self, day, inds):
+        ''' Queue the people with the given indices to be notified on the given day '''
+        if len(inds):
+            self._notifications.setdefault(int(day), []).append(np.asarray(inds, dtype=np.int64))
+        return
+
+
+    def trace(self, key, contact_inds, t):
+        ''' Filter the contacts in one layer by the probability of reaching them, and queue the ones that are reached '''
+        traced = contact_inds[cv.get_rng().random(len(contact_inds)) < self.trace_probs[key]]
+        self.notify(t + self.trace_time[key], traced)
+        return
+
+
     def apply(self, sim):
         t = sim.t
+        if not self.initialized:
+            self.initialize(sim)
         if t < self.start_day:
             return
 
-        not_sus_people = sim.people.filter_out('susceptible') # Or maybe symptomatic here
-        for person in not_sus_people:
-            # N.B. consider skipping tracing from dead people
-
-            # Trace dynamic contact, e.g. the ones that change on every step
-            # A sample of community contacts is appended to person.dyn_cont_ppl on each step
-            person.trace_dynamic_contacts(self.trace_probs, self.trace_time)
+        people = sim.people
+        contacts = self.get_contacts(sim)
 
-            # If a person was just diagnosed,time to trace their (static) contacts
-            if person.date_diagnosed is not None and person.date_diagnosed == t-1: # TODO: tracing on symptomatic
-                contactable_ppl = person.trace_static_contacts(self.trace_probs, self.trace_time)
-                contactable_ppl.update(person.dyn_cont_ppl)
+        # If people were just diagnosed, time to trace their contacts
+        diag_inds = (people.extract_array('date_diagnosed') == t-1).nonzero()[0] # TODO: tracing on symptomatic
+        if len(diag_inds):
+            for key in contacts.keys:
+                self.trace(key, contacts.find_contacts(key, diag_inds), t)
+            if sim.contact_history is not None and 'c' in self.trace_probs:
+                self.trace('c', sim.contact_history.find_contacts(diag_inds, t), t)
 
-                # Loop over people who get contacted
-                for contact_ind, contact_time in contactable_ppl.items():
-                    target_person = sim.people[contact_ind]
-                    if target_person.date_known_contact is None:
-                        target_person.date_known_contact = t + contact_time
-                    else:
-                        target_person.date_known_contact = min(target_person.date_known_contact, t + contact_time)
+        # Pass on the notifications that are due by the next timestep, keeping the earliest date for each person
+        for day in sorted(day for day in self._notifications if day <= t+1):
+            inds = np.unique(np.concatenate(self._notifications.pop(day)))
+            date_known_contact = np.fmin(people.extract_array('date_known_contact', inds=inds), day)
+            people.set_attr('date_known_contact', inds, date_known_contact.astype(np.int64))
 
         return
 
@@ -372,25 +630,28 @@ class test_prob(Intervention):
         return
 
 
+    def get_days(self, sim):
+        return np.arange(self.start_day, sim.npts)
+
+
     def apply(self, sim):
         ''' Perform testing '''
         t = sim.t
         if t < self.start_day:
             return
 
-        new_tests = 0
-        new_diagnoses = 0
-        for person in sim.people:
-            new_diagnoses += person.check_diagnosed(t)
-            if (person.symptomatic and cv.bt(self.symptomatic_prob)) or \
-                (not person.symptomatic and cv.bt(self.asymptomatic_prob)) or \
-                (person.quarantine and cv.bt(self.quarantine_prob)) or \
-                (person.symptomatic and person.quarantine and cv.bt(self.symp_quar_prob)) :
-
-                new_tests += 1
-                person.test(t, self.test_sensitivity, self.loss_prob, self.test_delay)
-
-        sim.results['new_tests'][t] += new_tests
+        # Probabilities are OR'd together: a person is tested unless none of the applicable trials succeed
+        people = sim.people
+        new_diagnoses = people.check_diagnosed(t)
+        symp = people.extract_array('symptomatic', dtype=bool)
+        quar = people.extract_array('quarantined', dtype=bool)
+        no_test_probs = (1 - np.where(symp, self.symptomatic_prob, self.asymptomatic_prob)) * \
+                        (1 - quar*self.quarantine_prob) * \
+                        (1 - (symp & quar)*self.symp_quar_prob)
+        test_inds = (cv.get_rng().random(sim.n) >= no_test_probs).nonzero()[0]
+        people.test(test_inds, t, self.test_sensitivity, self.loss_prob, self.test_delay)
+
+        sim.results['new_tests'][t] += len(test_inds)
         sim.results['new_diagnoses'][t] += new_diagnoses
 
         return
@@ -406,7 +667,7 @@ class test_historical(Intervention):
     This intervention will actually test all individuals. At the moment, testing someone who is negative
     has no effect, so they don't really need to be tested. However, it's possible that in the future
     a negative test may still have an impact (e.g. make it less likely for an individual to re-test even
-    if they become symptomatic). Therefore to remain as accurate as possible, `Person.test()` is guaranteed
+    if they become symptomatic). Therefore to remain as accurate as possible, `People.test()` is guaranteed
     to be called for every person tested.
 
     One minor limitation of this intervention is that symptomatic individuals that are tested and in reality
@@ -429,6 +690,11 @@ class test_historical(Intervention):
         return
 
 
+    def get_days(self, sim):
+        ''' The days with tests '''
+        return self.n_tests.nonzero()[0]
+
+
     def apply(self, sim):
         ''' Perform testing '''
 
@@ -437,26 +703,17 @@ class test_historical(Intervention):
         if self.n_tests[t]:
 
             # Compute weights for people who would test positive or negative
-            positive_tests = np.zeros((sim.n,))
-            for i,person in enumerate(sim.people):
-                if person.infectious:
-                    positive_tests[i] = 1
+            positive_tests = sim.people.extract_array('infectious', dtype=bool).astype(np.float64)
             negative_tests = 1-positive_tests
 
             # Select the people to test in each category
-            positive_inds = cv.choose_weighted(probs=positive_tests, n=min(sum(positive_tests), self.n_positive[t]), normalize=True)
-            negative_inds = cv.choose_weighted(probs=negative_tests, n=min(sum(negative_tests), self.n_tests[t]-len(positive_inds)), normalize=True)
-
-            # Todo - assess performance and optimize e.g. to reduce dict indexing
-            for ind in positive_inds:
-                person = sim.people[ind]
-                person.test(t, test_sensitivity=1.0) # Sensitivity is 1 because the person is guaranteed to test positive
-                sim.results['new_diagnoses'][t] += 1
-
-            for ind in negative_inds:
-                person = sim.people[ind]
-                person.test(t, test_sensitivity=1.0)
+            positive_inds = cv.choose_weighted(probs=positive_tests, n=min(positive_tests.sum(), self.n_positive[t]), normalize=True)
+            negative_inds = cv.choose_weighted(probs=negative_tests, n=min(negative_tests.sum(), self.n_tests[t]-len(positive_inds)), normalize=True)
 
+            # Sensitivity is 1 because the positive people are guaranteed to test positive
+            sim.people.test(positive_inds, t, test_sensitivity=1.0)
+            sim.people.test(negative_inds, t, test_sensitivity=1.0)
+            sim.results['new_diagnoses'][t] += len(positive_inds)
             sim.results['new_tests'][t] += self.n_tests[t]
 
         return
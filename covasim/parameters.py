@@ -3,7 +3,6 @@ Set the parameters for Covasim.
 '''
 
 import numpy as np
-import pandas as pd
 
 
 __all__ = ['make_pars', 'set_contacts', 'get_prognoses', 'load_data']
@@ -33,6 +32,7 @@ def make_pars(set_prognoses=False, prog_by_age=True, use_layers=False, **kwargs)
     pars['n_days']     = 60 # Number of days of run, if end_day isn't used
     pars['rand_seed']  = 1 # Random seed, if None, don't reset
     pars['verbose']    = 1 # Whether or not to display information during the run -- options are 0 (silent), 1 (default), 2 (everything)
+    pars['crn']        = False # Whether to use common random numbers: separate streams for the population, importation, natural history, transmission, and interventions, so runs with the same seed are matched across scenarios
 
     # Rescaling parameters
     pars['pop_scale']         = 1   # Factor by which to scale the population -- e.g. 1000 with pop_size = 10e3 means a population of 10m
@@ -113,11 +113,14 @@ def set_contacts(pars):
 
 
 
+_prognoses = {} # Cached by get_prognoses(), since they're requested every time a sim is created
+
 def get_prognoses(by_age=True):
     '''
     Return the default parameter values for prognoses
 
     The prognosis probabilities are conditional given the previous disease state.
+    They are only calculated once per process; each call returns a fresh copy.
 
     Args:
         by_age (bool): whether or not to use age-specific values
@@ -126,6 +129,14 @@ def get_prognoses(by_age=True):
         prog_pars (dict): the dictionary of prognosis probabilities
 
     '''
+    by_age = bool(by_age)
+    if by_age not in _prognoses:
+        _prognoses[by_age] = _make_prognoses(by_age)
+    return {key:val.copy() for key,val in _prognoses[by_age].items()}
+
+
+def _make_prognoses(by_age):
+    ''' Calculate the prognoses for get_prognoses() '''
 
     max_age = 120 # For the sake of having a finite age cutoff
 
@@ -166,6 +177,7 @@ def load_data(filename, columns=None, calculate=True, verbose=True, **kwargs):
     Returns:
         data (dataframe): pandas dataframe of the loaded data
     '''
+    import pandas as pd # Only needed for loading data
 
     # Load data
     if filename.lower().endswith('csv'):
@@ -11,17 +11,62 @@ from . import utils as cvu
 # Specify all externally visible functions this file defines
 __all__ = ['Person']
 
+
+# States and dates that are stored in arrays shared by all people (see People.arrays), so
+# that the testing interventions can read and write them for everyone at once
+array_states = ['infectious', 'symptomatic', 'tested', 'diagnosed', 'quarantined']
+array_dates  = ['date_diagnosed', 'date_known_contact', 'end_quarantine']
+
+
+def make_arrays(n):
+    '''
+    Make the arrays storing the array-backed states (False) and dates (NaN, i.e. None)
+    of n people, plus the log of tests, a list of (t, inds) pairs of the day and the
+    indices of the people tested that day (see Person.date_tested)
+    '''
+    arrays = {attr:np.zeros(n, dtype=bool) for attr in array_states}
+    arrays.update({attr:np.full(n, np.nan) for attr in array_dates})
+    arrays['test_log'] = []
+    return arrays
+
+
+def _array_state(attr):
+    ''' Make a property for a state stored in the people's arrays '''
+    def get(self):
+        return self._arrays[attr].item(self._ind)
+    def set(self, value):
+        self._arrays[attr][self._ind] = value
+    return property(get, set)
+
+
+def _array_date(attr):
+    ''' Make a property for a date stored in the people's arrays, where NaN means None '''
+    def get(self):
+        value = self._arrays[attr].item(self._ind)
+        return None if value != value else value
+    def set(self, value):
+        self._arrays[attr][self._ind] = np.nan if value is None else value
+    return property(get, set)
+
+
 class Person(sc.prettyobj):
     '''
     Class for a single person.
+
+    The states and dates listed in array_states and array_dates are stored in
+    arrays shared by the whole population (row ind of arrays), rather than on
+    the person; a person created on their own gets arrays of their own.
     '''
-    def __init__(self, pars, uid, age, sex, contacts):
+    def __init__(self, pars, uid, age, sex, contacts, arrays=None, ind=0):
+        if arrays is None:
+            arrays = make_arrays(1)
+        self._arrays     = arrays # Storage for the array-backed states and dates
+        self._ind        = ind # This person's row in the arrays
         self.uid         = uid # This person's unique identifier
         self.age         = float(age) # Age of the person (in years)
         self.sex         = int(sex) # Female (0) or male (1)
         self.contacts    = contacts # Contacts
         self.durpars     = pars['dur']  # Store duration parameters
-        self.dyn_cont_ppl = {} # People who are contactable within the community.  Changes every step so has to be here.
 
         # Set states
         self.make_susceptible()
@@ -38,6 +83,50 @@ class Person(sc.prettyobj):
         return
 
 
+    # Array-backed states and dates
+    infectious         = _array_state('infectious')
+    symptomatic        = _array_state('symptomatic')
+    tested             = _array_state('tested')
+    diagnosed          = _array_state('diagnosed')
+    quarantined        = _array_state('quarantined')
+    date_diagnosed     = _array_date('date_diagnosed')
+    date_known_contact = _array_date('date_known_contact')
+    end_quarantine     = _array_date('end_quarantine')
+
+
+    @property
+    def date_tested(self):
+        ''' The days on which this person was tested, from the log of tests, or None if they haven't been '''
+        date_tested = []
+        for t,inds in self._arrays['test_log']:
+            date_tested += [t]*int(np.count_nonzero(inds == self._ind))
+        return date_tested if date_tested else None
+
+    @date_tested.setter
+    def date_tested(self, value):
+        log = self._arrays['test_log']
+        if log: # Remove any earlier tests
+            log[:] = [(t, inds[inds != self._ind]) for t,inds in log]
+        if value is not None:
+            for t in sc.promotetolist(value):
+                log.append((t, np.array([self._ind])))
+        return
+
+
+    def __getattr__(self, attr):
+        ''' Give a person whose subclass doesn't call Person.__init__() arrays of their own '''
+        if attr in ['_arrays', '_ind']:
+            self._arrays = make_arrays(1)
+            self._ind    = 0
+            return getattr(self, attr)
+        raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{attr}'")
+
+
+    def __repr__(self):
+        ''' Don't show the whole population's arrays '''
+        return sc.prepr(self, skip='_arrays')
+
+
     def make_susceptible(self):
         """
         Make person susceptible. This is used during initialization and dynamic resampling
@@ -84,7 +173,7 @@ class Person(sc.prettyobj):
 
 
     # Methods to make events occur (infection and diagnosis)
-    def infect(self, t, bed_constraint=None, source=None):
+    def infect(self, t, bed_constraint=None, source=None, rng=None):
         """
         Infect this person and determine their eventual outcomes.
             * Every infected person can infect other people, regardless of whether they develop symptoms
@@ -96,10 +185,17 @@ class Person(sc.prettyobj):
             t: (int) timestep
             bed_constraint: (bool) whether or not there is a bed available for this person
             source: (Person instance), if None, then it was a seed infection
+            rng: (RandomStream), if supplied, draw the natural history from this stream (for common random numbers) rather than the global one
 
         Returns:
             1 (for incrementing counters)
         """
+        if rng is None:
+            sample, bt = cvu.sample, cvu.bt
+        else:
+            sample = lambda **kwargs: cvu.sample(**kwargs, rng=rng)
+            bt = lambda prob: rng.random_sample() < prob
+
         self.susceptible    = False
         self.exposed        = True
         self.date_exposed   = t
@@ -108,54 +204,54 @@ class Person(sc.prettyobj):
         if bed_constraint is None: bed_constraint = False
 
         # Calculate how long before this person can infect other people
-        self.dur_exp2inf     = cvu.sample(**self.durpars['exp2inf'])
+        self.dur_exp2inf     = sample(**self.durpars['exp2inf'])
         self.date_infectious = t + self.dur_exp2inf
 
         # Use prognosis probabilities to determine what happens to them
-        symp_bool = cvu.bt(self.symp_prob) # Determine if they develop symptoms
+        symp_bool = bt(self.symp_prob) # Determine if they develop symptoms
 
         # CASE 1: Asymptomatic: may infect others, but have no symptoms and do not die
         if not symp_bool:  # No symptoms
-            dur_asym2rec = cvu.sample(**self.durpars['asym2rec'])
+            dur_asym2rec = sample(**self.durpars['asym2rec'])
             self.date_recovered = self.date_infectious + dur_asym2rec  # Date they recover
             self.dur_disease = self.dur_exp2inf + dur_asym2rec  # Store how long this person had COVID-19
 
         # CASE 2: Symptomatic: can either be mild, severe, or critical
         else:
-            self.dur_inf2sym = cvu.sample(**self.durpars['inf2sym']) # Store how long this person took to develop symptoms
+            self.dur_inf2sym = sample(**self.durpars['inf2sym']) # Store how long this person took to develop symptoms
             self.date_symptomatic = self.date_infectious + self.dur_inf2sym # Date they become symptomatic
-            sev_bool = cvu.bt(self.severe_prob) # See if they're a severe or mild case
+            sev_bool = bt(self.severe_prob) # See if they're a severe or mild case
 
             # CASE 2a: Mild symptoms, no hospitalization required and no probaility of death
             if not sev_bool: # Easiest outcome is that they're a mild case - set recovery date
-                dur_mild2rec = cvu.sample(**self.durpars['mild2rec'])
+                dur_mild2rec = sample(**self.durpars['mild2rec'])
                 self.date_recovered = self.date_symptomatic + dur_mild2rec  # Date they recover
                 self.dur_disease = self.dur_exp2inf + self.dur_inf2sym + dur_mild2rec  # Store how long this person had COVID-19
 
             # CASE 2b: Severe cases: hospitalization required, may become critical
             else:
-                self.dur_sym2sev = cvu.sample(**self.durpars['sym2sev']) # Store how long this person took to develop severe symptoms
+                self.dur_sym2sev = sample(**self.durpars['sym2sev']) # Store how long this person took to develop severe symptoms
                 self.date_severe = self.date_symptomatic + self.dur_sym2sev  # Date symptoms become severe
-                crit_bool = cvu.bt(self.crit_prob)  # See if they're a critical case
+                crit_bool = bt(self.crit_prob)  # See if they're a critical case
 
                 if not crit_bool:  # Not critical - they will recover
-                    dur_sev2rec = cvu.sample(**self.durpars['sev2rec'])
+                    dur_sev2rec = sample(**self.durpars['sev2rec'])
                     self.date_recovered = self.date_severe + dur_sev2rec  # Date they recover
                     self.dur_disease = self.dur_exp2inf + self.dur_inf2sym + self.dur_sym2sev + dur_sev2rec  # Store how long this person had COVID-19
 
                 # CASE 2c: Critical cases: ICU required, may die
                 else:
-                    self.dur_sev2crit = cvu.sample(**self.durpars['sev2crit'])
+                    self.dur_sev2crit = sample(**self.durpars['sev2crit'])
                     self.date_critical = self.date_severe + self.dur_sev2crit  # Date they become critical
                     this_death_prob = self.death_prob * (self.OR_no_treat if bed_constraint else 1.) # Probability they'll die
-                    death_bool = cvu.bt(this_death_prob)  # Death outcome
+                    death_bool = bt(this_death_prob)  # Death outcome
 
                     if death_bool:
-                        dur_crit2die = cvu.sample(**self.durpars['crit2die'])
+                        dur_crit2die = sample(**self.durpars['crit2die'])
                         self.date_dead = self.date_critical + dur_crit2die # Date of death
                         self.dur_disease = self.dur_exp2inf + self.dur_inf2sym + self.dur_sym2sev + self.dur_sev2crit + dur_crit2die   # Store how long this person had COVID-19
                     else:
-                        dur_crit2rec = cvu.sample(**self.durpars['crit2rec'])
+                        dur_crit2rec = sample(**self.durpars['crit2rec'])
                         self.date_recovered = self.date_critical + dur_crit2rec # Date they recover
                         self.dur_disease = self.dur_exp2inf + self.dur_inf2sym + self.dur_sym2sev + self.dur_sev2crit + dur_crit2rec  # Store how long this person had COVID-19
 
@@ -168,8 +264,12 @@ class Person(sc.prettyobj):
 
     def trace_dynamic_contacts(self, trace_probs, trace_time, ckey='c'):
         '''
-        A method to trace a person's dynamic contacts, e.g. community
+        A method to trace a person's dynamic contacts, e.g. community, storing them
+        in self.dyn_cont_ppl. Kept for backwards compatibility: contact_tracing now
+        traces community contacts from the sim's contact history instead.
         '''
+        if not hasattr(self, 'dyn_cont_ppl'):
+            self.dyn_cont_ppl = {}
         if ckey in self.contacts:
             this_trace_prob = trace_probs[ckey]
             new_contact_keys = cvu.bf(this_trace_prob, self.contacts[ckey])
@@ -179,7 +279,9 @@ class Person(sc.prettyobj):
 
     def trace_static_contacts(self, trace_probs, trace_time):
         '''
-        A method to trace a person's static contacts, e.g. home, school, work
+        A method to trace a person's static contacts, e.g. home, school, work.
+        Kept for backwards compatibility: contact_tracing now traces everyone's
+        static contacts at once.
         '''
         contactable_ppl = {}  # Store people that are contactable and how long it takes to contact them
         for ckey in self.contacts.keys():
@@ -207,11 +309,7 @@ class Person(sc.prettyobj):
             Whether or not this person tested positive
         '''
         self.tested = True
-
-        if self.date_tested is None: # First time tested
-            self.date_tested = [t]
-        else:
-            self.date_tested.append(t) # They're been tested before; append new test date. TODO: adjust testing probs based on whether a person's a repeat tester?
+        self._arrays['test_log'].append((t, np.array([self._ind]))) # TODO: adjust testing probs based on whether a person's a repeat tester?
 
         if self.infectious and cvu.bt(test_sensitivity):  # Person was tested and is true-positive
             needs_diagnosis = not self.date_diagnosed or self.date_diagnosed and self.date_diagnosed > t+test_delay
@@ -3,8 +3,14 @@ Defines functions for making the population.
 '''
 
 #%% Imports
+import os
+import json
+import operator
+import itertools
+import multiprocessing as mp
 import numpy as np # Needed for a few things not provided by pl
 import sciris as sc
+from . import version as cvv
 from . import utils as cvu
 from . import defaults as cvd
 from . import requirements as cvreqs
@@ -14,9 +20,10 @@ from collections import defaultdict
 
 
 # Specify all externally visible functions this file defines
-__all__ = ['People', 'make_people', 'make_randpop', 'make_random_contacts',
+__all__ = ['People', 'make_people', 'make_popdict', 'make_randpop', 'make_random_contacts',
            'make_microstructured_contacts', 'make_realistic_contacts',
-           'make_synthpop']
+           'make_randpop_chunked', 'make_synthpop', 'synthpop_to_popdict', 'CSRContacts', 'ContactRow',
+           'ContactHistory', 'save_popdict', 'load_popdict', 'SharedPopulation']
 
 
 class People(list):
@@ -26,8 +33,21 @@ class People(list):
     the repr of an odict, and with a keys() method. It also has shortcuts for "filtering
     in" (i.e., keeping people with a certain attribute) and "filtering out" (removing
     people with a certain attribute).
+
+    The states and dates the testing interventions use (person.array_states and
+    person.array_dates) are stored in the arrays attribute, a dict with one array
+    per attribute and one entry per person, which each person reads and writes.
+    The days each person was tested are logged in bulk, in arrays['test_log'].
     '''
 
+    def _array(self, attr):
+        ''' Return the array storing this attribute for everyone, or None if it's stored on each person '''
+        arrays = getattr(self, 'arrays', None)
+        if arrays is not None and attr in arrays and len(arrays[attr]) == len(self): # Not the case for e.g. people combined from several sims
+            return arrays[attr]
+        return None
+
+
     def filter_in(self, attr):
         '''
         Filter in based on an attribute.
@@ -77,6 +97,150 @@ class People(list):
         return [getattr(person, attr) for person in self]
 
 
+    def extract_array(self, attr, inds=None, dtype=np.float64, fill=np.nan):
+        '''
+        Return a given attribute for every person (or the people with the given
+        indices) as an array, for vectorized operations on people's states.
+
+        Args:
+            attr (str): The attribute to extract.
+            inds (array): If supplied, only extract the attribute for these people.
+            dtype (type): The type of the array (e.g. bool for states, float for dates).
+            fill (any): The value to use in place of None (e.g. for dates that haven't happened).
+
+        Example:
+            diagnosed = sim.people.extract_array('diagnosed', dtype=bool)
+        '''
+        array = self._array(attr)
+        if array is not None:
+            values = array.copy() if inds is None else array[inds]
+            if array.dtype == np.float64 and fill is not None and not np.isnan(fill):
+                values[np.isnan(values)] = fill
+            return values.astype(dtype, copy=False)
+        people = self if inds is None else [self[ind] for ind in np.asarray(inds).tolist()]
+        values = map(operator.attrgetter(attr), people)
+        if fill is not None:
+            values = (fill if value is None else value for value in values)
+        return np.fromiter(values, dtype=dtype, count=len(people))
+
+
+    def set_attr(self, attr, inds, values):
+        '''
+        Set a given attribute for the people with the given indices.
+
+        Args:
+            attr (str): The attribute to set.
+            inds (array): The indices of the people to update.
+            values (any): Either a single value for everyone, or one value per index.
+
+        Example:
+            sim.people.set_attr('diagnosed', new_diagnoses, True)
+        '''
+        array = self._array(attr)
+        if array is not None:
+            array[inds] = np.nan if values is None else values
+            return
+        if np.ndim(values) == 0:
+            values = itertools.repeat(values)
+        elif isinstance(values, np.ndarray):
+            values = values.tolist() # Store Python numbers rather than Numpy scalars
+        for ind,value in zip(inds.tolist() if isinstance(inds, np.ndarray) else inds, values):
+            setattr(self[ind], attr, value)
+        return
+
+
+    def check_diagnosed(self, t):
+        '''
+        Check for new diagnoses for everyone at once; the vectorized equivalent of
+        Person.check_diagnosed().
+
+        Args:
+            t (int): current timestep
+
+        Returns:
+            The number of new diagnoses
+        '''
+        diagnosed = self.extract_array('diagnosed', dtype=bool)
+        date_diagnosed = self.extract_array('date_diagnosed')
+        new_diagnoses = (~diagnosed & (date_diagnosed <= t)).nonzero()[0] # NaN (never diagnosed) compares as False
+        self.set_attr('diagnosed', new_diagnoses, True)
+        return len(new_diagnoses)
+
+
+    def test(self, inds, t, test_sensitivity=1.0, loss_prob=0.0, test_delay=0):
+        '''
+        Test the people with the given indices all at once; the vectorized equivalent
+        of calling Person.test() for each of them.
+
+        Args:
+            inds (array): indices of the people to test (repeats mean a person is tested more than once)
+            t (int): current timestep
+            test_sensitivity (float): probability of a true positive
+            loss_prob (float): probability of loss to follow-up
+            test_delay (int): number of days before test results are ready
+
+        Returns:
+            The indices of the people who tested positive
+        '''
+        inds = np.asarray(inds, dtype=np.int64)
+        n_tests = len(inds)
+        self.set_attr('tested', inds, True)
+        if self._array('tested') is not None: # Log everyone's tests at once
+            self.arrays['test_log'].append((t, inds.copy()))
+        else:
+            for ind in inds.tolist():
+                person = self[ind]
+                person._arrays['test_log'].append((t, np.array([person._ind])))
+
+        # Work out who tests positive and who needs a diagnosis
+        infectious = self.extract_array('infectious', inds=inds, dtype=bool)
+        positive = infectious & (cvu.get_rng().random(n_tests) < test_sensitivity)
+        date_diagnosed = self.extract_array('date_diagnosed', inds=inds) # None becomes NaN
+        date_result = t + test_delay
+        needs_diagnosis = ~(date_diagnosed <= date_result) # Never diagnosed, or diagnosed later than this result
+        not_lost = cvu.get_rng().random(n_tests) >= loss_prob
+        diag_inds = inds[positive & needs_diagnosis & not_lost]
+        self.set_attr('date_diagnosed', diag_inds, date_result)
+
+        return inds[positive]
+
+
+    def check_quarantine(self, t, quar_period):
+        '''
+        Put people who have become known contacts into quarantine, and release people
+        whose quarantine has ended, for everyone at once; the vectorized equivalent
+        of calling Person.check_quar_begin() and Person.check_quar_end() for each person.
+
+        Args:
+            t (int): current timestep
+            quar_period (int): number of days to quarantine for (if None, nobody is quarantined)
+
+        Returns:
+            The number of people newly quarantined
+        '''
+        quarantined        = self._array('quarantined')
+        date_known_contact = self._array('date_known_contact')
+        end_quarantine     = self._array('end_quarantine')
+        if quarantined is None or date_known_contact is None or end_quarantine is None: # Not stored in arrays, so check each person
+            new_quarantined = 0
+            for person in self:
+                new_quarantined += person.check_quar_begin(t, quar_period)
+                person.check_quar_end(t)
+            return new_quarantined
+
+        new_quarantined = 0
+        if quar_period is not None:
+            begin = (date_known_contact <= t).nonzero()[0] # NaN (no known contact) compares as False
+            new_quarantined = len(begin) - np.count_nonzero(quarantined[begin])
+            quarantined[begin] = True
+            end_quarantine[begin] = np.fmax(end_quarantine[begin], t + quar_period) # Extend, but never shorten, an existing quarantine
+            date_known_contact[begin] = np.nan
+        release = (quarantined & (end_quarantine <= t)).nonzero()[0]
+        quarantined[release] = False
+        end_quarantine[release] = np.nan
+        return int(new_quarantined)
+
+
     def keys(self):
         ''' Convenience method to list the "keys" of the list '''
         return list(range(len(self)))
@@ -87,7 +251,7 @@ class People(list):
         return sc.odict.__repr__(self) # Use the odict repr to skip large numbers of people
 
 
-def make_people(sim, verbose=None, die=True, reset=False):
+def make_people(sim, verbose=None, die=True, reset=False, popfile=None, chunk_size=None):
     '''
     Make the actual people for the simulation.
 
@@ -97,6 +261,8 @@ def make_people(sim, verbose=None, die=True, reset=False):
         id_len (int): length of ID for each person (default: calculate required length based on the number of people)
         die (bool): whether or not to fail if synthetic populations are requested but not available
         reset (bool): whether to force population creation even if self.popdict exists
+        popfile (str): if supplied, write the population to this folder in the binary format and memory-map it (random populations are also generated in chunks; see make_randpop())
+        chunk_size (int): the number of people to generate per chunk if popfile is supplied
 
     Returns:
         None.
@@ -104,34 +270,11 @@ def make_people(sim, verbose=None, die=True, reset=False):
 
     # Set inputs and defaults
     pop_size = int(sim['pop_size']) # Shorten
-    pop_type = sim['pop_type'] # Shorten
     if verbose is None:
         verbose = sim['verbose']
 
-    # Check which type of population to produce
-    if pop_type == 'synthpops' and not cvreqs.available['synthpops']:
-        errormsg = f'You have requested "{pop_type}" population, but synthpops is not available; please use random, clustered, or realistic'
-        if die:
-            raise ValueError(errormsg)
-        else:
-            print(errormsg)
-            pop_type = 'random'
-
-    # Actually create the population
-    if pop_type in ['realistic', 'synthpops']:
-        sim.update_pars(use_layers=True) # These two population types require layers
-
-    if sim.popdict and not reset:
-        popdict = sim.popdict # Use stored one
-    else:
-        # Create the population
-        if pop_type in ['random', 'clustered', 'realistic']:
-            popdict = make_randpop(sim, microstructure=pop_type)
-        elif pop_type == 'synthpops':
-            popdict = make_synthpop(sim)
-        else:
-            errormsg = f'Population type "{pop_type}" not found; choices are random, clustered, realistic, or synthpops'
-            raise NotImplementedError(errormsg)
+    # Create the population, or use the stored one
+    popdict = make_popdict(sim, die=die, reset=reset, popfile=popfile, chunk_size=chunk_size)
 
     # Ensure prognoses are set
     if sim['prognoses'] is None:
@@ -139,12 +282,15 @@ def make_people(sim, verbose=None, die=True, reset=False):
 
     # Actually create the people
     people = People() # List for storing the people
+    people.arrays = cvper.make_arrays(pop_size) # Storage for the states and dates used by the testing interventions
     for p in range(pop_size): # Loop over each person
         keys = ['uid', 'age', 'sex', 'contacts']
         person_args = {}
         for key in keys:
             person_args[key] = popdict[key][p] # Convert from list to dict
-        person = cvper.Person(pars=sim.pars, **person_args) # Create the person
+        if type(person_args['contacts']) is dict: # Copy, since the community contacts are stored here while running, and the population may be shared between sims
+            person_args['contacts'] = dict(person_args['contacts'])
+        person = cvper.Person(pars=sim.pars, arrays=people.arrays, ind=p, **person_args) # Create the person
         people.append(person) # Save them to the dictionary
 
     # Store people
@@ -158,25 +304,77 @@ def make_people(sim, verbose=None, die=True, reset=False):
     return
 
 
-def make_randpop(sim, age_data=None, sex_ratio=0.5, microstructure=False):
-    ''' Make a random population, without contacts '''
+def make_popdict(sim, die=True, reset=False, popfile=None, chunk_size=None):
+    '''
+    Make the population dictionary (ages, sexes, and contacts) for the simulation,
+    without creating the people themselves.
+
+    Args:
+        sim (Sim): the simulation object
+        die (bool): whether or not to fail if synthetic populations are requested but not available
+        reset (bool): whether to force population creation even if sim.popdict exists
+        popfile (str): if supplied, write the population to this folder in the binary format and memory-map it (random populations are also generated in chunks; see make_randpop())
+        chunk_size (int): the number of people to generate per chunk if popfile is supplied
+
+    Returns:
+        popdict (dict): the population dictionary
+    '''
+
+    pop_type = sim['pop_type'] # Shorten
+
+    # Check which type of population to produce
+    if pop_type == 'synthpops' and not cvreqs.available['synthpops']:
+        errormsg = f'You have requested "{pop_type}" population, but synthpops is not available; please use random, clustered, or realistic'
+        if die:
+            raise ValueError(errormsg)
+        else:
+            print(errormsg)
+            pop_type = 'random'
+
+    # Actually create the population
+    if pop_type in ['realistic', 'synthpops']:
+        sim.update_pars(use_layers=True) # These two population types require layers
+
+    if sim.popdict and not reset:
+        popdict = sim.popdict # Use stored one
+    else:
+        # Create the population
+        if pop_type in ['random', 'clustered', 'realistic']:
+            popdict = make_randpop(sim, microstructure=pop_type, popfile=popfile, chunk_size=chunk_size)
+        elif pop_type == 'synthpops':
+            popdict = make_synthpop(sim, popfile=popfile)
+        else:
+            errormsg = f'Population type "{pop_type}" not found; choices are random, clustered, realistic, or synthpops'
+            raise NotImplementedError(errormsg)
+
+    return popdict
 
-    pop_size = int(sim['pop_size']) # Number of people
+
+def make_randpop(sim, age_data=None, sex_ratio=0.5, microstructure=False, popfile=None, chunk_size=None):
+    '''
+    Make a random population, with contacts.
+
+    If popfile is supplied, the population is instead generated chunk_size people
+    at a time and written incrementally to disk in the binary format (see
+    save_popdict()), so the full population never needs to fit in memory. The
+    returned population dictionary is then memory-mapped from that folder, and a
+    person's contacts are only read from disk when they are used.
+    '''
 
     # Load age data based on 2018 Seattle demographics
     if age_data is None:
         age_data = cvd.default_age_data
 
+    # Optionally generate out-of-core
+    if popfile is not None:
+        make_randpop_chunked(sim, popfile, age_data=age_data, sex_ratio=sex_ratio, microstructure=microstructure, chunk_size=chunk_size)
+        return load_popdict(popfile)
+
+    pop_size = int(sim['pop_size']) # Number of people
+
     # Handle sexes and ages
     uids = np.arange(pop_size, dtype=int)
-    sexes = cvu.rbt(sex_ratio, pop_size)
-    age_data_min  = age_data[:,0]
-    age_data_max  = age_data[:,1] + 1 # Since actually e.g. 69.999
-    age_data_range = age_data_max - age_data_min
-    age_data_prob = age_data[:,2]
-    age_data_prob /= age_data_prob.sum() # Ensure it sums to 1
-    age_bins = cvu.mt(age_data_prob, pop_size) # Choose age bins
-    ages = age_data_min[age_bins] + age_data_range[age_bins]*np.random.random(pop_size) # Uniformly distribute within this age bin
+    sexes, ages = _make_ages_sexes(pop_size, age_data, sex_ratio)
 
     # Store output; data duplicated as per-person and list-like formats for convenience
     popdict = {}
@@ -200,6 +398,19 @@ def make_randpop(sim, age_data=None, sex_ratio=0.5, microstructure=False):
     return popdict
 
 
+def _make_ages_sexes(n, age_data, sex_ratio):
+    ''' Draw the sexes and ages of n people '''
+    sexes = cvu.rbt(sex_ratio, n)
+    age_data_min  = age_data[:,0]
+    age_data_max  = age_data[:,1] + 1 # Since actually e.g. 69.999
+    age_data_range = age_data_max - age_data_min
+    age_data_prob = age_data[:,2]
+    age_data_prob = age_data_prob/age_data_prob.sum() # Ensure it sums to 1
+    age_bins = cvu.mt(age_data_prob, n) # Choose age bins
+    ages = age_data_min[age_bins] + age_data_range[age_bins]*cvu.get_rng().random(n) # Uniformly distribute within this age bin
+    return sexes, ages
+
+
 def make_random_contacts(pop_size, contacts):
     ''' Make random static contacts '''
 
@@ -303,35 +514,693 @@ def make_realistic_contacts(pop_size, ages, contacts, school_ages=None, work_age
 
 
 
+def make_randpop_chunked(sim, popfile, age_data=None, sex_ratio=0.5, microstructure='random', chunk_size=None):
+    '''
+    Make a random population chunk_size people at a time, writing each chunk to
+    disk as it's generated, so populations larger than memory can be created. The
+    output is in the binary format read by load_popdict(). Contacts follow the
+    same structure as make_random_contacts(), make_microstructured_contacts(), and
+    make_realistic_contacts(), except that random contacts are drawn with
+    replacement, and clusters (e.g. households) do not span chunks.
+
+    Args:
+        sim (Sim): the simulation object (for pop_size and contacts)
+        popfile (str): the folder to write the population to
+        age_data (array): age bins and their probabilities; see default_age_data
+        sex_ratio (float): proportion of people who are male
+        microstructure (str): the type of contacts; random, clustered, or realistic
+        chunk_size (int): number of people to generate at once (default 100,000)
+
+    Returns:
+        popfile (str): the folder the population was written to
+    '''
+
+    # Handle inputs and defaults
+    pop_size = int(sim['pop_size'])
+    chunk_size = int(chunk_size) if chunk_size else int(100e3)
+    if age_data is None:
+        age_data = cvd.default_age_data
+    contacts = sc.dcp(sim['contacts'])
+    contacts.pop('c', None) # Remove community
+    eligible_ages = {}
+    if microstructure in ['random', 'clustered']:
+        contact_keys = list(contacts.keys())
+        clustered_keys = contact_keys if microstructure == 'clustered' else []
+    elif microstructure == 'realistic':
+        contact_keys = ['h', 's', 'w']
+        contacts = sc.mergedicts({'h':4, 's':20, 'w':20}, contacts) # Ensure essential keys are populated
+        clustered_keys = ['h']
+        eligible_ages = {'s':[6, 18], 'w':[18, 65]} # As in make_realistic_contacts()
+    else:
+        errormsg = f'Microstructure type "{microstructure}" not found; choices are random, clustered, or realistic'
+        raise NotImplementedError(errormsg)
+
+    chunks = [(start, min(start+chunk_size, pop_size)) for start in range(0, pop_size, chunk_size)]
+    writer = _PopdictWriter(popfile)
+
+    # Ages and sexes
+    for start,stop in chunks:
+        sexes, ages = _make_ages_sexes(stop-start, age_data, sex_ratio)
+        writer.append('uid', np.arange(start, stop, dtype=np.int64))
+        writer.append('age', ages)
+        writer.append('sex', sexes)
+    writer.flush()
+
+    # Contacts, one layer at a time
+    ages = writer.memmap('age')
+    for key in contact_keys:
+        if key in eligible_ages: # Only people in an age range have these contacts, e.g. school
+            low, high = eligible_ages[key]
+            eligible = np.concatenate([start + sc.findinds((ages[start:stop] >= low) * (ages[start:stop] < high)) for start,stop in chunks])
+        else:
+            eligible = None
+        indptr_name  = f'contacts_{key}_indptr'
+        indices_name = f'contacts_{key}_indices'
+        writer.append(indptr_name, np.zeros(1))
+        n_written = 0
+        for start,stop in chunks:
+            if key in clustered_keys:
+                counts, indices = _make_clustered_chunk(start, stop, contacts[key])
+            else:
+                counts, indices = _make_random_chunk(start, stop, contacts[key], pop_size, eligible)
+            writer.append(indptr_name, n_written + np.cumsum(counts))
+            writer.append(indices_name, indices)
+            n_written += len(indices)
+    del ages
+
+    writer.close(pop_size, contact_keys)
+    return popfile
+
+
+def _make_random_chunk(start, stop, n_contacts, pop_size, eligible=None):
+    ''' Random contacts for people start:stop, optionally only among the eligible people '''
+    n = stop - start
+    rng = cvu.get_rng()
+    counts = np.zeros(n, dtype=np.int64)
+    if eligible is None:
+        counts[:] = rng.poisson(n_contacts, n)
+        indices = rng.randint(pop_size, size=counts.sum())
+    else:
+        these = eligible[np.searchsorted(eligible, start):np.searchsorted(eligible, stop)] - start
+        counts[these] = rng.poisson(n_contacts, len(these))
+        indices = eligible[rng.randint(len(eligible), size=counts.sum())] if len(eligible) else np.zeros(0)
+    return counts, indices
+
+
+def _make_clustered_chunk(start, stop, cluster_size):
+    ''' Clustered contacts (everyone in a cluster is connected) for people start:stop '''
+    n = stop - start
+    sizes = []
+    n_remaining = n
+    while n_remaining > 0: # Draw cluster sizes in batches until the chunk is full
+        batch = cvu.get_rng().poisson(cluster_size, max(1, int(n_remaining/max(cluster_size, 1))+1))
+        batch = batch[batch>0]
+        sizes.extend(batch.tolist())
+        n_remaining -= batch.sum()
+    sizes = np.array(sizes, dtype=np.int64)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), n)+1] # Trim excess clusters...
+    sizes[-1] -= sizes.sum() - n # ...and truncate the final one at the end of the chunk
+    cluster_starts = start + np.cumsum(sizes) - sizes
+    person_sizes  = np.repeat(sizes, sizes) # Size of each person's cluster
+    person_starts = np.repeat(cluster_starts, sizes)
+    people  = np.repeat(np.arange(start, stop), person_sizes) # Each person, repeated once per cluster member
+    offsets = np.arange(len(people)) - np.repeat(np.cumsum(person_sizes) - person_sizes, person_sizes) # Position within the cluster
+    members = np.repeat(person_starts, person_sizes) + offsets
+    indices = members[members != people] # Everyone else in the cluster
+    counts  = person_sizes - 1
+    return counts, indices
+
+
+class _PopdictWriter(object):
+    ''' Write the arrays of a binary population incrementally, then its header '''
+
+    dtypes = {'uid':np.int64, 'age':np.float64, 'sex':np.int64} # Contact arrays are all int64
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.files   = {}
+        self.lengths = {}
+        return
+
+    def path(self, name):
+        return os.path.join(self.folder, f'{name}.bin')
+
+    def append(self, name, arr):
+        dtype = self.dtypes.get(name, np.int64)
+        if name not in self.files:
+            self.files[name] = open(self.path(name), 'wb')
+            self.lengths[name] = 0
+        self.files[name].write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+        self.lengths[name] += len(arr)
+        return
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+        return
+
+    def memmap(self, name):
+        dtype = self.dtypes.get(name, np.int64)
+        return np.memmap(self.path(name), dtype=dtype, mode='r', shape=(self.lengths[name],))
+
+    def close(self, pop_size, contact_keys):
+        for f in self.files.values():
+            f.close()
+        arrayinfo = {}
+        for name,length in self.lengths.items():
+            arrayinfo[name] = {'dtype':np.dtype(self.dtypes.get(name, np.int64)).str, 'shape':[length]}
+        for key in contact_keys: # Layers with no contacts at all
+            arrayinfo.setdefault(f'contacts_{key}_indices', {'dtype':np.dtype(np.int64).str, 'shape':[0]})
+            if arrayinfo[f'contacts_{key}_indices']['shape'] == [0]:
+                open(self.path(f'contacts_{key}_indices'), 'ab').close()
+        return _write_header(self.folder, pop_size, contact_keys, arrayinfo)
+
+
+
+
+def make_synthpop(sim, popfile=None):
+    '''
+    Make a population using synthpops, including contacts.
 
-def make_synthpop(sim):
-    ''' Make a population using synthpops, including contacts '''
+    Args:
+        sim (Sim): the simulation object
+        popfile (str): if supplied, also save the population to this folder in the binary format, and memory-map it
+    '''
     import synthpops as sp # Optional import
     population = sp.make_population(n=sim['pop_size'])
-    uids, ages, sexes, contacts = [], [], [], []
-    for uid,person in population.items():
-        uids.append(uid)
-        ages.append(person['age'])
-        sexes.append(person['sex'])
-
-    # Replace contact UIDs with ints...
-    uid_mapping = {uid:u for u,uid in enumerate(uids)}
-    key_mapping = {'H':'h', 'S':'s', 'W':'w', 'C':'c'} # Remap keys from old names to new names
-    for uid,person in population.items():
-        uid_contacts = person['contacts']
-        int_contacts = {}
-        for key in uid_contacts.keys():
-            new_key = key_mapping[key]
-            int_contacts[new_key] = []
-            for uid in uid_contacts[key]:
-                int_contacts[new_key].append(uid_mapping[uid])
-            int_contacts[new_key] = np.array(int_contacts[new_key], dtype=np.int64)
-        contacts.append(int_contacts)
+    popdict = synthpop_to_popdict(population)
+    if popfile is not None:
+        save_popdict(popfile, popdict)
+        popdict = load_popdict(popfile)
+    return popdict
+
+
+def synthpop_to_popdict(population, key_mapping=None):
+    '''
+    Convert a synthpops population -- a dict of people, keyed by UID, each with
+    an age, a sex, and a dict of contact UIDs per layer -- into a population
+    dictionary. Rather than remapping each contact and appending it to a list one
+    at a time, all of a layer's contact UIDs are mapped in bulk (through a sorted
+    lookup array for numeric UIDs), and each layer is built as a single array of
+    edges, so the contacts are stored as CSRContacts.
+
+    Args:
+        population (dict): the synthpops population
+        key_mapping (dict): how to rename the synthpops layers (default: H, S, W, C to h, s, w, c)
+
+    Returns:
+        popdict (dict): the population dictionary
+    '''
+    if key_mapping is None:
+        key_mapping = {'H':'h', 'S':'s', 'W':'w', 'C':'c'} # Remap keys from old names to new names
+
+    # Extract the people
+    n = len(population)
+    uids = np.array(list(population.keys()))
+    people = list(population.values())
+    ages  = np.fromiter((person['age'] for person in people), dtype=np.float64, count=n)
+    sexes = np.fromiter((person['sex'] for person in people), dtype=np.int64,   count=n)
+
+    # Map UIDs to indices in bulk: via a sorted lookup array for numeric UIDs, else via a single dict (strings' hashes are cached, so this beats comparing them)
+    if uids.dtype.kind in 'iu':
+        order = np.argsort(uids, kind='stable')
+        sorted_uids = uids[order]
+        def uids_to_inds(contact_uids, n_contacts):
+            contact_uids = np.fromiter(contact_uids, dtype=uids.dtype, count=n_contacts)
+            pos = np.searchsorted(sorted_uids, contact_uids)
+            pos[pos == n] = 0 # Out of range, so not found
+            found = sorted_uids[pos] == contact_uids
+            if not found.all():
+                raise KeyError(contact_uids[~found][0])
+            return order[pos]
+    else:
+        uid_mapping = {uid:u for u,uid in enumerate(population.keys())}
+        def uids_to_inds(contact_uids, n_contacts):
+            return np.fromiter(map(uid_mapping.__getitem__, contact_uids), dtype=np.int64, count=n_contacts)
+
+    layers = {}
+    for sp_key,key in key_mapping.items():
+        rows = [person['contacts'].get(sp_key, ()) for person in people]
+        counts = np.fromiter(map(len, rows), dtype=np.int64, count=n)
+        indptr = np.zeros(n+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        try:
+            inds = uids_to_inds(itertools.chain.from_iterable(rows), indptr[-1])
+        except KeyError as E:
+            errormsg = f'Contact {E} in layer "{sp_key}" is not in the population'
+            raise ValueError(errormsg) from E
+        layers[key] = (indptr, inds.astype(np.int64))
 
     popdict = {}
     popdict['uid']      = uids
-    popdict['age']      = np.array(ages)
-    popdict['sex']      = np.array(sexes)
-    popdict['contacts'] = contacts
+    popdict['age']      = ages
+    popdict['sex']      = sexes
+    popdict['contacts'] = CSRContacts(layers, n=n)
     popdict['contact_keys'] = list(key_mapping.values())
     return popdict
+
+
+#%% Compact contact storage and the binary population format
+
+class CSRContacts(object):
+    '''
+    A read-only, list-like store of each person's contacts. Instead of a list of
+    dicts of small arrays, each layer is held as a pair of arrays in compressed
+    sparse row (CSR) format: the contacts of person p in layer key are
+    indices[indptr[p]:indptr[p+1]]. Indexing returns the same dict of arrays as
+    the list representation, but the arrays are views, so they can be backed by
+    memory-mapped files without being read until they're used.
+
+    Args:
+        layers (dict): for each contact key, a tuple of (indptr, indices)
+        n (int): the number of people (default: inferred from the first layer)
+        lazy (bool): if True, each person's dict only looks up a layer when it's first accessed
+
+    Example:
+        contacts = cv.CSRContacts.from_list(sim.popdict['contacts'], sim.contact_keys)
+        household = contacts[0]['h'] # Household contacts of the first person
+    '''
+
+    def __init__(self, layers, n=None, lazy=False):
+        self.lazy = lazy
+        self.layers = {}
+        for key,(indptr,indices) in layers.items():
+            self.layers[key] = (indptr, indices)
+            if n is None:
+                n = len(indptr) - 1
+            if len(indptr) != n + 1:
+                errormsg = f'Layer "{key}" has {len(indptr)-1} rows, but there are {n} people'
+                raise ValueError(errormsg)
+        self.n = int(n) if n is not None else 0
+        return
+
+    @classmethod
+    def from_list(cls, contacts_list, contact_keys=None):
+        ''' Convert a list of dicts of contact arrays (as made by e.g. make_random_contacts()) to CSR format '''
+        if isinstance(contacts_list, cls):
+            return contacts_list
+        n = len(contacts_list)
+        if contact_keys is None:
+            contact_keys = list(contacts_list[0].keys()) if n else []
+        layers = {}
+        for key in contact_keys:
+            rows = [np.asarray(contacts.get(key, []), dtype=np.int64) for contacts in contacts_list]
+            counts = np.fromiter((len(row) for row in rows), dtype=np.int64, count=n)
+            indptr = np.zeros(n+1, dtype=np.int64)
+            indptr[1:] = np.cumsum(counts)
+            indices = np.concatenate(rows) if n else np.zeros(0, dtype=np.int64)
+            layers[key] = (indptr, indices.astype(np.int64, copy=False))
+        return cls(layers, n=n)
+
+    @property
+    def keys(self):
+        ''' The contact keys (layers) stored '''
+        return list(self.layers.keys())
+
+    def layer(self, key):
+        ''' Return the (indptr, indices) arrays of a single layer '''
+        return self.layers[key]
+
+    def find_contacts(self, key, inds):
+        '''
+        Return the contacts in a single layer of all of the given people at once,
+        as one array (with repeats if people share contacts).
+
+        Args:
+            key (str): the contact layer
+            inds (array): the indices of the people whose contacts to find
+        '''
+        indptr, indices = self.layers[key]
+        inds = np.asarray(inds, dtype=np.int64)
+        starts = indptr[inds]
+        return _gather_slices(indices, starts, indptr[inds+1] - starts)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, ind):
+        ''' Return the contacts of a single person, as a dict of arrays '''
+        if ind < 0:
+            ind += self.n
+        if not 0 <= ind < self.n:
+            raise IndexError(f'Person {ind} is out of range for {self.n} people')
+        if self.lazy:
+            return ContactRow(self, ind)
+        contacts = {}
+        for key,(indptr,indices) in self.layers.items():
+            contacts[key] = indices[indptr[ind]:indptr[ind+1]]
+        return contacts
+
+    def __iter__(self):
+        for ind in range(self.n):
+            yield self[ind]
+
+    def __repr__(self):
+        n_contacts = {key:len(indices) for key,(indptr,indices) in self.layers.items()}
+        return f'CSRContacts({self.n} people; contacts per layer: {n_contacts})'
+
+
+
+def _gather_slices(arr, starts, counts):
+    ''' Concatenate the slices arr[start:start+count] for each start and count, without a Python loop '''
+    n = counts.sum()
+    if not n:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) # Map positions in the output to positions in arr
+    return np.asarray(arr[offsets + np.arange(n)], dtype=np.int64)
+
+
+
+class ContactHistory(object):
+    '''
+    A fixed-size record of recent dynamic (e.g. community) contacts, for tracing.
+    Each day's contacts are stored as a pair of edge arrays (sources and targets,
+    sorted by source) in a ring buffer that holds the last window days, so memory
+    use doesn't grow over the course of the simulation.
+
+    Args:
+        window (int): the number of days of contacts to keep
+
+    Example:
+        history = cv.ContactHistory(window=7)
+        history.add(t=0, sources=[0,0,3], targets=[5,8,2])
+        contacts = history.find_contacts([0], t=0) # Returns [5,8]
+    '''
+
+    def __init__(self, window):
+        self.window = max(1, int(window))
+        self.days = np.full(self.window, -1, dtype=np.int64) # Which day each slot holds; -1 for none
+        self.edges = [None]*self.window
+        return
+
+    def add(self, t, sources, targets):
+        ''' Record the contacts made on day t, replacing the oldest day '''
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        if len(sources) and np.any(sources[1:] < sources[:-1]): # Usually already sorted, since people are processed in order
+            order = np.argsort(sources, kind='stable')
+            sources, targets = sources[order], targets[order]
+        slot = t % self.window
+        self.days[slot] = t
+        self.edges[slot] = (sources, targets)
+        return
+
+    def find_contacts(self, inds, t):
+        '''
+        Return the dynamic contacts that the given people made in the window of
+        days up to and including day t, as one array (with repeats).
+        '''
+        inds = np.asarray(inds, dtype=np.int64)
+        found = []
+        for slot,day in enumerate(self.days):
+            if self.edges[slot] is not None and t - self.window < day <= t:
+                sources, targets = self.edges[slot]
+                starts = np.searchsorted(sources, inds, side='left')
+                counts = np.searchsorted(sources, inds, side='right') - starts
+                found.append(_gather_slices(targets, starts, counts))
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def __repr__(self):
+        n_edges = sum(len(edges[0]) for edges in self.edges if edges is not None)
+        return f'ContactHistory({self.window} days; {n_edges} contacts stored)'
+
+
+
+class ContactRow(dict):
+    '''
+    The contacts of a single person from a CSRContacts object, which behaves like
+    a dict but only slices each layer out of the CSR arrays when it's first used.
+    For memory-mapped populations, this means contacts are only read from disk
+    for the people whose contacts are actually needed (e.g. infectious people).
+    '''
+
+    def __init__(self, csr, ind):
+        super().__init__()
+        self._csr = csr
+        self._ind = ind
+        return
+
+    def __missing__(self, key):
+        indptr, indices = self._csr.layers[key] # Raises a KeyError if not a layer
+        value = indices[indptr[self._ind]:indptr[self._ind+1]]
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._csr.layers
+
+    def keys(self):
+        return list(dict.fromkeys(list(self._csr.layers.keys()) + list(dict.keys(self))))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __reduce__(self):
+        ''' Pickle (and copy) as a regular dict, rather than with the entire population '''
+        return (dict, (dict(self.items()),))
+
+# Version of the binary population format written by save_popdict()
+popdict_format = 'covasim-population'
+popdict_version = 1
+
+
+def _popdict_arrays(popdict):
+    ''' Flatten a population dictionary into a dict of named arrays '''
+    contact_keys = list(popdict['contact_keys'])
+    contacts = CSRContacts.from_list(popdict['contacts'], contact_keys)
+    arrays = {}
+    uids = np.asarray(popdict['uid'])
+    arrays['uid'] = uids.astype(np.int64) if uids.dtype.kind in 'iub' else uids.astype(str)
+    arrays['age'] = np.asarray(popdict['age'], dtype=np.float64)
+    arrays['sex'] = np.asarray(popdict['sex'], dtype=np.int64)
+    for key in contacts.keys:
+        indptr, indices = contacts.layer(key)
+        arrays[f'contacts_{key}_indptr']  = np.asarray(indptr,  dtype=np.int64)
+        arrays[f'contacts_{key}_indices'] = np.asarray(indices, dtype=np.int64)
+    return arrays, contacts.keys
+
+
+def _read_header(folder):
+    ''' Load and check the JSON header of a binary population '''
+    with open(os.path.join(folder, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != popdict_format:
+        errormsg = f'Folder "{folder}" does not contain a binary Covasim population'
+        raise ValueError(errormsg)
+    if header['version'] > popdict_version:
+        errormsg = f'Binary population version {header["version"]} is newer than the latest supported version ({popdict_version}); please upgrade Covasim'
+        raise ValueError(errormsg)
+    return header
+
+
+def _write_header(folder, pop_size, contact_keys, arrays):
+    ''' Write the JSON header describing each of the raw arrays '''
+    header = dict(
+        format       = popdict_format,
+        version      = popdict_version,
+        covasim      = cvv.__version__,
+        pop_size     = int(pop_size),
+        contact_keys = list(contact_keys),
+        arrays       = arrays, # Name: {'dtype':dtype, 'shape':shape}
+    )
+    with open(os.path.join(folder, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=2)
+    return header
+
+
+def save_popdict(filename, popdict):
+    '''
+    Save a population dictionary in the versioned binary format: a folder of raw
+    arrays (one file each for uid, age, sex, and the indptr and indices of each
+    contact layer) plus a JSON header describing them. Unlike sc.saveobj(), the
+    result can be memory-mapped by load_popdict().
+
+    Args:
+        filename (str): the folder to save to (created if needed)
+        popdict (dict): the population dictionary, e.g. sim.popdict
+
+    Returns:
+        filename (str): the folder the population was saved to
+    '''
+    arrays, contact_keys = _popdict_arrays(popdict)
+    os.makedirs(filename, exist_ok=True)
+    arrayinfo = {}
+    for name,arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arr.tofile(os.path.join(filename, f'{name}.bin'))
+        arrayinfo[name] = {'dtype':arr.dtype.str, 'shape':list(arr.shape)}
+    _write_header(filename, len(arrays['uid']), contact_keys, arrayinfo)
+    return filename
+
+
+def load_popdict(filename, mmap=True):
+    '''
+    Load a population saved by save_popdict(). By default, the arrays are
+    memory-mapped rather than read, so opening even a very large population is
+    near-instant and processes loading the same population share its pages.
+
+    Args:
+        filename (str): the folder to load from
+        mmap (bool): whether to memory-map the arrays (copy-on-write) instead of reading them into memory
+
+    Returns:
+        popdict (dict): the population dictionary, with contacts stored as CSRContacts, and the folder it was loaded from as popfile
+    '''
+    header = _read_header(filename)
+    arrays = {}
+    for name,info in header['arrays'].items():
+        path  = os.path.join(filename, f'{name}.bin')
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        if mmap and np.prod(shape): # Empty files can't be mapped
+            arrays[name] = np.memmap(path, dtype=dtype, mode='c', shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype).reshape(shape)
+
+    contact_keys = header['contact_keys']
+    layers = {key:(arrays[f'contacts_{key}_indptr'], arrays[f'contacts_{key}_indices']) for key in contact_keys}
+
+    popdict = {}
+    popdict['uid']          = arrays['uid']
+    popdict['age']          = arrays['age']
+    popdict['sex']          = arrays['sex']
+    popdict['contacts']     = CSRContacts(layers, n=header['pop_size'], lazy=mmap)
+    popdict['contact_keys'] = contact_keys
+    popdict['popfile']      = filename # So other processes can load the same population rather than being sent it; see make_job_spec()
+    return popdict
+
+
+def _shared_memory():
+    ''' Import multiprocessing.shared_memory, which is only available from Python 3.8 '''
+    try:
+        from multiprocessing import shared_memory
+    except ImportError as E: # pragma: no cover
+        errormsg = 'Sharing a population between processes requires Python 3.8 or later; use share_population=False instead'
+        raise NotImplementedError(errormsg) from E
+    return shared_memory
+
+
+class SharedPopulation(object):
+    '''
+    A handle to a population whose arrays (uid, age, sex, and the CSR arrays of
+    each contact layer) are stored once in shared memory. Pickling the handle only
+    transfers the names of the shared memory blocks, so passing it to worker
+    processes is cheap; workers attach to the same memory without copying and only
+    allocate their own people (i.e. the mutable per-person state).
+
+    The process that creates the handle owns the memory, and must call unlink()
+    (or use the handle as a context manager) once the workers are finished. The
+    arrays must be treated as read-only. Requires Python 3.8 or later.
+
+    Args:
+        popdict (dict): the population dictionary to share, e.g. sim.popdict
+
+    Example:
+        with cv.SharedPopulation(sim.popdict) as population:
+            sims = cv.multi_run(sim, population=population)
+    '''
+
+    def __init__(self, popdict):
+        arrays, contact_keys = _popdict_arrays(popdict)
+        self.pop_size     = len(arrays['uid'])
+        self.contact_keys = contact_keys
+        self.specs        = {} # Name of each array: (shared memory name, dtype, shape)
+        self._blocks      = {} # The SharedMemory objects, for attaching and cleanup
+        self._popdict     = None
+        self._owner       = True
+        for name,arr in arrays.items():
+            block = _shared_memory().SharedMemory(create=True, size=max(arr.nbytes, 1)) # Zero-size blocks aren't allowed
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[:] = arr
+            self._blocks[name] = block
+            self.specs[name] = (block.name, arr.dtype.str, arr.shape)
+        return
+
+    def __getstate__(self):
+        ''' Only send the names of the blocks, not the data '''
+        return {'pop_size':self.pop_size, 'contact_keys':self.contact_keys, 'specs':self.specs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks  = {}
+        self._popdict = None
+        self._owner   = False
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+        return
+
+    def __repr__(self):
+        nbytes = sum(np.prod(shape)*np.dtype(dtype).itemsize for _,dtype,shape in self.specs.values())
+        return f'SharedPopulation({self.pop_size} people, {nbytes/1e6:0.1f} MB in {len(self.specs)} shared arrays)'
+
+    def _attach(self, name):
+        ''' Attach to an existing block without registering it for cleanup by this process '''
+        block = _shared_memory().SharedMemory(name=name)
+        if mp.get_start_method() != 'fork': # Forked workers share the owner's resource tracker; otherwise, it would unlink the memory when the worker exits
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(block._name, 'shared_memory')
+            except Exception: # pragma: no cover
+                pass
+        return block
+
+    def to_popdict(self):
+        ''' Return a population dictionary whose arrays are views of the shared memory '''
+        if self._popdict is None:
+            arrays = {}
+            for name,(blockname,dtype,shape) in self.specs.items():
+                if name not in self._blocks:
+                    self._blocks[name] = self._attach(blockname)
+                arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self._blocks[name].buf)
+            layers = {key:(arrays[f'contacts_{key}_indptr'], arrays[f'contacts_{key}_indices']) for key in self.contact_keys}
+            self._popdict = {
+                'uid':          arrays['uid'],
+                'age':          arrays['age'],
+                'sex':          arrays['sex'],
+                'contacts':     CSRContacts(layers, n=self.pop_size),
+                'contact_keys': list(self.contact_keys),
+            }
+        return self._popdict
+
+    def close(self):
+        ''' Detach this process from the shared memory; arrays from to_popdict() must no longer be in use '''
+        self._popdict = None
+        for block in self._blocks.values():
+            try:
+                block.close()
+            except BufferError: # Views of the memory are still alive; they'll be released when garbage-collected
+                pass
+        self._blocks = {}
+        return
+
+    def unlink(self):
+        ''' Free the shared memory; only the process that created the population can do this '''
+        if self._owner:
+            blocks = self._blocks
+            self.close()
+            for block in blocks.values():
+                try:
+                    block.unlink()
+                except FileNotFoundError: # Already freed
+                    pass
+            self._owner = False
+        return
@@ -3,19 +3,22 @@ Functions for running multiple Covasim runs.
 '''
 
 #%% Imports
+import pickle
 import numpy as np
-import pylab as pl
-import pandas as pd
 import sciris as sc
 import datetime as dt
-import matplotlib.ticker as ticker
 from . import defaults as cvd
 from . import base as cvbase
+from . import parameters as cvpars
 from . import sim as cvsim
+from . import population as cvpop
+from . import utils as cvu
+from . import executors as cvex
+from . import ensemble as cvens
 
 
 # Specify all externally visible functions this file defines
-__all__ = ['make_metapars', 'Scenarios', 'single_run', 'multi_run']
+__all__ = ['make_metapars', 'Scenarios', 'QuantileSketch', 'ReplicateStats', 'estimate_cost', 'estimate_memory', 'plan_workers', 'make_job_spec', 'sim_from_spec', 'single_run', 'multi_run', 'Runner']
 
 
 
@@ -27,6 +30,10 @@ def make_metapars():
         noisepar  = 'beta',
         rand_seed = 1,
         quantiles = {'low':0.1, 'high':0.9},
+        max_runs  = None, # If set, keep running batches of n_runs more runs of each scenario until its results converge, up to this many runs
+        rtol      = 0.05, # Convergence tolerance: the largest change in the best, low, or high values from one batch to the next, relative to the largest high value
+        conv_keys = ['cum_infections'], # The results to check for convergence
+        crn       = False, # Use common random numbers, so run i of each scenario is matched (see the sim's crn parameter); this makes the differences between scenarios much less noisy
         verbose   = 1,
     )
     return metapars
@@ -95,14 +102,31 @@ class Scenarios(cvbase.ParsObj):
         return
 
 
-    def run(self, debug=False, verbose=None, **kwargs):
+    def run(self, debug=False, keep_sims=True, executor=None, ncpus=None, memory_budget=None, ensemble=False, verbose=None, **kwargs):
         '''
-        Run the actual scenarios
+        Run the actual scenarios.
+
+        All the runs of all the scenarios are sent to a single executor (by default,
+        a pool of worker processes), longest first, so workers aren't left idle
+        waiting for the last runs of each scenario to finish before the next
+        scenario is started.
+
+        If the max_runs metaparameter is set, the runs are done in batches of n_runs
+        runs of each scenario, and each scenario gets more batches until its results
+        (the best, low, and high values of each result in conv_keys) change by less
+        than rtol from one batch to the next, or it reaches max_runs runs. This way,
+        scenarios with more variable results get more runs. The number of runs of each
+        scenario is stored in scens.n_runs_used.
 
         Args:
             debug (bool): if True, runs a single run instead of multiple, which makes debugging easier
+            keep_sims (bool): if False, the workers only send back their results, which are summarized as they arrive (see ReplicateStats), so the sims are never stored; this uses much less memory for large numbers of runs, but the quantiles are only approximate for more than 128 runs
+            executor (Executor): the executor to run the sims with, e.g. a SocketExecutor to use other machines (default: a new ProcessExecutor)
+            ncpus (int): the maximum number of worker processes, if no executor is supplied (default: the number of CPUs)
+            memory_budget (float): the memory the worker processes can use, in bytes, if no executor is supplied; the number of workers is reduced to fit (see plan_workers())
+            ensemble (bool): if True, run all the runs of each scenario at once as a single vectorized Ensemble, in this process; much faster, but only for scenarios without interventions, and no sims are kept
             verbose (int): level of detail to print, passed to sim.run()
-            kwargs (dict): passed to multi_run() and thence to sim.run()
+            kwargs (dict): passed to single_run() and thence to sim.run(); if they include arguments only used by multi_run() (e.g. share_population), each scenario is run with multi_run() in turn instead
 
         Returns:
             None (modifies Scenarios object in place)
@@ -121,9 +145,9 @@ class Scenarios(cvbase.ParsObj):
 
         reskeys = self.reskeys # Shorten since used extensively
 
-        # Loop over scenarios
+        # Create the simulations for each scenario
+        scen_sims = sc.objdict()
         for scenkey,scen in self.scenarios.items():
-            scenname = scen['name']
             scenpars = scen['pars']
 
             # This is necessary for plotting, and since self.npts is defined prior to run
@@ -131,43 +155,59 @@ class Scenarios(cvbase.ParsObj):
                 errormsg = 'Scenarios cannot be run with different numbers of days; set via basepars instead'
                 raise ValueError(errormsg)
 
-            # Create and run the simulations
-
-            print_heading(f'Multirun for {scenkey}')
-            scen_sim = sc.dcp(self.base_sim)
-            scen_sim.update_pars(scenpars)
-            run_args = dict(n_runs=self['n_runs'], noise=self['noise'], noisepar=self['noisepar'], verbose=verbose)
-            if debug:
-                print('Running in debug mode (not parallelized)')
-                run_args.pop('n_runs', None) # Remove n_runs argument, not used for a single run
-                scen_sims = [single_run(scen_sim, **run_args, **kwargs)]
-            else:
-                scen_sims = multi_run(scen_sim, **run_args, **kwargs) # This is where the sims actually get run
+            scen_sims[scenkey] = sc.dcp(self.base_sim)
+            scen_sims[scenkey].update_pars(scenpars)
+            if self['crn']:
+                scen_sims[scenkey]['crn'] = True
+
+        # Run the simulations
+        run_args = dict(noise=self['noise'], noisepar=self['noisepar'], verbose=verbose)
+        outputs = sc.objdict() # Either a list of sims or a ReplicateStats object for each scenario
+        multi_kwargs = set(kwargs) & {'iterpars', 'combine', 'share_population'} # Options that only multi_run() supports
+        if self['max_runs'] and (ensemble or multi_kwargs):
+            errormsg = f'Scenarios with max_runs cannot be run with {"ensemble=True" if ensemble else ", ".join(multi_kwargs)}'
+            raise ValueError(errormsg)
+        if debug:
+            print('Running in debug mode (not parallelized)')
+            for scenkey,scen_sim in scen_sims.items():
+                print_heading(f'Running {scenkey}')
+                outputs[scenkey] = [single_run(scen_sim, **run_args, **kwargs)]
+        elif ensemble:
+            for scenkey,scen_sim in scen_sims.items():
+                print_heading(f'Running {scenkey} as an ensemble')
+                outputs[scenkey] = cvens.Ensemble(scen_sim, n_runs=self['n_runs'], noise=self['noise'], noisepar=self['noisepar'], verbose=verbose)
+                outputs[scenkey].run()
+        elif multi_kwargs:
+            for scenkey,scen_sim in scen_sims.items():
+                print_heading(f'Multirun for {scenkey}')
+                outputs[scenkey] = multi_run(scen_sim, n_runs=self['n_runs'], reduce=not keep_sims, executor=executor, **run_args, **kwargs)
+        elif self['max_runs']:
+            outputs = self._run_adaptive(scen_sims, keep_sims=keep_sims, executor=executor, ncpus=ncpus, memory_budget=memory_budget, print_heading=print_heading, **run_args, **kwargs)
+        else:
+            print_heading(f'Running {len(scen_sims)} scenarios with {self["n_runs"]} runs each')
+            outputs = _run_scenarios(scen_sims, n_runs=self['n_runs'], keep_sims=keep_sims, executor=executor, ncpus=ncpus, memory_budget=memory_budget, **run_args, **kwargs)
 
-            # Process the simulations
+        # Process the simulations
+        self.n_runs_used = sc.objdict()
+        for scenkey,output in outputs.items():
             print_heading(f'Processing {scenkey}')
 
-            scenraw = {}
-            for reskey in reskeys:
-                scenraw[reskey] = pl.zeros((self.npts, len(scen_sims)))
-                for s,sim in enumerate(scen_sims):
-                    scenraw[reskey][:,s] = sim.results[reskey].values
-
-            scenres = sc.objdict()
-            scenres.best = {}
-            scenres.low = {}
-            scenres.high = {}
-            for reskey in reskeys:
-                scenres.best[reskey] = pl.mean(scenraw[reskey], axis=1) # Changed from median to mean for smoother plots
-                scenres.low[reskey]  = pl.quantile(scenraw[reskey], q=self['quantiles']['low'], axis=1)
-                scenres.high[reskey] = pl.quantile(scenraw[reskey], q=self['quantiles']['high'], axis=1)
+            scenres = self._summarize(output, reskeys)
+            if isinstance(output, ReplicateStats):
+                self.n_runs_used[scenkey] = output.n
+                output = []
+            elif isinstance(output, cvens.Ensemble):
+                self.n_runs_used[scenkey] = output.n_runs
+                output = []
+            else:
+                self.n_runs_used[scenkey] = len(output)
 
             for reskey in reskeys:
-                self.results[reskey][scenkey]['name'] = scenname
+                self.results[reskey][scenkey]['name'] = self.scenarios[scenkey]['name']
                 for blh in ['best', 'low', 'high']:
                     self.results[reskey][scenkey][blh] = scenres[blh][reskey]
 
-            self.sims[scenkey] = scen_sims
+            self.sims[scenkey] = output
 
         #%% Print statistics
         if verbose:
@@ -181,6 +221,78 @@ class Scenarios(cvbase.ParsObj):
         return
 
 
+    def _summarize(self, output, reskeys):
+        '''
+        Compute the best (mean), low, and high values of each result over the runs of
+        a scenario, from a list of sims, a ReplicateStats object, or an Ensemble.
+        '''
+        scenres = sc.objdict()
+        scenres.best = {}
+        scenres.low = {}
+        scenres.high = {}
+        if isinstance(output, ReplicateStats):
+            for reskey in reskeys:
+                scenres.best[reskey] = output.mean(reskey)
+                scenres.low[reskey]  = output.quantile(reskey, q=self['quantiles']['low'])
+                scenres.high[reskey] = output.quantile(reskey, q=self['quantiles']['high'])
+        else:
+            scenraw = {}
+            if isinstance(output, cvens.Ensemble): # The results of all runs are already together
+                for reskey in reskeys:
+                    scenraw[reskey] = output.results[reskey].values
+            else:
+                for reskey in reskeys:
+                    scenraw[reskey] = np.zeros((self.npts, len(output)))
+                    for s,sim in enumerate(output):
+                        scenraw[reskey][:,s] = sim.results[reskey].values
+
+            for reskey in reskeys:
+                scenres.best[reskey] = np.mean(scenraw[reskey], axis=1) # Changed from median to mean for smoother plots
+                scenres.low[reskey]  = np.quantile(scenraw[reskey], q=self['quantiles']['low'], axis=1)
+                scenres.high[reskey] = np.quantile(scenraw[reskey], q=self['quantiles']['high'], axis=1)
+        return scenres
+
+
+    def _run_adaptive(self, scen_sims, keep_sims=True, executor=None, ncpus=None, memory_budget=None, print_heading=print, **kwargs):
+        '''
+        Run batches of n_runs runs of the scenarios that haven't converged yet, until
+        all have converged or reached max_runs runs; see run(). All the batches are
+        run with the same executor, so worker processes are only started once.
+        '''
+        batch     = self['n_runs']
+        max_runs  = self['max_runs']
+        conv_keys = sc.promotetolist(self['conv_keys'])
+        running   = sc.objdict(scen_sims) # The scenarios that are still being run
+        outputs   = sc.objdict()
+        previous  = {} # The summary of each scenario after the previous batch
+
+        own_executor = executor is None
+        if own_executor:
+            largest = max(scen_sims.values(), key=estimate_cost)
+            keep_people = keep_sims and kwargs.get('keep_people', False)
+            ncpus = plan_workers(largest, n_runs=batch*len(scen_sims), keep_people=keep_people, memory_budget=memory_budget, ncpus=ncpus, verbose=kwargs.get('verbose', 0) >= 2)
+            executor = cvex.ProcessExecutor(ncpus=ncpus)
+        try:
+            n_done = 0
+            while running:
+                n_runs = min(batch, max_runs - n_done)
+                print_heading(f'Running {len(running)} scenarios with runs {n_done+1}-{n_done+n_runs}')
+                _run_scenarios(running, n_runs=n_runs, start=n_done, outputs=outputs, keep_sims=keep_sims, executor=executor, **kwargs)
+                n_done += n_runs
+                for scenkey in list(running.keys()):
+                    scenres = self._summarize(outputs[scenkey], conv_keys)
+                    converged = scenkey in previous and _converged(previous[scenkey], scenres, self['rtol'])
+                    previous[scenkey] = scenres
+                    if converged or n_done >= max_runs:
+                        print_heading(f'Finished {scenkey} after {n_done} runs ({"converged" if converged else "not converged"})')
+                        running.pop(scenkey)
+        finally:
+            if own_executor:
+                executor.close()
+
+        return outputs
+
+
     def plot(self, to_plot=None, do_save=None, fig_path=None, fig_args=None, plot_args=None,
              axis_args=None, fill_args=None, legend_args=None, as_dates=True, dateformat=None,
              interval=None, n_cols=1, font_size=18, font_family=None, grid=True, commaticks=True,
@@ -228,6 +340,8 @@ class Scenarios(cvbase.ParsObj):
         fill_args   = sc.mergedicts({'alpha': 0.2}, fill_args)
         legend_args = sc.mergedicts({'loc': 'best'}, legend_args)
 
+        import pylab as pl # Plotting libraries are only imported when needed
+        import matplotlib.ticker as ticker
         if sep_figs:
             figs = []
         else:
@@ -263,7 +377,7 @@ class Scenarios(cvbase.ParsObj):
                 # Optionally reset tick marks (useful for e.g. plotting weeks/months)
                 if interval:
                     xmin,xmax = ax.get_xlim()
-                    ax.set_xticks(pl.arange(xmin, xmax+1, interval))
+                    ax.set_xticks(np.arange(xmin, xmax+1, interval))
 
                 # Set xticks as dates
                 if as_dates:
@@ -327,6 +441,7 @@ class Scenarios(cvbase.ParsObj):
             An sc.Spreadsheet with an Excel file, or writes the file to disk
 
         """
+        import pandas as pd # Only needed for exporting
         spreadsheet = sc.Spreadsheet()
         spreadsheet.freshbytes()
         with pd.ExcelWriter(spreadsheet.bytes, engine='xlsxwriter') as writer:
@@ -409,7 +524,181 @@ class Scenarios(cvbase.ParsObj):
 
 
 
-def single_run(sim, ind=0, noise=0.0, noisepar=None, verbose=None, keep_people=False, run_args=None, sim_args=None, **kwargs):
+class QuantileSketch(sc.prettyobj):
+    '''
+    A mergeable summary of the distribution of a time series across replicates, for
+    estimating quantiles at each time point without storing every replicate.
+
+    Values are stored exactly until there are more than "capacity" of them, so the
+    quantiles match np.quantile() for small numbers of replicates. After that, each
+    full level is compacted by sorting the values at each time point and keeping
+    every other one, with twice the weight (as in the KLL sketch), so memory only
+    grows with the logarithm of the number of replicates.
+
+    Args:
+        npts (int): the number of time points
+        capacity (int): the number of values to store at each level before compacting
+
+    **Example**::
+
+        sketch = cv.QuantileSketch(npts=sim.npts)
+        for sim in sims:
+            sketch.add(sim.results['cum_infections'].values)
+        low = sketch.quantile(0.1)
+    '''
+
+    def __init__(self, npts, capacity=128):
+        self.npts     = npts
+        self.capacity = int(capacity)
+        self.n        = 0  # Number of time series added
+        self.levels   = [] # Level i is a list of (npts, m) arrays, with weight 2**i per value
+        self.offsets  = [] # Alternate which half is kept at each level, to avoid bias
+        return
+
+
+    def _size(self, level):
+        return sum(arr.shape[1] for arr in self.levels[level])
+
+
+    def _compact(self):
+        ''' Compact any levels that are over capacity '''
+        level = 0
+        while level < len(self.levels):
+            if self._size(level) > self.capacity:
+                values = np.sort(np.concatenate(self.levels[level], axis=1), axis=1)
+                if values.shape[1] % 2: # Keep an odd one out at this level
+                    self.levels[level] = [values[:, -1:]]
+                    values = values[:, :-1]
+                else:
+                    self.levels[level] = []
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                    self.offsets.append(0)
+                self.levels[level+1].append(values[:, self.offsets[level]::2])
+                self.offsets[level] = 1 - self.offsets[level]
+            level += 1
+        return
+
+
+    def add(self, values):
+        ''' Add a single time series '''
+        values = np.asarray(values, dtype=np.float64).reshape(self.npts, 1)
+        if not self.levels:
+            self.levels.append([])
+            self.offsets.append(0)
+        self.levels[0].append(values)
+        self.n += 1
+        self._compact()
+        return
+
+
+    def merge(self, other):
+        ''' Merge in another sketch, e.g. one built by a different process '''
+        if other.npts != self.npts:
+            raise ValueError(f'Cannot merge sketches with {other.npts} and {self.npts} time points')
+        for level,arrs in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append([])
+                self.offsets.append(0)
+            self.levels[level].extend(arrs)
+        self.n += other.n
+        self._compact()
+        return
+
+
+    def quantile(self, q):
+        ''' Estimate the q-th quantile at each time point '''
+        if not self.n:
+            raise ValueError('Cannot calculate quantiles of an empty sketch')
+        if len(self.levels) == 1: # Nothing has been compacted, so this is exact
+            return np.quantile(np.concatenate(self.levels[0], axis=1), q=q, axis=1)
+
+        # Otherwise, interpolate between the weighted values at each time point
+        values  = np.concatenate([arr for arrs in self.levels for arr in arrs], axis=1)
+        weights = np.concatenate([np.full(arr.shape[1], 2.0**level) for level,arrs in enumerate(self.levels) for arr in arrs])
+        output = np.empty(self.npts)
+        for t in range(self.npts):
+            order = np.argsort(values[t])
+            cumweights = np.cumsum(weights[order]) - weights[order]/2 # The midpoint of each value's weight
+            output[t] = np.interp(q*weights.sum(), cumweights, values[t, order])
+        return output
+
+
+
+class ReplicateStats(sc.prettyobj):
+    '''
+    Summary statistics of the results of many replicate runs, computed as each
+    run's results arrive, so the runs themselves don't need to be kept. The mean and
+    variance are updated with Welford's algorithm, and quantiles are estimated with
+    a QuantileSketch for each result. Statistics computed in different processes can
+    be combined with merge().
+
+    Args:
+        reskeys (list): the keys of the results to summarize
+        npts (int): the number of time points
+        capacity (int): passed to QuantileSketch()
+
+    **Example**::
+
+        stats = cv.multi_run(sim, n_runs=100, reduce=True)
+        best = stats.mean('cum_infections')
+        low  = stats.quantile('cum_infections', q=0.1)
+    '''
+
+    def __init__(self, reskeys, npts, capacity=128):
+        self.reskeys  = list(reskeys)
+        self.npts     = npts
+        self.n        = 0
+        self._mean    = {key:np.zeros(npts) for key in self.reskeys}
+        self._m2      = {key:np.zeros(npts) for key in self.reskeys} # Sum of squared differences from the mean
+        self.sketches = {key:QuantileSketch(npts, capacity=capacity) for key in self.reskeys}
+        return
+
+
+    def add(self, results):
+        ''' Add the results of one run, as a dict of arrays (or Result objects) '''
+        self.n += 1
+        for key in self.reskeys:
+            values = np.asarray(results[key], dtype=np.float64)
+            delta = values - self._mean[key]
+            self._mean[key] += delta/self.n
+            self._m2[key] += delta*(values - self._mean[key])
+            self.sketches[key].add(values)
+        return
+
+
+    def merge(self, other):
+        ''' Merge in the statistics of another set of runs '''
+        n = self.n + other.n
+        for key in self.reskeys:
+            if n:
+                delta = other._mean[key] - self._mean[key]
+                self._mean[key] += delta*other.n/n
+                self._m2[key] += other._m2[key] + delta**2*self.n*other.n/n
+            self.sketches[key].merge(other.sketches[key])
+        self.n = n
+        return
+
+
+    def mean(self, key):
+        return self._mean[key].copy()
+
+
+    def var(self, key):
+        ''' The sample variance (i.e. with n-1 degrees of freedom) '''
+        return self._m2[key]/(self.n - 1) if self.n > 1 else np.full(self.npts, np.nan)
+
+
+    def std(self, key):
+        return np.sqrt(self.var(key))
+
+
+    def quantile(self, key, q):
+        return self.sketches[key].quantile(q)
+
+
+
+def single_run(sim, ind=0, noise=0.0, noisepar=None, verbose=None, keep_people=False, run_args=None, sim_args=None, population=None, executor=None, **kwargs):
     '''
     Convenience function to perform a single simulation run. Mostly used for
     parallelization, but can also be used directly.
@@ -422,6 +711,8 @@ def single_run(sim, ind=0, noise=0.0, noisepar=None, verbose=None, keep_people=F
         verbose (int): detail to print
         run_args (dict): arguments passed to sim.run()
         sim_args (dict): extra parameters to pass to the sim, e.g. 'n_infected'
+        population (SharedPopulation): if supplied, use this population (and create the people from it) instead of the sim's own
+        executor (Executor): if supplied, run the sim with this executor, e.g. on a remote worker
         kwargs (dict): also passed to the sim
 
     Returns:
@@ -433,7 +724,18 @@ def single_run(sim, ind=0, noise=0.0, noisepar=None, verbose=None, keep_people=F
         sim = cv.single_run(sim) # Run it, equivalent(ish) to sim.run()
     '''
 
-    new_sim = sc.dcp(sim) # Copy the sim to avoid overwriting it
+    if executor is not None:
+        taskkwargs = dict(spec=make_job_spec(sim, population=population), ind=ind, noise=noise, noisepar=noisepar, verbose=verbose, keep_people=keep_people, run_args=run_args, sim_args=sim_args, **kwargs)
+        return executor.map(_run_single, [taskkwargs])[0]
+
+    new_sim = sc.dcp(sim.shrink(skip_attrs=['popdict'], in_place=False)) # Copy the sim to avoid overwriting it...
+    new_sim.popdict = sim.popdict # ...except for the population, which isn't modified, so can be shared (e.g. between threads)
+
+    # Use the shared population, if supplied; the people are created from it when the sim is initialized
+    if population is not None:
+        new_sim.popdict = population.to_popdict()
+        new_sim.people = []
+        new_sim.initialized = False
 
     # Set sim and run arguments
     if verbose is None:
@@ -451,7 +753,7 @@ def single_run(sim, ind=0, noise=0.0, noisepar=None, verbose=None, keep_people=F
             raise KeyError(f'Noise parameter {noisepar} was not found in sim parameters')
 
     # Handle noise -- normally distributed fractional error
-    noiseval = noise*np.random.normal()
+    noiseval = noise*cvu.get_rng().normal()
     if noiseval > 0:
         noisefactor = 1 + noiseval
     else:
@@ -481,9 +783,306 @@ def single_run(sim, ind=0, noise=0.0, noisepar=None, verbose=None, keep_people=F
     return new_sim
 
 
-def multi_run(sim, n_runs=4, noise=0.0, noisepar=None, iterpars=None, verbose=None, combine=False, keep_people=None, run_args=None, sim_args=None, **kwargs):
+def make_job_spec(sim, population=None):
+    '''
+    Describe a sim compactly, for sending to worker processes instead of the sim
+    itself (which, once initialized, includes every person): the parameters that
+    differ from their defaults, the data, and a reference to the population. The
+    workers rebuild the sim with sim_from_spec(), and create the people themselves.
+
+    The population is referenced, so the size of the spec doesn't depend on the
+    population size, if it's in shared memory (a SharedPopulation) or was loaded
+    from a binary population folder (see Sim.save_population()), which the
+    workers load themselves. Otherwise, if the sim has a population, it's included
+    in the spec; if not, the workers create it, as the sim would. multi_run() and
+    Scenarios place a population the sim already has in shared memory, if the runs
+    are sent to worker processes on this machine.
+
+    Args:
+        sim (Sim): the sim to describe
+        population (SharedPopulation): if supplied, use this population rather than the sim's own
+
+    Returns:
+        spec (objdict): the parameters, data, and population of the sim
+
+    **Example**::
+
+        spec = cv.make_job_spec(sim)
+        new_sim = cv.sim_from_spec(spec) # E.g. in a worker process
+    '''
+    defaults = cvpars.make_pars()
+    pars = {}
+    for key,val in sim.pars.items():
+        if key not in defaults or pickle.dumps(val) != pickle.dumps(defaults[key]): # Compare pickles, since values can be arrays, dicts of arrays, or interventions
+            pars[key] = val
+    if population is None and sim.popdict:
+        popfile = sim.popdict.get('popfile') if isinstance(sim.popdict, dict) else None
+        population = popfile if popfile is not None else sim.popdict
+    spec = sc.objdict(pars=pars, data=sim.data, population=population)
+    return spec
+
+
+def sim_from_spec(spec):
+    '''
+    Rebuild a sim, not yet initialized, from a spec made by make_job_spec().
+
+    Args:
+        spec (dict): the spec of the sim
+
+    Returns:
+        sim (Sim): the new sim
+    '''
+    sim = cvsim.Sim()
+    sim.pars.update(spec['pars']) # Update directly, since e.g. setting use_layers via update_pars() would reset the contacts
+    sim.data = spec['data']
+    population = spec['population']
+    if isinstance(population, cvpop.SharedPopulation):
+        sim.popdict = population.to_popdict()
+    elif sc.isstring(population):
+        sim.load_population(population)
+    else:
+        sim.popdict = population
+    return sim
+
+
+def estimate_cost(sim):
+    ''' Estimate the relative time a sim will take to run, for scheduling the longest runs first '''
+    contacts = sim['contacts']
+    n_contacts = sum(contacts.values()) if isinstance(contacts, dict) else contacts
+    return sim['pop_size']*(1 + n_contacts)*sim.npts
+
+
+# Approximate memory use, for estimate_memory(); measured with Python 3.11
+person_bytes  = 2500  # Memory per person, excluding contacts
+contact_bytes = 20    # Memory per contact
+worker_bytes  = 250e6 # Memory per worker process, excluding people
+n_results     = 30    # Approximate number of results arrays
+
+def estimate_memory(sim, keep_people=False):
+    '''
+    Roughly estimate the memory (in bytes) needed to run a sim in a worker process.
+    Each person takes about 2.5 kB, plus about 20 bytes per contact, and each worker
+    also needs about 250 MB for Python and the libraries Covasim uses.
+
+    Args:
+        sim (Sim): the sim to estimate the memory for
+        keep_people (bool): if True, also count the memory needed to keep the people in the sim that's returned
+
+    Returns:
+        A dict with the memory needed for the worker and for the people, and in total
+    '''
+    contacts = sim['contacts']
+    n_contacts = sum(contacts.values()) if isinstance(contacts, dict) else contacts
+    people  = sim['pop_size']*(person_bytes + contact_bytes*n_contacts)
+    results = sim.npts*n_results*8 # The results arrays are float64
+    memory = sc.objdict()
+    memory.worker = worker_bytes + people + results
+    memory.kept   = people if keep_people else 0 # The people sent back, and kept, by the main process
+    return memory
+
+
+def plan_workers(sim, n_runs, keep_people=False, memory_budget=None, ncpus=None, verbose=0):
+    '''
+    Choose how many worker processes to use so the runs fit in memory. Each worker
+    needs estimate_memory(sim) while it's running, and if the people are kept, the
+    main process also needs to store the people for every run.
+
+    Args:
+        sim (Sim): the sim (or the largest sim) to be run
+        n_runs (int): the number of runs
+        keep_people (bool): whether the people of each run will be kept
+        memory_budget (float): the memory to use, in bytes (default: 80% of the memory currently available)
+        ncpus (int): the maximum number of workers (default: the number of CPUs)
+        verbose (int): whether to print the decision
+
+    Returns:
+        n_workers (int): the number of worker processes to use
+    '''
+    import psutil # Installed with Sciris
+    if memory_budget is None:
+        memory_budget = 0.8*psutil.virtual_memory().available
+    if ncpus is None:
+        ncpus = psutil.cpu_count()
+    memory = estimate_memory(sim, keep_people=keep_people)
+    available = memory_budget - n_runs*memory.kept
+    n_workers = int(min(ncpus, n_runs, max(1, available//memory.worker)))
+    if verbose or available < memory.worker:
+        string = f'Using {n_workers} workers for {n_runs} runs: {memory.worker/1e9:0.2f} GB each with a budget of {memory_budget/1e9:0.2f} GB'
+        if memory.kept:
+            string += f', of which {n_runs*memory.kept/1e9:0.2f} GB is for keeping the people'
+        if available < memory.worker:
+            string += '; this may run out of memory'
+        print(string)
+    return n_workers
+
+
+def _run_scenario_task(task, shared):
+    ''' Run one run of one scenario, for _run_scenarios() '''
+    scenkey, ind = task
+    sim = single_run(sim_from_spec(shared['specs'][scenkey]), ind=ind, **shared['kwargs'])
+    if shared['keep_sims']:
+        output = sim
+    else:
+        output = {key:sim.results[key].values for key in sim.reskeys}
+    return scenkey, ind, output
+
+
+def _converged(old, new, rtol):
+    ''' Check whether the best, low, and high values of each result changed by less than rtol, relative to the largest high value '''
+    for reskey in new.best.keys():
+        scale = np.max(np.abs(new.high[reskey]))
+        change = max(np.max(np.abs(new[blh][reskey] - old[blh][reskey])) for blh in ['best', 'low', 'high'])
+        if change > rtol*scale:
+            return False
+    return True
+
+
+def _share_population(sim, executor=None):
+    '''
+    Place the population of a sim in shared memory (see SharedPopulation), if it
+    has one in memory and the runs are sent to worker processes on this machine,
+    so that it isn't included in the spec of the sim (see make_job_spec()), and
+    copied to the workers with every batch.
+
+    Args:
+        sim (Sim): the sim to be run
+        executor (Executor): the executor the sim will be run with (default: a new ProcessExecutor)
+
+    Returns:
+        population (SharedPopulation): the shared population, which the caller must unlink(); or None if the population isn't shared
+    '''
+    popdict = sim.popdict
+    if not popdict or (isinstance(popdict, dict) and popdict.get('popfile') is not None):
+        return None # No population, or the workers load it from the binary population folder
+    if isinstance(executor, cvex.SocketExecutor):
+        print('Warning: the population of the sim is sent to the workers with every batch; to avoid this, save it with sim.save_population(binary=True) to a folder the workers can read, and load it with sim.load_population()')
+        return None
+    if executor is not None and not isinstance(executor, cvex.ProcessExecutor):
+        return None # E.g. threads, which use the population as is
+    try:
+        return cvpop.SharedPopulation(popdict)
+    except NotImplementedError: # Python 3.7, so it's included in the spec instead
+        return None
+
+
+def _run_scenarios(scen_sims, n_runs, keep_sims=True, executor=None, ncpus=None, memory_budget=None, start=0, outputs=None, **kwargs):
     '''
-    For running multiple runs in parallel.
+    Run n_runs runs of each of the supplied sims with a single executor (by
+    default, a pool of worker processes), starting with the most expensive runs.
+    The results are routed back to their scenario and added in order of run, so
+    they don't depend on which worker finishes first.
+
+    Args:
+        scen_sims (dict): the sim for each scenario
+        n_runs (int): the number of runs of each scenario
+        keep_sims (bool): whether to return the sims, or only a ReplicateStats object for each scenario
+        executor (Executor): the executor to run the sims with (default: a new ProcessExecutor)
+        ncpus (int): the maximum number of worker processes, if a new executor is created (default: the number of CPUs)
+        memory_budget (float): the memory the worker processes can use, if a new executor is created; see plan_workers()
+        start (int): the index of the first run, e.g. to add more runs to the outputs of an earlier call
+        outputs (objdict): if supplied, add the runs to these outputs from an earlier call
+        kwargs (dict): passed to single_run()
+
+    Returns:
+        outputs (objdict): a list of sims, or a ReplicateStats object, for each scenario
+    '''
+    if not keep_sims:
+        kwargs['keep_people'] = False
+    tasks = [(scenkey, ind) for scenkey in scen_sims.keys() for ind in range(start, start+n_runs)]
+    costs = {scenkey:estimate_cost(scen_sim) for scenkey,scen_sim in scen_sims.items()}
+    tasks.sort(key=lambda task: -costs[task[0]]) # Longest first; the sort is stable, so runs of the same scenario stay in order
+
+    if outputs is None:
+        outputs = sc.objdict()
+    pending = {} # Results that arrived before those of earlier runs of the same scenario
+    for scenkey,scen_sim in scen_sims.items():
+        if keep_sims:
+            outputs[scenkey] = outputs.get(scenkey, []) + [None]*n_runs
+        else:
+            if scenkey not in outputs:
+                scen_sim.init_results()
+                outputs[scenkey] = ReplicateStats(scen_sim.reskeys, scen_sim.npts)
+            pending[scenkey] = {}
+
+    own_executor = executor is None
+    if own_executor:
+        largest = scen_sims[max(costs, key=costs.get)]
+        keep_people = keep_sims and kwargs.get('keep_people', False)
+        ncpus = plan_workers(largest, n_runs=len(tasks), keep_people=keep_people, memory_budget=memory_budget, ncpus=ncpus, verbose=kwargs.get('verbose', 0) >= 2)
+        executor = cvex.ProcessExecutor(ncpus=ncpus)
+    populations = {scenkey:_share_population(scen_sim, executor=executor) for scenkey,scen_sim in scen_sims.items()}
+    specs = {scenkey:make_job_spec(scen_sim, population=populations[scenkey]) for scenkey,scen_sim in scen_sims.items()}
+    shared = {'specs':specs, 'keep_sims':keep_sims, 'kwargs':kwargs} # Sent to each worker once per batch
+    try:
+        for i,(scenkey,ind,output) in executor.imap_unordered(_run_scenario_task, tasks, shared=shared):
+            if keep_sims:
+                outputs[scenkey][ind] = output
+            else:
+                stats = outputs[scenkey]
+                pending[scenkey][ind] = output
+                while stats.n in pending[scenkey]:
+                    stats.add(pending[scenkey].pop(stats.n))
+    finally:
+        for population in populations.values():
+            if population is not None:
+                population.unlink()
+        if own_executor:
+            executor.close()
+
+    return outputs
+
+
+def _run_single(taskkwargs):
+    ''' Run a single sim, for single_run() with an executor '''
+    taskkwargs = dict(taskkwargs)
+    sim = sim_from_spec(taskkwargs.pop('spec'))
+    return single_run(sim, **taskkwargs)
+
+
+def _run_job(job, shared):
+    '''
+    Run one job for multi_run(): the job is just the index of the run and the
+    parameters specific to it (e.g. from iterpars), and the shared dict holds the
+    spec of the base sim (see make_job_spec()) and the other arguments to
+    single_run(), which are only sent to each worker once per batch.
+    '''
+    kwargs = dict(shared['kwargs'])
+    sim = sim_from_spec(kwargs.pop('spec'))
+    sim = single_run(sim, **kwargs, **job)
+    if shared['reduce']:
+        return {key:sim.results[key].values for key in sim.reskeys}
+    else:
+        return sim
+
+
+def _make_popdict(sim):
+    '''
+    Make the population of a sim as Sim.initialize() would, but for a copy of the
+    sim, and in a separate thread, which has its own random number streams (see
+    get_rng()): neither the sim nor the random number streams of this thread are
+    changed.
+    '''
+    popsim = sim.shrink(in_place=False)
+    popsim.pars = sc.dcp(sim.pars) # Creating the population can change the parameters (e.g. use_layers)
+
+    def make_popdict(popsim):
+        popsim.validate_pars()
+        popsim.set_seed()
+        popsim.init_streams()
+        if popsim['crn']:
+            cvu.set_seed(popsim.stream('population').randint(1e9))
+        return cvpop.make_popdict(popsim)
+
+    with cvex.ThreadExecutor(n_workers=1) as executor:
+        popdict = executor.map(make_popdict, [popsim])[0]
+    return popdict
+
+
+def multi_run(sim, n_runs=4, noise=0.0, noisepar=None, iterpars=None, verbose=None, combine=False, keep_people=None, run_args=None, sim_args=None, share_population=False, reduce=False, executor=None, memory_budget=None, crn=None, **kwargs):
+    '''
+    For running multiple runs in parallel. The workers are sent a compact spec of
+    the sim (see make_job_spec()) rather than the sim itself, and create the people
+    themselves, so an initialized sim is run from the start with the seed of each run.
 
     Args:
         sim (Sim): the sim instance to be run
@@ -496,10 +1095,17 @@ def multi_run(sim, n_runs=4, noise=0.0, noisepar=None, iterpars=None, verbose=No
         keep_people (bool): whether or not to keep the people in each sim
         run_args (dict): arguments passed to sim.run()
         sim_args (dict): extra parameters to pass to the sim
+        share_population (bool or SharedPopulation): if True, create the population once and share it read-only between all runs via shared memory, rather than copying it to (or regenerating it in) each worker; can also be an existing SharedPopulation
+        reduce (bool): if True, the workers only send back their results, which are added to a ReplicateStats object as they arrive, rather than returning the sims
+        executor (Executor): if supplied, run the sims with this executor (e.g. a Runner, or a SocketExecutor to use other machines), rather than a new pool of worker processes
+        memory_budget (float): the memory the new worker processes can use, in bytes; the number of workers is chosen to fit (see plan_workers())
+        crn (bool): if supplied, whether to use common random numbers (default: the sim's crn parameter); with the same seeds, the runs are then matched with those of other multi_run() calls with different parameters
         kwargs (dict): also passed to the sim
 
     Returns:
-        if combine:
+        if reduce:
+            a ReplicateStats object summarizing the results of the runs
+        elif combine:
             a single sim object with the combined results from each sim
         else (default):
             a list of sim objects
@@ -513,6 +1119,11 @@ def multi_run(sim, n_runs=4, noise=0.0, noisepar=None, iterpars=None, verbose=No
     # Create the sims
     if sim_args is None:
         sim_args = {}
+    if reduce and combine:
+        raise ValueError('Results can either be combined or reduced, not both')
+    if crn is not None and crn != sim['crn']: # Use a copy of the sim with its own parameters, so the original isn't modified
+        sim = sim.shrink(skip_attrs=[], in_place=False)
+        sim.pars = sc.mergedicts(sim.pars, {'crn':crn})
 
     # Handle iterpars
     if iterpars is None:
@@ -526,14 +1137,54 @@ def multi_run(sim, n_runs=4, noise=0.0, noisepar=None, iterpars=None, verbose=No
             else:
                 n_runs = new_n
 
-    # Copy the simulations
-    iterkwargs = {'ind':np.arange(n_runs)}
-    iterkwargs.update(iterpars)
-    kwargs = {'sim':sim, 'noise':noise, 'noisepar':noisepar, 'verbose':verbose, 'keep_people':keep_people, 'sim_args':sim_args, 'run_args':run_args}
-    sims = sc.parallelize(single_run, iterkwargs=iterkwargs, kwargs=kwargs)
+    # Optionally place the population in shared memory, and send the workers a sim without it
+    population = None
+    owns_population = False
+    if share_population:
+        if isinstance(share_population, cvpop.SharedPopulation):
+            population = share_population
+        else:
+            popdict = sim.popdict if sim.popdict else _make_popdict(sim)
+            population = cvpop.SharedPopulation(popdict)
+            owns_population = True
+        sim = sim.shrink(in_place=False)
+    else: # If the sim already has a population, still share it with worker processes rather than copying it to them with every batch
+        population = _share_population(sim, executor=executor)
+        owns_population = population is not None
+
+    # Create the jobs: the spec of the base sim and the other arguments are shared, so each job is just the index of the run and any parameters specific to it
+    spec = make_job_spec(sim, population=population)
+    kwargs = {'spec':spec, 'noise':noise, 'noisepar':noisepar, 'verbose':verbose, 'keep_people':keep_people, 'sim_args':sim_args, 'run_args':run_args}
+    if reduce:
+        kwargs['keep_people'] = False
+    shared = {'kwargs':kwargs, 'reduce':reduce}
+    jobs = [sc.mergedicts({'ind':i}, {key:val[i] for key,val in iterpars.items()}) for i in range(n_runs)]
+
+    own_executor = executor is None
+    if own_executor:
+        ncpus = plan_workers(sim, n_runs=n_runs, keep_people=keep_people and not reduce, memory_budget=memory_budget, verbose=verbose is not None and verbose >= 2)
+        executor = cvex.ProcessExecutor(ncpus=ncpus)
+    try:
+        if reduce: # Fold the results into the statistics as they arrive, in order, so the statistics are reproducible
+            stats = None
+            for results in executor.imap(_run_job, jobs, shared=shared):
+                if stats is None:
+                    stats = ReplicateStats(results.keys(), npts=len(next(iter(results.values()))))
+                stats.add(results)
+        else:
+            sims = executor.map(_run_job, jobs, shared=shared)
+    finally:
+        if owns_population:
+            population.unlink()
+        if own_executor:
+            executor.close()
+
+    # Summary statistics only
+    if reduce:
+        return stats
 
     # Usual case -- return a list of sims
-    if not combine:
+    elif not combine:
         return sims
 
     # Or, combine them into a single sim with scaled results
@@ -554,4 +1205,125 @@ def multi_run(sim, n_runs=4, noise=0.0, noisepar=None, iterpars=None, verbose=No
             if not output_sim.results[key].scale:
                 output_sim.results[key].values /= len(sims)
 
-        return output_sim
\ No newline at end of file
+        return output_sim
+
+
+
+_worker = sc.objdict() # The state each Runner worker keeps between jobs
+_popkeys = ['pop_size', 'pop_type', 'use_layers', 'contacts'] # Parameters that determine the population
+
+
+def _popkey(sim):
+    return str([sim[key] for key in _popkeys])
+
+
+def _init_worker(sim, cache_population):
+    ''' Set up a Runner worker: compile the Numba functions and store the base sim '''
+    cvu.warmup()
+    _worker.sim = sim
+    _worker.cache_population = cache_population
+    _worker.popdicts = {}
+    if sim.popdict:
+        _worker.popdicts[_popkey(sim)] = sim.popdict
+    return
+
+
+def _run_runner_job(job):
+    ''' Run one Runner job in a worker, reusing the population if possible '''
+    pars, seed, keep_sim, verbose = job
+    sim = cvsim.Sim.from_template(_worker.sim, **pars) # Copies the nested parameters and interventions, so the job can't change the base sim
+    if seed is not None:
+        sim['rand_seed'] = seed
+
+    if _worker.cache_population:
+        key = _popkey(sim)
+        if key not in _worker.popdicts:
+            sim.validate_pars()
+            cvu.set_seed(_worker.sim['rand_seed']) # So the population doesn't depend on which job happened to create it
+            _worker.popdicts[key] = cvpop.make_popdict(sim)
+        sim.popdict = _worker.popdicts[key]
+
+    sim.run(verbose=verbose)
+    if keep_sim:
+        sim.shrink()
+        return sim
+    else:
+        return {key:sim.results[key].values for key in sim.reskeys}
+
+
+class Runner(cvex.ProcessExecutor):
+    '''
+    A pool of worker processes that stays alive between batches of runs, for when
+    many small batches are needed (e.g. for calibration). Each worker compiles the
+    Numba functions and receives the base sim once, when it starts, rather than
+    for every batch, and keeps the population it creates for each set of
+    population parameters, so it can be reused by later jobs.
+
+    Each job is specified by the parameters to change from the base sim and the
+    random seed to use. Since the population is created once, with the base sim's
+    seed, it's the same for every job with the same population parameters (as with
+    multi_run(share_population=True)); set cache_population=False to create a new
+    one for each job instead. The Runner is a ProcessExecutor, so it can also be
+    passed to multi_run() and Scenarios.run().
+
+    Args:
+        sim (Sim): the base sim (default: a default sim); its population is used, if it has one
+        ncpus (int): the number of worker processes (default: the number of CPUs)
+        cache_population (bool): whether each worker should reuse populations between jobs
+        verbose (int): detail to print for each run
+
+    **Example**::
+
+        with cv.Runner(cv.Sim(pop_size=5000)) as runner:
+            for beta in np.linspace(0.01, 0.02, 11):
+                stats = runner.run([dict(pars={'beta':beta}, seed=seed) for seed in range(10)], reduce=True)
+    '''
+
+    def __init__(self, sim=None, ncpus=None, cache_population=True, verbose=0):
+        if sim is None:
+            sim = cvsim.Sim()
+        self.sim = sim.shrink(skip_attrs=['people'], in_place=False) # Keep the population dictionary, if any
+        self.cache_population = cache_population
+        self.verbose = verbose
+        self.n_jobs = 0 # Number of jobs run so far
+        super().__init__(ncpus=ncpus, initializer=_init_worker, initargs=(self.sim, self.cache_population))
+        return
+
+
+    def run(self, jobs, keep_sims=False, reduce=False):
+        '''
+        Run a batch of jobs.
+
+        Args:
+            jobs (list): the jobs to run; each is a dict with optional keys "pars" (the parameters to change) and "seed" (the random seed), a (pars, seed) tuple, or just a seed
+            keep_sims (bool): whether to return the (shrunken) sims, rather than only their results
+            reduce (bool): whether to return a ReplicateStats object summarizing the results, rather than the results of each job
+
+        Returns:
+            A list of sims or results dicts (of arrays), in the order of the jobs, or a ReplicateStats object
+        '''
+        self._check()
+        if keep_sims and reduce:
+            raise ValueError('Sims can either be kept or reduced, not both')
+
+        tasks = []
+        for job in jobs:
+            if isinstance(job, dict):
+                pars, seed = job.get('pars'), job.get('seed')
+            elif isinstance(job, tuple):
+                pars, seed = job
+            else:
+                pars, seed = None, job
+            tasks.append((sc.mergedicts(pars), seed, keep_sims, self.verbose))
+
+        self.n_jobs += len(tasks)
+        if reduce:
+            stats = None
+            for results in self.pool.imap(_run_runner_job, tasks):
+                if stats is None:
+                    stats = ReplicateStats(results.keys(), npts=len(next(iter(results.values()))))
+                stats.add(results)
+            return stats
+        else:
+            return self.pool.map(_run_runner_job, tasks)
+
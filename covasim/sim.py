@@ -3,12 +3,10 @@ Defines the Sim class, Covasim's core class.
 '''
 
 #%% Imports
+import os
 import numpy as np
-import pylab as pl
-import pandas as pd
 import sciris as sc
 import datetime as dt
-import matplotlib.ticker as ticker
 from . import version as cvv
 from . import utils as cvu
 from . import defaults as cvd
@@ -47,17 +45,61 @@ class Sim(cvbase.BaseSim):
         self.results_ready = False # Whether or not results are ready
         self.people        = []    # Initialize these here so methods that check their length can see they're empty
         self.contact_keys  = None  # Keys for contact networks
+        self.contact_history = None # Recent dynamic contacts, if needed for tracing
+        self.intervention_schedule = None # The interventions to apply on each day
+        self.scheduled_interventions = [] # The interventions the schedule was compiled for
+        self.stream_seed   = None  # The seed of the named random number streams, if common random numbers are used
+        self.stream_uids   = None  # The UIDs of the people, for computing the keys of their streams
         self.results       = {}    # For storing results
 
         # Now update everything
         self.set_metadata(filename)        # Set the simulation date and filename
         self.load_data(datafile, datacols) # Load the data, if provided
-        self.load_population(popfile)      # Load the population, if provided
         self.update_pars(pars)             # Update the parameters, if provided
+        self.load_population(popfile)      # Load the population, if provided -- after the parameters, so pop_size can be checked
 
         return
 
 
+    @classmethod
+    def from_template(cls, template, keep_population=False, **kwargs):
+        '''
+        Create a new sim with the parameters of an existing sim (or parameters dict),
+        without deep-copying them. This is much faster than creating each sim from
+        scratch when many sims are needed, e.g. for calibration.
+
+        The new sim has its own parameters dict, and its own copies of the nested
+        parameters (e.g. beta_layers or the durations, which interventions may change
+        in place) and of the interventions, which store information about the sim
+        they're applied to; these are all small. Data loaded by the template are shared.
+
+        Args:
+            template (Sim or dict): the sim, or the parameters, to copy
+            keep_population (bool): whether to reuse the template's population dictionary, if it has one
+            kwargs (dict): parameters to override, as for update_pars()
+
+        **Example**::
+
+            base = cv.Sim(pop_size=5000, n_days=90)
+            sims = [cv.Sim.from_template(base, beta=beta) for beta in np.linspace(0.01, 0.02, 100)]
+        '''
+        sim = cls()
+        if isinstance(template, Sim):
+            pars = template.pars
+            sim.datafile = template.datafile
+            sim.data     = template.data
+            if keep_population:
+                sim.popdict = template.popdict
+        else:
+            pars = template
+        sim.pars.update(pars) # Starting from the defaults means a partial parameters dict is fine too
+        for key,val in sim.pars.items():
+            if isinstance(val, (dict, list)): # Nested parameters and interventions
+                sim.pars[key] = sc.dcp(val)
+        sim.update_pars(kwargs)
+        return sim
+
+
     def update_pars(self, pars=None, create=False, **kwargs):
         ''' Ensure that metaparameters get used properly before being updated '''
         pars = sc.mergedicts(pars, kwargs)
@@ -93,16 +135,21 @@ class Sim(cvbase.BaseSim):
         return
 
 
-    def load_population(self, filename=None, **kwargs):
+    def load_population(self, filename=None, mmap=True, **kwargs):
         '''
-        Load the population dictionary from file.
+        Load the population dictionary from file. Both the pickled format and the
+        binary format (a folder, see save_population()) are supported.
 
         Args:
-            filename (str): name of the file to load
+            filename (str): name of the file (or binary population folder) to load
+            mmap (bool): for binary populations, whether to memory-map the arrays rather than read them
         '''
         if filename is not None:
             filepath = sc.makefilepath(filename=filename, **kwargs)
-            self.popdict = sc.loadobj(filepath)
+            if os.path.isdir(filepath):
+                self.popdict = cvpop.load_popdict(filepath, mmap=mmap)
+            else:
+                self.popdict = sc.loadobj(filepath)
             n_actual = len(self.popdict['uid'])
             n_expected = self['pop_size']
             if n_actual != n_expected:
@@ -111,15 +158,19 @@ class Sim(cvbase.BaseSim):
         return
 
 
-    def save_population(self, filename, **kwargs):
+    def save_population(self, filename, binary=False, **kwargs):
         '''
         Save the population dictionary to file.
 
         Args:
-            filename (str): name of the file to save to.
+            filename (str): name of the file to save to (or, if binary, the folder)
+            binary (bool): if True, save raw arrays plus a JSON header, which can be memory-mapped when loaded; else, save as a gzipped pickle
         '''
         filepath = sc.makefilepath(filename=filename, **kwargs)
-        sc.saveobj(filepath, self.popdict)
+        if binary:
+            cvpop.save_popdict(filepath, self.popdict)
+        else:
+            sc.saveobj(filepath, self.popdict)
         return filepath
 
 
@@ -133,12 +184,112 @@ class Sim(cvbase.BaseSim):
         self.t = 0  # The current time index
         self.validate_pars() # Ensure parameters have valid values
         self.set_seed() # Reset the random seed
+        self.init_streams() # Set the seed of the named random number streams, if used
         self.init_results() # Create the results stucture
+        if self['crn']:
+            cvu.set_seed(self.stream('population').randint(1e9)) # Use the same population for all scenarios
         self.init_people(**kwargs) # Create all the people (slow)
+        self.init_interventions() # Let the interventions set themselves up for this sim
+        self.orig_pars = sc.dcp({k:v for k,v in self.pars.items() if k not in self._reset_skip}) # Snapshot for reset(), since interventions can modify parameters
         self.initialized = True
         return
 
 
+    _reset_skip = ['rand_seed', 'interventions', 'interv_func', 'stopping_func'] # Parameters that reset() leaves alone
+
+    def reset(self, seed=-1, verbose=None):
+        '''
+        Reset the simulation to its initial state without rebuilding the population,
+        for running several replicates in a row on the same people. Ages, prognoses,
+        and contacts are kept; the disease, testing, and quarantine state of each
+        person, the transmission records, the parameters (as they were after
+        initialization), and the results are all reset, and the seed infections are
+        drawn again.
+
+        Note that since creating the population also uses random numbers, a reset sim
+        will not give the same results as a new sim with the same seed.
+
+        Args:
+            seed (None or int): as for set_seed(): if no argument, reuse the current seed; if None, randomize; otherwise, use and store the supplied seed
+            verbose (int): level of detail to print
+
+        **Example**::
+
+            sim = cv.Sim()
+            for seed in range(5):
+                sim.reset(seed=seed)
+                sim.run()
+        '''
+        if not self.initialized: # Nothing to reset yet
+            if seed != -1:
+                self['rand_seed'] = seed
+            self.initialize()
+            return
+
+        if verbose is None:
+            verbose = self['verbose']
+        sc.printv(f'Resetting {len(self.people)} people...', 1, verbose)
+
+        self.pars.update(sc.dcp(self.orig_pars)) # Undo any changes made by interventions
+        self.t = 0
+        self.set_seed(seed)
+        self.init_streams()
+        self.results = {}
+        self.init_results()
+        for person in self.people:
+            person.make_susceptible()
+        self.init_interventions()
+
+        # Create the seed infections
+        for i in range(int(self['pop_infected'])):
+            person = self.people[i]
+            person.infect(t=0, rng=self.stream('natural_history', person.uid))
+
+        return
+
+
+    def init_streams(self):
+        ''' Set the seed of the named random number streams used for common random numbers (see stream()) '''
+        seed = self['rand_seed']
+        if self['crn'] and seed is None: # The seed is random, so draw one
+            seed = cvu.get_rng().randint(1e9)
+        self.stream_seed = seed
+        self.stream_uids = None
+        return
+
+
+    def stream(self, name, *keys):
+        '''
+        Return the named random number stream for an event (see RandomStream), e.g.
+        sim.stream('transmission', t, uid) for the transmission from person uid on day
+        t, if common random numbers are used (the crn parameter); otherwise, None, and
+        the global random number stream is used.
+
+        Args:
+            name (str): the name of the stream
+            keys (ints): the keys of the event, e.g. the day and the person
+        '''
+        if not self['crn']:
+            return None
+        return cvu.RandomStream(self.stream_seed, name, *keys)
+
+
+    def stream_keys(self, name, *keys):
+        '''
+        Return the keys of everyone's random number streams for an event at once (see
+        RandomStream.keys()), e.g. sim.stream_keys('transmission', t)[ind] is the key
+        of sim.stream('transmission', t, uid) for the person with index ind and UID
+        uid. Only used with common random numbers.
+
+        Args:
+            name (str): the name of the stream
+            keys (ints): the keys of the event, other than the person, e.g. the day
+        '''
+        if self.stream_uids is None or len(self.stream_uids) != len(self.people):
+            self.stream_uids = self.people.extract_array('uid', dtype=np.int64)
+        return self.stream(name, *keys).keys(self.stream_uids)
+
+
     def validate_pars(self):
         ''' Some parameters can take multiple types; this makes them consistent '''
 
@@ -240,8 +391,49 @@ class Sim(cvbase.BaseSim):
         # Create the seed infections
         for i in range(int(self['pop_infected'])):
             person = self.people[i]
-            person.infect(t=0)
+            person.infect(t=0, rng=self.stream('natural_history', person.uid))
+
+        return
+
+
+    def init_interventions(self):
+        '''
+        Initialize the interventions, e.g. so they can check or precompute what
+        they need from the sim, and compile the schedule of which interventions
+        to apply on each day, so interventions with nothing to do are skipped.
+        '''
+        self.contact_history = None
+        self.intervention_schedule = None
+        self.scheduled_interventions = []
+        self.update_schedule()
+        return
+
 
+    def update_schedule(self):
+        '''
+        Initialize any interventions that aren't in the schedule yet, and compile
+        the schedule again, if the interventions have changed since it was compiled
+        (e.g. they were set after the sim was initialized). Called at the start of
+        each timestep.
+        '''
+        interventions = sc.promotetolist(self['interventions'], keepnone=False)
+        scheduled = getattr(self, 'scheduled_interventions', [])
+        if self.intervention_schedule is not None and len(interventions) == len(scheduled) and all(i1 is i2 for i1,i2 in zip(interventions, scheduled)):
+            return # Nothing has changed
+
+        self.intervention_schedule = [[] for t in range(self.npts)]
+        for intervention in interventions:
+            initialize = getattr(intervention, 'initialize', None) # Only apply() is required, so these are optional
+            get_days   = getattr(intervention, 'get_days', None)
+            if initialize is not None and not any(intervention is i for i in scheduled):
+                initialize(self)
+            days = get_days(self) if get_days is not None else None
+            if days is None: # Apply it every day
+                days = range(self.npts)
+            for t in np.unique(days).tolist():
+                if 0 <= t < self.npts:
+                    self.intervention_schedule[t].append(intervention)
+        self.scheduled_interventions = list(interventions) # A copy, in case the list is changed in place
         return
 
 
@@ -254,6 +446,7 @@ class Sim(cvbase.BaseSim):
         t = self.t
         if t >= self.npts:
             return
+        self.update_schedule() # In case the interventions have changed
 
         # Zero counts for this time step: stocks
         n_susceptible   = 0
@@ -285,11 +478,17 @@ class Sim(cvbase.BaseSim):
         n_beds           = self['n_beds']
         bed_constraint   = False
         pop_size         = len(self.people)
-        n_imports        = cvu.pt(self['n_imports']) # Imported cases
+        crn              = self['crn'] # Whether to use common random numbers, i.e. a separate random number stream for each event
+        imports          = self.stream('importation', t) if crn else None
+        n_imports        = imports.poisson(self['n_imports']) if crn else cvu.pt(self['n_imports']) # Imported cases
         if 'c' in self['contacts']:
-            n_comm_contacts = self['contacts']['c'] # Community contacts; TODO: make less ugly
+            n_comm_contacts = int(self['contacts']['c']) # Community contacts; TODO: make less ugly
         else:
             n_comm_contacts = 0
+        if crn: # The keys of everyone's streams for today, computed all at once, rather than creating a stream for each person
+            natural_history_keys = self.stream_keys('natural_history')
+            transmission_keys    = self.stream_keys('transmission', t)
+            acquisition_keys     = self.stream_keys('acquisition', t)
 
         # Print progress
         if verbose >= 1:
@@ -305,25 +504,33 @@ class Sim(cvbase.BaseSim):
 
         # Randomly infect some people (imported infections)
         if n_imports>0:
-            imporation_inds = cvu.choose(max_n=pop_size, n=n_imports)
+            imporation_inds = imports.choose(max_n=pop_size, n=n_imports) if crn else cvu.choose(max_n=pop_size, n=n_imports)
             for ind in imporation_inds:
                 person = self.people[ind]
-                new_infections += person.infect(t=t)
+                new_infections += person.infect(t=t, rng=cvu.RandomStream.from_key(natural_history_keys[ind]) if crn else None)
 
 
+        # Put known contacts into quarantine and release people whose quarantine has ended, since this affects transmission
+        new_quarantined += self.people.check_quarantine(t, quar_period)
+
         susceptible = self.people.filter_in('susceptible')
         n_susceptible = 0
         for person in susceptible:
             n_susceptible += 1 # Update number of susceptibles
-
-            # If they're quarantined, this affects their transmission rate
-            new_quarantined += person.check_quar_begin(t, quar_period) # Set know_contact and go into quarantine
-            n_quarantined += person.check_quar_end(t) # Come out of quarantine, and count quarantine state
+            n_quarantined += person.quarantined
 
         # Loop over everyone not susceptible
-        not_susceptible = self.people.filter_out('susceptible')
-        for person in not_susceptible:
-            # N.B. Recovered and dead people are included here!
+        contact_history = self.contact_history
+        comm_sources = [] # People who had community contacts, if these need to be stored
+        comm_targets = []
+        acquisitions = {} # With common random numbers, the stream of each pair of people exposed while quarantined today
+        if n_comm_contacts and not crn: # Sample everyone's community contacts in batches, one row per person, starting with enough for everyone already infectious
+            n_comm_batch = np.count_nonzero(self.people.extract_array('infectious', dtype=bool)) + 1
+            comm_batch = np.zeros((0, n_comm_contacts), dtype=np.int64)
+            comm_row = 0
+        for ind,person in enumerate(self.people):
+            if person.susceptible: # N.B. Recovered and dead people are included here!
+                continue
 
             # If exposed, check if the person becomes infectious
             if person.exposed:
@@ -332,9 +539,6 @@ class Sim(cvbase.BaseSim):
                     person.infectious = True
                     sc.printv(f'      Person {person.uid} became infectious!', 2, verbose)
 
-            # If they're quarantined, this affects their transmission rate
-            new_quarantined += person.check_quar_begin(t, quar_period) # Set know_contact and go into quarantine
-            person.check_quar_end(t) # Come out of quarantine
             n_quarantined += person.quarantined
             n_diagnosed   += person.diagnosed
 
@@ -371,10 +575,23 @@ class Sim(cvbase.BaseSim):
                     # Set community contacts
                     person_contacts = person.contacts
                     if n_comm_contacts:
-                        community_contact_inds = cvu.choose(max_n=pop_size, n=n_comm_contacts)
+                        if crn:
+                            community_contact_inds = np.floor(pop_size*cvu.stream_random(transmission_keys[ind], 0, n_comm_contacts)).astype(np.int64) # With replacement, which is much faster for a stream
+                        else:
+                            if comm_row == len(comm_batch): # Sample the next batch
+                                comm_batch = cvu.choose_groups(pop_size, np.full(n_comm_batch, n_comm_contacts, dtype=np.int64)).reshape(n_comm_batch, n_comm_contacts)
+                                comm_row = 0
+                            community_contact_inds = comm_batch[comm_row]
+                            comm_row += 1
                         person_contacts['c'] = community_contact_inds
+                        if contact_history is not None:
+                            comm_sources.append(ind)
+                            comm_targets.append(community_contact_inds)
 
                     # Determine who gets infected
+                    if crn: # Draw the numbers for all of this person's contacts at once
+                        draws = cvu.stream_random(transmission_keys[ind], n_comm_contacts, sum([len(person_contacts[ckey]) for ckey in self.contact_keys]))
+                        n_drawn = 0
                     for ckey in self.contact_keys:
                         contact_ids = person_contacts[ckey]
                         if len(contact_ids):
@@ -382,7 +599,12 @@ class Sim(cvbase.BaseSim):
                                               beta_layers[ckey] *\
                                               (quar_trans_factor[ckey] if person.quarantined else 1.) # Reduction in onward transmission due to quarantine
 
-                            transmission_inds = cvu.bf(this_beta_layer, contact_ids)
+                            if crn:
+                                n_contacts = len(contact_ids)
+                                transmission_inds = contact_ids[draws[n_drawn:n_drawn+n_contacts] < this_beta_layer]
+                                n_drawn += n_contacts
+                            else:
+                                transmission_inds = cvu.bf(this_beta_layer, contact_ids)
                             for contact_ind in transmission_inds: # Loop over people who get infected
                                 target_person = self.people[contact_ind]
                                 if target_person.susceptible: # Skip people who are not susceptible
@@ -390,13 +612,27 @@ class Sim(cvbase.BaseSim):
                                     # See whether we will infect this person
                                     infect_this_person = True # By default, infect them...
                                     if target_person.quarantined:
-                                        infect_this_person = cvu.bt(quar_acq_factor) # ... but don't infect them if they're isolating # DJK - should be layer dependent!
+                                        if crn:
+                                            pair = (target_person.uid, person.uid)
+                                            acquisition = acquisitions.get(pair)
+                                            if acquisition is None:
+                                                acquisition = acquisitions[pair] = cvu.RandomStream.from_key(cvu.splitmix64(acquisition_keys[contact_ind] ^ np.uint64(person.uid)))
+                                            infect_this_person = acquisition.random_sample() < quar_acq_factor # Repeated exposures take the next number from the pair's stream
+                                        else:
+                                            infect_this_person = cvu.bt(quar_acq_factor) # ... but don't infect them if they're isolating # DJK - should be layer dependent!
                                     if infect_this_person:
-                                        new_infections += target_person.infect(t, bed_constraint, source=person) # Actually infect them
+                                        rng = cvu.RandomStream.from_key(natural_history_keys[contact_ind]) if crn else None
+                                        new_infections += target_person.infect(t, bed_constraint, source=person, rng=rng) # Actually infect them
                                         sc.printv(f'        Person {person.uid} infected person {target_person.uid}!', 2, verbose)
 
-        # End of person loop; apply interventions
-        for intervention in self['interventions']:
+        # End of person loop; store the community contacts, then apply interventions
+        if contact_history is not None:
+            comm_sources = np.repeat(np.array(comm_sources, dtype=np.int64), n_comm_contacts)
+            comm_targets = np.concatenate(comm_targets) if comm_targets else np.zeros(0, dtype=np.int64)
+            contact_history.add(t, comm_sources, comm_targets)
+        if crn:
+            cvu.set_seed(self.stream('interventions', t).randint(1e9)) # Interventions use the global stream, so reset it each day
+        for intervention in self.intervention_schedule[t]:
             intervention.apply(self)
         if self['interv_func'] is not None: # Apply custom intervention function
             self =self['interv_func'](self)
@@ -608,7 +844,7 @@ class Sim(cvbase.BaseSim):
                                 p = 1.0
                             else:
                                 p = cvu.poisson_test(datum, estimate)
-                            logp = pl.log(p)
+                            logp = np.log(p)
                             loglike += weight*logp
                             sc.printv(f'  {d}, data={datum:3.0f}, model={estimate:3.0f}, log(p)={logp:10.4f}, loglike={loglike:10.4f}', 2, verbose)
 
@@ -681,6 +917,8 @@ class Sim(cvbase.BaseSim):
         axis_args    = sc.mergedicts({'left':0.1, 'bottom':0.05, 'right':0.9, 'top':0.97, 'wspace':0.2, 'hspace':0.25}, axis_args)
         legend_args  = sc.mergedicts({'loc': 'best'}, legend_args)
 
+        import pylab as pl # Plotting libraries are only imported when needed
+        import matplotlib.ticker as ticker
         fig = pl.figure(**fig_args)
         pl.subplots_adjust(**axis_args)
         pl.rcParams['font.size'] = font_size
@@ -702,7 +940,7 @@ class Sim(cvbase.BaseSim):
                     data_t = (self.data.index-self['start_day'])/np.timedelta64(1,'D') # Convert from data date to model output index based on model start date
                     pl.scatter(data_t, self.data[key], c=[this_color], **scatter_args)
             if self.data is not None and len(self.data):
-                pl.scatter(pl.nan, pl.nan, c=[(0,0,0)], label='Data', **scatter_args)
+                pl.scatter(np.nan, np.nan, c=[(0,0,0)], label='Data', **scatter_args)
 
             pl.legend(**legend_args)
             pl.grid(use_grid)
@@ -714,7 +952,7 @@ class Sim(cvbase.BaseSim):
             # Optionally reset tick marks (useful for e.g. plotting weeks/months)
             if interval:
                 xmin,xmax = ax.get_xlim()
-                ax.set_xticks(pl.arange(xmin, xmax+1, interval))
+                ax.set_xticks(np.arange(xmin, xmax+1, interval))
 
             # Set xticks as dates
             if as_dates:
@@ -762,6 +1000,7 @@ class Sim(cvbase.BaseSim):
         '''
         fig_args  = sc.mergedicts({'figsize':(16,10)}, fig_args)
         plot_args = sc.mergedicts({'lw':3, 'alpha':0.7}, plot_args)
+        import pylab as pl # Plotting libraries are only imported when needed
         fig = pl.figure(**fig_args)
         pl.subplot(111)
         tvec = self.results['t']
@@ -2,22 +2,22 @@
 Utilities for running the COVID-ABM
 '''
 
+import zlib # For hashing the names of random number streams
+import math # For lgamma() in Numba functions
+import threading # For per-thread random number generators
 import numba  as nb # For faster computations
 import numpy  as np # For numerics
-import pandas as pd # Used for pd.unique() (better than np.unique())
-import pylab  as pl # Used by fixaxis()
 import sciris as sc # Used by fixaxis()
-import scipy.stats as sps # Used by poisson_test()
 from . import version as cvver
 
-__all__ = ['CancelError', 'sample', 'set_seed', 'bt', 'mt', 'pt', 'choose', 'choose_weighted', 'check_version', 'git_info', 'fixaxis', 'get_doubling_time', 'poisson_test']
+__all__ = ['CancelError', 'sample', 'get_rng', 'set_seed', 'RandomStream', 'warmup', 'bt', 'mt', 'pt', 'choose', 'binomial_filter', 'n_poisson', 'choose_groups', 'choose_weighted', 'AliasSampler', 'check_version', 'git_info', 'fixaxis', 'get_doubling_time', 'poisson_test']
 
 class CancelError(Exception):
     pass
 
 #%% Define helper functions
 
-def sample(dist=None, par1=None, par2=None, size=None):
+def sample(dist=None, par1=None, par2=None, size=None, rng=None):
     '''
     Draw a sample from the distribution specified by the input.
 
@@ -25,7 +25,8 @@ def sample(dist=None, par1=None, par2=None, size=None):
         dist (str): the distribution to sample from
         par1 (float): the "main" distribution parameter (e.g. mean)
         par2 (float): the "secondary" distribution parameter (e.g. std)
-        n (int): the number of samples (default=1)
+        size (int): the number of samples (default: a single sample, not an array)
+        rng (RandomState or RandomStream): the random number generator to use (default: get_rng())
 
     Returns:
         A length N array of samples
@@ -54,16 +55,18 @@ def sample(dist=None, par1=None, par2=None, size=None):
 
     # Compute distribution parameters and draw samples
     # NB, if adding a new distribution, also add to choices above
-    if   dist == 'uniform':       samples = np.random.uniform(low=par1, high=par2, size=size)
-    elif dist == 'normal':        samples = np.random.normal(loc=par1, scale=par2, size=size)
-    elif dist == 'normal_pos':    samples = np.abs(np.random.normal(loc=par1, scale=par2, size=size))
-    elif dist == 'normal_int':    samples = np.round(np.abs(np.random.normal(loc=par1, scale=par2, size=size)))
+    if rng is None:
+        rng = get_rng()
+    if   dist == 'uniform':       samples = rng.uniform(low=par1, high=par2, size=size)
+    elif dist == 'normal':        samples = rng.normal(loc=par1, scale=par2, size=size)
+    elif dist == 'normal_pos':    samples = np.abs(rng.normal(loc=par1, scale=par2, size=size))
+    elif dist == 'normal_int':    samples = np.round(np.abs(rng.normal(loc=par1, scale=par2, size=size)))
     elif dist in ['lognormal', 'lognormal_int']:
         mean  = np.log(par1**2 / np.sqrt(par2 + par1**2)) # Computes the mean of the underlying normal distribution
         sigma = np.sqrt(np.log(par2/par1**2 + 1)) # Computes sigma for the underlying normal distribution
-        samples = np.random.lognormal(mean=mean, sigma=sigma, size=size)
+        samples = rng.lognormal(mean=mean, sigma=sigma, size=size)
         if dist == 'lognormal_int': samples = np.round(samples)
-    elif dist == 'neg_binomial':  samples = np.random.negative_binomial(n=par1, p=par2, size=size)
+    elif dist == 'neg_binomial':  samples = rng.negative_binomial(n=par1, p=par2, size=size)
     else:
         choicestr = '\n'.join(choices)
         errormsg = f'The selected distribution "{dist}" is not implemented; choices are: {choicestr}'
@@ -72,64 +75,341 @@ def sample(dist=None, par1=None, par2=None, size=None):
     return samples
 
 
-def set_seed(seed=None):
-    ''' Reset the random seed -- complicated because of Numba '''
+@nb.njit((nb.int64,), cache=True, nogil=True)
+def set_seed_numba(seed):
+    ''' Numba has its own random number stream, so has to be seeded separately '''
+    return np.random.seed(seed)
+
+
+_rng_local = threading.local() # The NumPy random number generator for each thread; see get_rng()
+
+def get_rng():
+    '''
+    Return the NumPy random number generator for the current thread. The main thread
+    uses NumPy's global generator (as used by np.random.seed() etc.), while each
+    other thread gets its own, so sims running in different threads (e.g. with a
+    ThreadExecutor) each have their own random number stream. Numba already keeps a
+    separate stream for each thread.
+    '''
+    try:
+        return _rng_local.rng
+    except AttributeError:
+        if threading.current_thread() is threading.main_thread():
+            _rng_local.rng = np.random.mtrand._rand # The global generator
+        else:
+            _rng_local.rng = np.random.RandomState()
+        return _rng_local.rng
 
-    @nb.njit((nb.int64,))
-    def set_seed_numba(seed):
-        return np.random.seed(seed)
 
-    def set_seed_regular(seed):
-        return np.random.seed(seed)
+def set_seed(seed=None):
+    ''' Reset the random seed for this thread -- complicated because of Numba '''
 
     # Dies if a float is given
     if seed is not None:
         seed = int(seed)
 
-    set_seed_regular(seed) # If None, reinitializes it
+    rng = get_rng()
+    rng.seed(seed) # If None, reinitializes it
     if seed is None: # Numba can't accept a None seed, so use our just-reinitialized Numpy stream to generate one
-        seed = np.random.randint(1e9)
+        seed = rng.randint(1e9)
     set_seed_numba(seed)
 
     return
 
 
-@nb.njit((nb.float64,)) # These types can also be declared as a dict, but performance is much slower...?
+@nb.njit((nb.uint64,), cache=True, nogil=True)
+def splitmix64(x):
+    ''' Hash a 64-bit integer (the SplitMix64 generator's output function) '''
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+@nb.njit(cache=True, nogil=True)
+def _stream_uniform(key, i):
+    ''' The i-th uniform random number of the stream with this key '''
+    return (splitmix64(key ^ splitmix64(np.uint64(i))) >> np.uint64(11)) * (1.0/9007199254740992.0) # 53 random bits
+
+
+@nb.njit((nb.uint64, nb.int64, nb.int64), cache=True, nogil=True)
+def stream_random(key, start, n):
+    ''' The start-th to (start+n-1)-th uniform random numbers of the stream with this key '''
+    samples = np.empty(n)
+    for i in range(n):
+        samples[i] = _stream_uniform(key, start + i)
+    return samples
+
+
+@nb.njit((nb.uint64, nb.int64[:]), cache=True, nogil=True)
+def stream_keys(key, keys):
+    ''' The key of the stream for each of the keys (e.g. each person) within the stream with this key '''
+    samples = np.empty(len(keys), dtype=np.uint64)
+    for i in range(len(keys)):
+        samples[i] = splitmix64(key ^ np.uint64(keys[i]))
+    return samples
+
+
+@nb.njit(cache=True, nogil=True)
+def _stream_poisson(key, i, lam):
+    '''
+    A Poisson random number from the stream with this key, starting at the i-th
+    number; returns the sample and the index of the next unused number. Small
+    means use inversion (one number per sample); large means use the transformed
+    rejection method (PTRS) of Hörmann (1993), as NumPy does.
+    '''
+    if lam <= 0:
+        return 0, i
+    if lam < 10:
+        u = _stream_uniform(key, i)
+        k = 0
+        p = np.exp(-lam)
+        cdf = p
+        while u > cdf and p > 0:
+            k += 1
+            p *= lam/k
+            cdf += p
+        return k, i+1
+    slam = np.sqrt(lam)
+    loglam = np.log(lam)
+    b = 0.931 + 2.53*slam
+    a = -0.059 + 0.02483*b
+    invalpha = 1.1239 + 1.1328/(b - 3.4)
+    vr = 0.9277 - 3.6224/(b - 2)
+    while True:
+        U = _stream_uniform(key, i) - 0.5
+        V = _stream_uniform(key, i+1)
+        i += 2
+        us = 0.5 - np.abs(U)
+        k = np.floor((2*a/us + b)*U + lam + 0.43)
+        if us >= 0.07 and V <= vr:
+            return int(k), i
+        if k < 0 or (us < 0.013 and V > us):
+            continue
+        if np.log(V) + np.log(invalpha) - np.log(a/(us*us) + b) <= -lam + k*loglam - math.lgamma(k + 1):
+            return int(k), i
+
+
+@nb.njit(cache=True, nogil=True)
+def _stream_gamma(key, i, shape):
+    ''' A gamma random number with unit scale, by the method of Marsaglia and Tsang (2000); returns the sample and the index of the next unused number '''
+    boost = 1.0
+    if shape < 1: # Draw from shape+1 and scale down
+        boost = _stream_uniform(key, i)**(1.0/shape)
+        shape += 1
+        i += 1
+    d = shape - 1.0/3
+    c = 1.0/np.sqrt(9*d)
+    while True:
+        x = np.sqrt(-2*np.log(1.0 - _stream_uniform(key, i)))*np.cos(2*np.pi*_stream_uniform(key, i+1)) # Box-Muller transform
+        v = 1 + c*x
+        if v <= 0:
+            i += 2
+            continue
+        v = v*v*v
+        u = _stream_uniform(key, i+2)
+        i += 3
+        if np.log(u) < 0.5*x*x + d - d*v + d*np.log(v):
+            return d*v*boost, i
+
+
+@nb.njit((nb.uint64, nb.int64, nb.float64, nb.int64), cache=True, nogil=True)
+def stream_poisson(key, start, lam, n):
+    ''' n Poisson random numbers with mean lam from the stream with this key; returns the samples and how many uniform numbers they used '''
+    samples = np.empty(n, dtype=np.int64)
+    i = start
+    for s in range(n):
+        k, i = _stream_poisson(key, i, lam)
+        samples[s] = k
+    return samples, i - start
+
+
+@nb.njit((nb.uint64, nb.int64, nb.float64, nb.float64, nb.int64), cache=True, nogil=True)
+def stream_negative_binomial(key, start, r, p, n):
+    ''' n negative binomial random numbers (as for np.random.negative_binomial()) from the stream with this key, as a gamma-Poisson mixture; returns the samples and how many uniform numbers they used '''
+    samples = np.empty(n, dtype=np.int64)
+    i = start
+    for s in range(n):
+        lam, i = _stream_gamma(key, i, r)
+        k, i = _stream_poisson(key, i, lam*(1 - p)/p)
+        samples[s] = k
+    return samples, i - start
+
+
+class RandomStream(object):
+    '''
+    A named stream of random numbers that depends only on the seed, the name, and
+    the keys (e.g. the day and the person), not on how many other random numbers
+    have been drawn. This is used for common random numbers (see the crn parameter):
+    runs of different scenarios with the same seed draw the same numbers for the
+    same events (e.g. for a given person's natural history), so the differences
+    between the scenarios are due to the scenarios rather than to chance.
+
+    Each number is a hash of the key and a counter, so creating a stream is cheap,
+    and streams can be created for every person on every day. Streams provide the
+    methods of np.random.RandomState that covasim uses, so they can be passed to
+    sample(). For speed, the keys of the streams of many events can be computed at
+    once with keys(), and their numbers drawn directly with stream_random().
+
+    Args:
+        seed (int): the random seed of the run
+        name (str): the name of the stream, e.g. 'transmission'
+        keys (ints): any other keys, e.g. the day and the person's index
+
+    **Example**::
+
+        stream = cv.RandomStream(1, 'transmission', t, uid)
+        contacts = contacts[stream.random(len(contacts)) < beta]
+    '''
+
+    def __init__(self, seed, name, *keys):
+        mask = 0xFFFFFFFFFFFFFFFF # Keys are 64-bit unsigned integers
+        key = int(splitmix64(np.uint64(((int(seed) << 32) ^ zlib.crc32(name.encode())) & mask)))
+        for k in keys:
+            key = int(splitmix64(np.uint64(key ^ (int(k) & mask))))
+        self.key = np.uint64(key)
+        self.count = 0 # The number of random numbers drawn so far
+        return
+
+    @classmethod
+    def from_key(cls, key):
+        ''' Create the stream with this key, e.g. from keys() '''
+        stream = object.__new__(cls)
+        stream.key = np.uint64(key)
+        stream.count = 0
+        return stream
+
+    def keys(self, keys):
+        ''' The keys of the streams with each of these extra keys, e.g. RandomStream(seed, name, t).keys(uids)[i] is the key of RandomStream(seed, name, t, uids[i]) '''
+        return stream_keys(self.key, np.asarray(keys, dtype=np.int64))
+
+    def random_sample(self, size=None):
+        n = 1 if size is None else (size if isinstance(size, int) else int(np.prod(size)))
+        samples = stream_random(self.key, self.count, n)
+        self.count += n
+        return samples[0] if size is None else samples.reshape(size)
+
+    random = random_sample
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high - low)*self.random_sample(size)
+
+    def randint(self, low, high=None, size=None):
+        if high is None:
+            low, high = 0, low
+        samples = low + np.floor((high - low)*self.random_sample(size))
+        return int(samples) if size is None else samples.astype(np.int64)
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        n = 1 if size is None else (size if isinstance(size, int) else int(np.prod(size)))
+        samples = stream_random(self.key, self.count, 2*n) # Both sets of numbers at once
+        self.count += 2*n
+        u1 = 1.0 - samples[:n] # In (0,1], so the log is finite
+        u2 = samples[n:]
+        samples = loc + scale*np.sqrt(-2*np.log(u1))*np.cos(2*np.pi*u2) # Box-Muller transform
+        return samples[0] if size is None else samples.reshape(size)
+
+    def lognormal(self, mean=0.0, sigma=1.0, size=None):
+        return np.exp(self.normal(mean, sigma, size))
+
+    def poisson(self, lam=1.0, size=None):
+        n = 1 if size is None else (size if isinstance(size, int) else int(np.prod(size)))
+        samples, used = stream_poisson(self.key, self.count, float(lam), n)
+        self.count += used
+        return samples[0] if size is None else samples.reshape(size)
+
+    def negative_binomial(self, n, p, size=None):
+        n_samples = 1 if size is None else (size if isinstance(size, int) else int(np.prod(size)))
+        samples, used = stream_negative_binomial(self.key, self.count, float(n), float(p), n_samples)
+        self.count += used
+        return samples[0] if size is None else samples.reshape(size)
+
+    def choose(self, max_n, n):
+        ''' Choose n of max_n items without replacement, as for choose() '''
+        return np.argpartition(self.random_sample(max_n), n-1)[:n] if n > 0 else np.zeros(0, dtype=np.int64)
+
+
+def warmup(verbose=False):
+    '''
+    Make sure all of the Numba functions are compiled and ready to use, by running
+    them once, so that later calls -- e.g. in parallel worker processes or
+    a web server -- don't pay the start-up cost. Compiled functions are cached on
+    disk, so after covasim has been used once, this mostly just loads them.
+
+    This doesn't touch the random number streams, so it can be called after the
+    seed has been set: the functions that would reseed or draw from the global
+    stream whatever their inputs (set_seed_numba(), bt(), pt() and choose()) are
+    skipped, since they're compiled or loaded when covasim is imported anyway,
+    and the rest are called with empty inputs.
+
+    Args:
+        verbose (bool): whether to print the time taken
+
+    Returns:
+        The time taken, in seconds
+    '''
+    T = sc.tic()
+    ints   = np.arange(4, dtype=np.int64)
+    floats = np.full(4, 0.25)
+    none   = ints[:0]
+    key = splitmix64(np.uint64(0))
+    stream_random(key, 0, 2) # Counter-based, so independent of the global stream
+    stream_keys(key, none)
+    stream_poisson(key, 0, 1.0, 0)
+    stream_negative_binomial(key, 0, 1.0, 0.5, 0)
+    rbt(0.5, 0)
+    mbt(0.5, 0)
+    bf(0.5, none)
+    binomial_filter(floats[:0], none)
+    n_poisson(floats[:0])
+    mt(floats, 0)
+    choose_groups(4, none)
+    weighted_keys(floats[:0])
+    unique_new(ints, np.zeros(4, dtype=np.bool_))
+    cutoffs, aliases = make_alias_table(floats)
+    sample_alias_table(cutoffs, aliases, 0)
+    elapsed = sc.toc(T, output=True)
+    if verbose:
+        print(f'Numba functions warmed up in {elapsed:0.2f} s')
+    return elapsed
+
+
+@nb.njit((nb.float64,), cache=True, nogil=True) # These types can also be declared as a dict, but performance is much slower...?
 def bt(prob):
     ''' A simple Bernoulli (binomial) trial '''
     return np.random.random() < prob # Or rnd.random() < prob, np.random.binomial(1, prob), which seems slower
 
 
-@nb.njit((nb.float64, nb.int64))
+@nb.njit((nb.float64, nb.int64), cache=True, nogil=True)
 def rbt(prob, n):
     ''' A repeated Bernoulli (binomial) trial '''
     return np.random.binomial(1, prob, n)
 
 
-@nb.njit((nb.float64, nb.int64))
+@nb.njit((nb.float64, nb.int64), nogil=True, cache=True)
 def mbt(prob, n):
     ''' Multiple Bernoulli (binomial) trials -- return indices that passed '''
-    return list((np.random.random(n) < prob).nonzero()[0])
+    return (np.random.random(n) < prob).nonzero()[0]
 
 
-@nb.njit((nb.float64, nb.int64[:]))
+@nb.njit((nb.float64, nb.int64[:]), nogil=True, cache=True)
 def bf(prob, arr):
     ''' Bernoulli "filter" -- return entries that passed '''
-    return list(arr[(np.random.random(len(arr)) < prob).nonzero()[0]])
+    return arr[(np.random.random(len(arr)) < prob).nonzero()[0]]
 
-@nb.njit((nb.float64[:], nb.int64))
+@nb.njit((nb.float64[:], nb.int64), cache=True, nogil=True)
 def mt(probs, repeats):
     ''' A multinomial trial '''
     return np.searchsorted(np.cumsum(probs), np.random.random(repeats))
 
 
-@nb.njit((nb.int64,))
+@nb.njit((nb.int64,), cache=True, nogil=True)
 def pt(rate):
     ''' A Poisson trial '''
     return np.random.poisson(rate, 1)[0]
 
 
-@nb.njit((nb.int64, nb.int64))
+@nb.njit((nb.int64, nb.int64), cache=True, nogil=True)
 def choose(max_n, n):
     '''
     Choose a subset of items (e.g., people) without replace.
@@ -144,26 +424,89 @@ def choose(max_n, n):
     return np.random.choice(max_n, n, replace=False)
 
 
+#%% Batch sampling functions -- these work on whole arrays at once, and release the GIL
+
+@nb.njit((nb.float64[:], nb.int64[:]), nogil=True, cache=True)
+def binomial_filter(prob_arr, arr):
+    ''' Bernoulli "filter", with a probability for each entry -- return entries that passed '''
+    return arr[(np.random.random(len(arr)) < prob_arr).nonzero()[0]]
+
+
+@nb.njit((nb.float64[:],), nogil=True, cache=True)
+def n_poisson(rates):
+    '''
+    Poisson trials, each with its own rate -- return the number of events for
+    each, e.g. to use as the sizes of groups for choose_groups()
+    '''
+    counts = np.empty(len(rates), dtype=np.int64)
+    for i in range(len(rates)):
+        counts[i] = np.random.poisson(rates[i])
+    return counts
+
+
+@nb.njit((nb.int64, nb.int64[:]), nogil=True, cache=True)
+def choose_groups(max_n, counts):
+    '''
+    Choose a subset of items (e.g., people) without replacement for each of several
+    groups, e.g. community contacts for each infectious person. Each group's items
+    are unique, but the same item can be in more than one group. Uses Floyd's
+    algorithm, so each group takes time proportional to its size, not to max_n.
+
+    Args:
+        max_n (int): the total number of items
+        counts (array): the number of items to choose for each group (at most max_n)
+
+    Returns:
+        A single array of the items chosen, group by group, i.e. the items for
+        group g are at positions cumsum(counts)[g]-counts[g] to cumsum(counts)[g]
+
+    Example:
+        choose_groups(10, np.array([2, 3])) will choose 2 and then 3 out of 10 people with equal probability.
+    '''
+    chosen = np.empty(counts.sum(), dtype=np.int64)
+    seen = np.zeros(max_n, dtype=np.bool_)
+    pos = 0
+    for count in counts:
+        start = pos
+        for j in range(max_n-count, max_n):
+            item = np.random.randint(0, j+1)
+            if seen[item]:
+                item = j
+            seen[item] = True
+            chosen[pos] = item
+            pos += 1
+        for i in range(start, pos): # Reset for the next group
+            seen[chosen[i]] = False
+    return chosen
+
+
 # @nb.njit((nb.float64[:], nb.int64, nb.float64))
 def choose_weighted(probs, n, overshoot=1.5, eps=1e-6, max_tries=10, normalize=False, unique=True):
     '''
     Choose n items (e.g. people), each with a probability from the distribution probs.
     Overshoot handles the case where there are repeats.
 
+    Unique samples are chosen by drawing with replacement and dropping repeats,
+    which is equivalent to drawing one item at a time and removing it. If that
+    hasn't found enough samples after max_tries (e.g. if most of the probability
+    is on a few items), the rest are chosen with the method of Efraimidis and
+    Spirakis, which is exact and always succeeds: if there are fewer items with
+    nonzero probability than samples requested, the rest are chosen uniformly
+    from the items with zero probability.
+
     Args:
         probs (array): list of probabilities, should sum to 1
         n (int): number of samples to choose
         overshoot (float): number of extra samples to generate, expecting duplicates
         eps (float): how close to check that probabilities sum to 1
-        max_tries (int): maximum number of times to try to pick samples without replacement
+        max_tries (int): maximum number of times to draw samples with replacement before switching method
         normalize (bool): whether or not to normalize probs to always sum to 1
         unique (bool): whether or not to ensure unique indices
 
     Example:
         choose_weighted([0.2, 0.5, 0.1, 0.1, 0.1], 2) will choose 2 out of 5 people with nonequal probability.
 
-    NB: unfortunately pd.unique() is not supported by Numba, nor is
-    np.unique(return_index=True), hence why this function is not jitted.
+    To draw repeatedly from the same weights with replacement, an AliasSampler is faster.
     '''
 
     # Ensure it's the right type and optionally normalize
@@ -189,23 +532,166 @@ def choose_weighted(probs, n, overshoot=1.5, eps=1e-6, max_tries=10, normalize=F
         raise Exception(errormsg)
 
     # Choose samples
-    unique_inds = np.array([], dtype=np.int)
-    tries = 0
-    while len(unique_inds)<n_samples and tries<max_tries:
-        tries += 1
-        raw_inds = mt(probs, int(n_samples*overshoot)) # Return raw indices, with replacement
-        if not unique:
-            return raw_inds
-        mixed_inds = np.hstack((unique_inds, raw_inds))
-        unique_inds = pd.unique(mixed_inds) # Or np.unique(mixed_inds, return_index=True) with another step
-    if tries == max_tries:
-        errormsg = f'Unable to choose {n_samples} unique samples from {n_people} people after {max_tries} tries'
-        raise RuntimeError(errormsg)
-    inds = unique_inds[:int(n)]
+    if not unique:
+        return mt(probs, n_samples) # Return raw indices, with replacement
+    unique_inds = np.zeros(0, dtype=np.int64)
+    if n_samples*overshoot < n_people/10: # Otherwise there would be too many repeats
+        cdf = np.cumsum(probs)
+        seen = np.zeros(n_people, dtype=np.bool_)
+        chosen = []
+        n_chosen = 0
+        for tries in range(max_tries):
+            n_draws = int((n_samples-n_chosen)*overshoot) + 1
+            raw_inds = np.searchsorted(cdf, get_rng().random(n_draws)*cdf[-1], side='right') # Raw indices, with replacement
+            new_inds = unique_new(np.minimum(raw_inds, n_people-1), seen) # Keep the order they were drawn in
+            chosen.append(new_inds)
+            n_chosen += len(new_inds)
+            if n_chosen >= n_samples or len(new_inds) < n_draws/4: # Done, or mostly repeats, so switch methods
+                break
+        unique_inds = np.concatenate(chosen)
+    if len(unique_inds) < n_samples: # Choose the rest exactly from the people not yet chosen
+        remaining = probs.copy()
+        remaining[unique_inds] = 0
+        unique_inds = np.concatenate((unique_inds, _choose_weighted_keys(remaining, n_samples-len(unique_inds))))
+    inds = unique_inds[:n_samples]
 
     return inds
 
 
+@nb.njit((nb.int64[:], nb.boolean[:]), cache=True, nogil=True)
+def unique_new(inds, seen):
+    ''' Return the indices that haven't been seen before (in order, without repeats), and mark them as seen '''
+    new_inds = np.empty(len(inds), dtype=np.int64)
+    n_new = 0
+    for ind in inds:
+        if not seen[ind]:
+            seen[ind] = True
+            new_inds[n_new] = ind
+            n_new += 1
+    return new_inds[:n_new]
+
+
+def _choose_weighted_keys(probs, n):
+    ''' Choose n unique items using Efraimidis-Spirakis keys, filling up with zero-probability items if needed; see choose_weighted() '''
+    keys = weighted_keys(probs)
+    nonzero = (probs > 0).nonzero()[0]
+    if n <= len(nonzero): # Choose the largest keys, in order
+        inds = np.argpartition(-keys, n-1)[:n] if n else np.zeros(0, dtype=np.int64)
+        return inds[np.argsort(-keys[inds], kind='stable')]
+    else: # Choose everyone with nonzero probability, and fill up from everyone else
+        zero = (probs <= 0).nonzero()[0]
+        nonzero = nonzero[np.argsort(-keys[nonzero], kind='stable')]
+        return np.concatenate([nonzero, zero[choose(len(zero), n-len(nonzero))]])
+
+
+@nb.njit((nb.float64[:],), cache=True, nogil=True)
+def weighted_keys(probs):
+    ''' Efraimidis-Spirakis keys for weighted sampling without replacement; see choose_weighted() '''
+    keys = np.empty(len(probs))
+    for i in range(len(probs)):
+        if probs[i] > 0:
+            keys[i] = np.log(np.random.random())/probs[i]
+        else:
+            keys[i] = -np.inf
+    return keys
+
+
+@nb.njit((nb.float64[:],), cache=True, nogil=True)
+def make_alias_table(probs):
+    ''' Build a Walker alias table from the probabilities (which must sum to 1), using Vose's method '''
+    n = len(probs)
+    scaled = probs*n
+    cutoffs = np.ones(n)
+    aliases = np.arange(n)
+    small = np.empty(n, dtype=np.int64)
+    large = np.empty(n, dtype=np.int64)
+    n_small = 0
+    n_large = 0
+    for i in range(n):
+        if scaled[i] < 1.0:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+    while n_small and n_large:
+        n_small -= 1
+        s = small[n_small]
+        n_large -= 1
+        l = large[n_large]
+        cutoffs[s] = scaled[s]
+        aliases[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small[n_small] = l
+            n_small += 1
+        else:
+            large[n_large] = l
+            n_large += 1
+    return cutoffs, aliases # Anything left over has a cutoff of 1 (within rounding error)
+
+
+@nb.njit((nb.float64[:], nb.int64[:], nb.int64), cache=True, nogil=True)
+def sample_alias_table(cutoffs, aliases, n):
+    ''' Draw n samples (with replacement) from a Walker alias table '''
+    n_items = len(cutoffs)
+    samples = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        u = np.random.random()*n_items
+        ind = int(u)
+        if u - ind < cutoffs[ind]:
+            samples[i] = ind
+        else:
+            samples[i] = aliases[ind]
+    return samples
+
+
+class AliasSampler(sc.prettyobj):
+    '''
+    Draw weighted samples with replacement using a Walker alias table. Building
+    the table takes O(N) time, but then each sample takes O(1) time, and the table
+    is only rebuilt when the weights change, so this is fast for drawing from the
+    same weights many times (e.g. choosing who gets tested each day).
+
+    Args:
+        weights (array): the weights of each item; need not be normalized, and if they're all zero, items are chosen uniformly
+
+    Example:
+        sampler = cv.AliasSampler([1, 2, 3, 4])
+        inds = sampler.sample(10)
+        inds = sampler.sample(10, weights=[0, 1, 0, 1]) # Only rebuilds the table if the weights differ
+    '''
+
+    def __init__(self, weights=None):
+        self.weights = None
+        self.cutoffs = None
+        self.aliases = None
+        if weights is not None:
+            self.update(weights)
+        return
+
+
+    def update(self, weights):
+        ''' Set the weights, rebuilding the table if they've changed; returns whether it was rebuilt '''
+        weights = np.array(weights, dtype=np.float64)
+        if self.weights is not None and np.array_equal(weights, self.weights):
+            return False
+        total = weights.sum()
+        probs = weights/total if total else np.ones(len(weights))/len(weights)
+        self.cutoffs, self.aliases = make_alias_table(probs)
+        self.weights = weights
+        return True
+
+
+    def sample(self, n, weights=None):
+        ''' Draw n samples, optionally updating the weights first '''
+        if weights is not None:
+            self.update(weights)
+        if self.weights is None:
+            raise ValueError('No weights have been supplied to sample from')
+        return sample_alias_table(self.cutoffs, self.aliases, int(n))
+
+
 def check_version(expected, die=False, verbose=True, **kwargs):
     '''
     Get current git information and optionally write it to disk.
@@ -226,7 +712,9 @@ def check_version(expected, die=False, verbose=True, **kwargs):
     return compare
 
 
-def git_info(filename=None, check=False, old_info=None, die=False, verbose=True, **kwargs):
+_git_info = None # Cached by git_info(), since looking it up is slow relative to creating a sim
+
+def git_info(filename=None, check=False, old_info=None, die=False, verbose=True, cache=True, **kwargs):
     '''
     Get current git information and optionally write it to disk.
 
@@ -235,12 +723,16 @@ def git_info(filename=None, check=False, old_info=None, die=False, verbose=True,
         check (bool): whether or not to compare two git versions
         old_info (dict): dictionary of information to check against
         die (bool): whether or not to raise an exception if the check fails
+        cache (bool): whether to reuse the information found by a previous call in this process, rather than looking it up again
 
     Example:
         cv.git_info('covasim_version.json') # Writes to disk
         cv.git_info('covasim_version.json', check=True) # Checks that current version matches saved file
     '''
-    info = sc.gitinfo(__file__)
+    global _git_info
+    if _git_info is None or not cache:
+        _git_info = sc.gitinfo(__file__)
+    info = dict(_git_info) # Copy so the cached version can't be modified
     if not check: # Just get information
         if filename is not None:
             output = sc.savejson(filename, info, **kwargs)
@@ -261,6 +753,7 @@ def git_info(filename=None, check=False, old_info=None, die=False, verbose=True,
 
 def fixaxis(sim, useSI=True, boxoff=False):
     ''' Make the plotting more consistent -- add a legend and ensure the axes start at 0 '''
+    import pylab as pl # Imported here since plotting is not needed by most runs
     delta = 0.5
     pl.legend() # Add legend
     sc.setylim() # Rescale y to start at 0
@@ -448,6 +941,7 @@ def poisson_test(count1, count2, exposure1=1, exposure2=1, ratio_null=1,
     Biometrical Journal 50 (2008) 2, 2008
 
     '''
+    import scipy.stats as sps # Imported here since SciPy is slow to import and rarely needed
 
     # Copied from statsmodels.stats.weightstats
     def zstat_generic2(value, std_diff, alternative):
@@ -21,6 +21,7 @@ import scirisweb as sw
 app = sw.ScirisApp(__name__, name="Covasim")
 app.sessions = dict() # For storing user data
 flask_app = app.flask_app
+cv.warmup() # Compile the Numba functions before the first request
 
 #%% Define the API
 
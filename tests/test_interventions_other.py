@@ -3,6 +3,8 @@ Testing the effect of testing interventions in Covasim
 '''
 
 #%% Imports and settings
+import pytest
+import pandas as pd
 import sciris as sc
 import covasim as cv
 
@@ -117,12 +119,115 @@ def test_borderclosure(do_plot=False, do_show=True, do_save=False, fig_path=None
     return scens
 
 
+def test_schedule():
+    sc.heading('Test of the intervention schedule')
+
+    daily_tests = pd.Series([0, 10, 0, 20], index=pd.date_range('2020-03-02', '2020-03-05'))
+    beta = cv.change_beta(days=[5, 10], changes=[0.5, 1.0])
+    pars = cv.dynamic_pars({'diag_factor':{'days':7, 'vals':0.5}})
+    tests = cv.test_num(daily_tests=daily_tests)
+    sim = cv.Sim(pop_size=500, n_days=20, start_day='2020-03-01', interventions=[beta, pars, tests])
+    sim.initialize()
+
+    # Check that each intervention is only scheduled on the days it does something
+    days = {type(intervention).__name__:[] for intervention in sim['interventions']}
+    for t,interventions in enumerate(sim.intervention_schedule):
+        for intervention in interventions:
+            days[type(intervention).__name__].append(t)
+    assert days == {'change_beta':[5, 10], 'dynamic_pars':[7], 'test_num':[2, 4]}
+
+    # Check that the pars changes are still applied
+    sim.run(verbose=0)
+    assert sim['beta'] == beta.orig_betas['overall']
+    assert sim['diag_factor'] == 0.5
+    assert sim.results['new_tests'].values.sum() == 30
+
+    # Duplicate days are caught before the sim runs
+    with pytest.raises(ValueError):
+        cv.Sim(pop_size=100, interventions=cv.dynamic_pars({'beta':{'days':[3, 3], 'vals':[0.1, 0.2]}})).initialize()
+
+    # Interventions only need an apply() method, in which case they're applied every day
+    class count_days:
+        def __init__(self):
+            self.days = []
+        def apply(self, sim):
+            self.days.append(sim.t)
+
+    counter = count_days()
+    sim2 = cv.Sim(pop_size=100, n_days=10, interventions=[counter, cv.sequence(days=[5, 10], interventions=[count_days(), count_days()])])
+    sim2.run(verbose=0)
+    assert counter.days == list(range(sim2.npts))
+
+    # Interventions set after the sim is initialized are still applied
+    pars = dict(pop_size=1000, n_days=20, rand_seed=1)
+    ref = cv.Sim(pars, interventions=cv.change_beta(days=0, changes=0.0))
+    ref.run(verbose=0)
+    sim3 = cv.Sim(pars)
+    sim3.initialize()
+    sim3['interventions'] = [cv.change_beta(days=0, changes=0.0)]
+    sim3.run(verbose=0)
+    assert sim3.results['cum_infections'][-1] == ref.results['cum_infections'][-1]
+    sim4 = cv.Sim(pars)
+    sim4.initialize()
+    single = cv.single_run(sim4, sim_args={'interventions':[cv.change_beta(days=0, changes=0.0)]})
+    assert single.results['cum_infections'][-1] == ref.results['cum_infections'][-1]
+    sim5 = cv.Sim(pars)
+    sim5.initialize()
+    counter = count_days()
+    for t in range(sim5.npts):
+        if t == 5:
+            sim5['interventions'].append(counter) # Added part-way through the run
+        sim5.next()
+    assert counter.days == list(range(5, sim5.npts))
+
+    return sim
+
+
+def test_array_intervention():
+    sc.heading('Test of array interventions')
+
+    class quarantine_symptomatic(cv.ArrayIntervention):
+        reads  = ['symptomatic']
+        writes = ['date_known_contact']
+
+        def initialize(self, sim):
+            self.n_symptomatic = 0
+            super().initialize(sim)
+
+        def apply_arrays(self, sim, arrays, events):
+            self.n_symptomatic += len(events.symptomatic)
+            arrays.date_known_contact[events.symptomatic] = sim.t
+
+    interv = quarantine_symptomatic()
+    sim = cv.Sim(pop_size=2000, n_days=40, use_layers=True, interventions=[interv, cv.change_beta(days=20, changes=0.5)])
+    sim.run(verbose=0)
+    assert interv.n_symptomatic == sim.results['cum_symptomatic'][-1]
+    assert sim.results['cum_quarantined'][-1] > 0
+    assert all(person.date_known_contact in [None, sim.npts-1] for person in sim.people) # Everyone's been quarantined, except those found on the last day
+
+    # Attributes that aren't stored in arrays are extracted, and the changes written back
+    class flag_elderly(cv.ArrayIntervention):
+        reads  = ['age']
+        writes = ['known_contact']
+
+        def apply_arrays(self, sim, arrays, events):
+            arrays.known_contact[arrays.age > 80] = True
+
+    sim2 = cv.Sim(pop_size=500, n_days=5, interventions=flag_elderly())
+    sim2.run(verbose=0)
+    assert all(person.known_contact == (person.age > 80) for person in sim2.people)
+
+    return sim
+
+
 #%% Run as a script
 if __name__ == '__main__':
     sc.tic()
 
     bed_scens = test_beds(do_plot=do_plot, do_save=do_save, do_show=do_show, fig_path=fig_path)
     border_scens = test_borderclosure(do_plot=do_plot, do_save=do_save, do_show=do_show, fig_path=fig_path)
+    sim = test_schedule()
+    sim2 = test_array_intervention()
 
     sc.toc()
 
@@ -3,6 +3,7 @@ Testing the effect of testing interventions in Covasim
 '''
 
 #%% Imports and settings
+import numpy as np
 import sciris as sc
 import covasim as cv
 
@@ -232,6 +233,98 @@ def test_tracedelay(do_plot=False, do_show=True, do_save=False, fig_path=None):
 
 
 
+def test_people_testing():
+    sc.heading('Test of vectorized testing')
+
+    sim = cv.Sim(pop_size=500, pop_infected=50, n_days=10)
+    sim.initialize()
+    people = sim.people
+    for person in people[:50]:
+        person.infectious = True
+
+    # Everyone infectious tests positive, but results are only ready after the delay
+    inds = np.arange(100)
+    positives = people.test(inds, t=3, test_sensitivity=1.0, test_delay=2)
+    assert np.array_equal(positives, np.arange(50))
+    assert all(person.tested and person.date_tested == [3] for person in people[:100])
+    assert all(person.date_diagnosed == 5 for person in people[:50])
+    assert all(person.date_diagnosed is None for person in people[50:])
+    assert people.check_diagnosed(4) == 0
+    assert people.check_diagnosed(5) == 50
+
+    # Re-testing adds test dates, but doesn't delay an earlier diagnosis
+    people.test(inds, t=6, test_sensitivity=1.0, test_delay=2)
+    assert people[0].date_tested == [3, 6]
+    assert people[0].date_diagnosed == 5
+    assert len(people.arrays['test_log']) == 2 # The tests are logged once per call, not per person
+    assert people[100].date_tested is None
+
+    # The test dates of a person can still be changed directly
+    people[1].date_tested = None
+    people[1].test(t=7, test_sensitivity=0.0)
+    people[2].date_tested = [1, 2]
+    assert people[1].date_tested == [7] and people[2].date_tested == [1, 2] and people[3].date_tested == [3, 6]
+
+    # Results lost to follow-up are not diagnosed
+    people.test([60, 70], t=6, test_sensitivity=1.0, loss_prob=1.0)
+    assert people[60].date_diagnosed is None
+
+    # The states are stored in arrays that people read and write directly
+    assert people.arrays['tested'][:100].all() and not people.arrays['tested'][100:].any()
+    people[80].diagnosed = True
+    assert people.extract_array('diagnosed', dtype=bool)[80]
+    people.set_attr('date_known_contact', [90, 91], 7)
+    assert people[90].date_known_contact == 7
+
+    # Known contacts are quarantined all at once, and released at the end of their quarantine
+    assert people.check_quarantine(7, quar_period=3) == 2
+    assert people[91].quarantined and people[91].end_quarantine == 10 and people[91].date_known_contact is None
+    assert people.check_quarantine(9, quar_period=3) == 0 and people[91].quarantined
+    people.check_quarantine(10, quar_period=3)
+    assert not people[91].quarantined and people[91].end_quarantine is None
+
+    return sim
+
+
+def test_contact_tracing():
+    sc.heading('Test of contact tracing')
+
+    sim = cv.Sim(pop_size=500, pop_infected=0, n_days=10, use_layers=True)
+    sim.initialize()
+    people = sim.people
+    trace_probs = {'h': 1.0, 's': 0.0, 'w': 0.0, 'c': 0.0}
+    trace_time  = {'h': 2,   's': 0,   'w': 0,   'c': 0}
+    tracing = cv.contact_tracing(trace_probs=trace_probs, trace_time=trace_time)
+
+    # Diagnose a few people and check their households are notified once the tracing is done
+    diag_inds = np.arange(5)
+    household = np.setdiff1d(np.concatenate([people[i].contacts['h'] for i in diag_inds]), diag_inds)
+    people.set_attr('date_diagnosed', diag_inds, 2)
+    sim.t = 3
+    tracing.apply(sim)
+    assert all(people[i].date_known_contact is None for i in household) # Due on day 5, so not yet
+    sim.t = 4
+    tracing.apply(sim)
+    assert all(people[i].date_known_contact == 5 for i in household)
+    assert 'InterventionType' in tracing.to_json()
+
+    # Check that only the most recent community contacts are kept
+    history = cv.ContactHistory(window=2)
+    history.add(t=0, sources=[0, 0, 3], targets=[5, 8, 2])
+    history.add(t=1, sources=[3, 1], targets=[7, 9])
+    assert sorted(history.find_contacts([0, 3], t=1)) == [2, 5, 7, 8]
+    history.add(t=2, sources=[0], targets=[6])
+    assert sorted(history.find_contacts([0, 3], t=2)) == [6, 7]
+
+    # Check that a sim with community tracing runs, and keeps its history bounded
+    tracing = cv.contact_tracing(trace_probs={**trace_probs, 'c': 0.5}, trace_time={**trace_time, 'c': 3})
+    sim = cv.Sim(pop_size=1000, n_days=30, use_layers=True, interventions=[cv.test_prob(symptomatic_prob=0.5), tracing])
+    sim.run(verbose=0)
+    assert sim.contact_history.window == 3
+
+    return sim
+
+
 #%% Run as a script
 if __name__ == '__main__':
     sc.tic()
@@ -239,6 +332,8 @@ if __name__ == '__main__':
     #scens1 = test_interventions(do_plot=do_plot, do_save=do_save, do_show=do_show, fig_path=fig_paths[0])
 #    scens2 = test_turnaround(do_plot=do_plot, do_save=do_save, do_show=do_show, fig_path=fig_paths[1])
     scens3 = test_tracedelay(do_plot=do_plot, do_save=do_save, do_show=do_show, fig_path=fig_paths[2])
+    sim    = test_people_testing()
+    sim2   = test_contact_tracing()
 
     sc.toc()
 
@@ -4,6 +4,11 @@ Simple example usage for the Covid-19 agent-based model
 
 #%% Imports and settings
 import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pytest
 import sciris as sc
 import covasim as cv
 
@@ -48,6 +53,55 @@ def test_multirun(do_plot=False): # If being run via pytest, turn off
     return sims
 
 
+def test_shared_population():
+    sc.heading('Shared population test')
+
+    n_runs = 3
+    sim = cv.Sim(pop_size=1000, n_days=20, pop_type='realistic')
+    sims = cv.multi_run(sim=sim, n_runs=n_runs, keep_people=True, share_population=True)
+
+    # Every run should have used the same population, but with different seeds
+    assert len(sims) == n_runs
+    ages = [s.people.extract('age') for s in sims]
+    for s in range(1, n_runs):
+        assert ages[s] == ages[0], 'Shared population differs between runs'
+    assert sims[0]['rand_seed'] != sims[1]['rand_seed']
+
+    # The sim and the random number streams of the caller are left as they were
+    assert sim.popdict is None and not sim.initialized
+    ref = cv.Sim(pop_size=1000, n_days=20, pop_type='realistic')
+    ref.initialize()
+    assert ages[0] == ref.people.extract('age')
+    cv.set_seed(5)
+    expected = [np.random.random(), cv.utils.rbt(0.5, 10).tolist()]
+    cv.set_seed(5)
+    cv.multi_run(sim=sim, n_runs=2, share_population=True, reduce=True)
+    assert [np.random.random(), cv.utils.rbt(0.5, 10).tolist()] == expected, 'multi_run() changed the random number streams'
+
+    # If the sim already has a population, it's shared too, rather than sent to the workers with every batch
+    class SizingExecutor(cv.ProcessExecutor):
+        def imap(self, func, items, shared=None):
+            self.shared_size = len(pickle.dumps(shared))
+            return super().imap(func, items, shared=shared)
+
+        def imap_unordered(self, func, items, shared=None):
+            self.shared_size = len(pickle.dumps(shared))
+            return super().imap_unordered(func, items, shared=shared)
+
+    for pop_size in [1000, 8000]:
+        sim = cv.Sim(pop_size=pop_size, n_days=20, pop_type='realistic')
+        sim.initialize()
+        with SizingExecutor(ncpus=2) as executor:
+            sims = cv.multi_run(sim=sim, n_runs=2, keep_people=True, executor=executor)
+            assert executor.shared_size < 20e3, f'The population was sent with the jobs ({executor.shared_size} bytes)'
+            assert sims[0].people.extract('age') == sim.people.extract('age')
+            scens = cv.Scenarios(sim=sim, metapars={'n_runs':2})
+            scens.run(executor=executor, verbose=0)
+            assert executor.shared_size < 20e3, f'The population was sent with the scenarios ({executor.shared_size} bytes)'
+
+    return sims
+
+
 def test_scenarios(do_plot=False):
     sc.heading('Scenarios test')
     basepars = {'pop_size':1000}
@@ -91,6 +145,330 @@ def test_combine(do_plot=False): # If being run via pytest, turn off
     return sim
 
 
+def test_replicate_stats():
+    sc.heading('Streaming summary statistics test')
+
+    # Compare to the statistics of the full data
+    np.random.seed(1)
+    npts, n = 5, 1000
+    data = np.random.lognormal(size=(npts, n))
+    stats = [cv.ReplicateStats(['x'], npts) for i in range(2)]
+    for i in range(n):
+        stats[i%2].add({'x':data[:,i]})
+    stats[0].merge(stats[1])
+    assert stats[0].n == n
+    assert np.allclose(stats[0].mean('x'), data.mean(axis=1))
+    assert np.allclose(stats[0].var('x'), data.var(axis=1, ddof=1))
+    for q in [0.1, 0.5, 0.9]:
+        estimate = stats[0].quantile('x', q=q)
+        ranks = (data < estimate[:,None]).mean(axis=1)
+        assert np.all(abs(ranks - q) < 0.03), f'Quantile {q} estimated at ranks {ranks}'
+
+    # Up to the capacity, the quantiles are exact
+    sketch = cv.QuantileSketch(npts)
+    for i in range(sketch.capacity):
+        sketch.add(data[:,i])
+        if i in [9, sketch.capacity-1]:
+            assert np.array_equal(sketch.quantile(0.1), np.quantile(data[:,:i+1], 0.1, axis=1))
+
+    # Scenarios give the same results without keeping the sims
+    basepars = {'pop_size':1000, 'n_days':20}
+    scens = [cv.Scenarios(basepars=basepars, metapars={'n_runs':3}) for i in range(2)]
+    scens[0].run(verbose=0)
+    scens[1].run(keep_sims=False, verbose=0)
+    assert not scens[1].sims['baseline']
+    for reskey in ['cum_infections', 'new_infections']:
+        r0, r1 = scens[0].results[reskey]['baseline'], scens[1].results[reskey]['baseline']
+        assert np.allclose(r0.best, r1.best)
+        assert np.array_equal(r0.low, r1.low)
+        assert np.array_equal(r0.high, r1.high)
+
+    return stats[0]
+
+
+def test_scenario_pool():
+    sc.heading('Running all scenarios in one pool')
+
+    basepars = {'pop_size':1000, 'n_days':20}
+    scenarios = {
+        'baseline': {'name':'Baseline', 'pars':{}},
+        'bigger':   {'name':'Bigger', 'pars':{'pop_size':2000}},
+    }
+    scens = cv.Scenarios(basepars=basepars, metapars={'n_runs':3}, scenarios=scenarios)
+    scens.run(ncpus=2, verbose=0)
+    assert cv.estimate_cost(scens.sims['bigger'][0]) > cv.estimate_cost(scens.sims['baseline'][0])
+
+    # Check that the results were routed to the right scenario and run
+    for scenkey,sims in scens.sims.items():
+        assert [sim['rand_seed'] for sim in sims] == [1, 2, 3]
+        assert all(sim['pop_size'] == scenarios[scenkey]['pars'].get('pop_size', 1000) for sim in sims)
+        sim = cv.single_run(cv.Sim(sc.mergedicts(basepars, scenarios[scenkey]['pars'])), ind=1, noise=0.1, verbose=0)
+        assert np.array_equal(sims[1].results['cum_infections'].values, sim.results['cum_infections'].values)
+
+    return scens
+
+
+def test_runner():
+    sc.heading('Persistent worker pool')
+
+    pars = {'pop_size':1000, 'n_days':20}
+    with cv.Runner(cv.Sim(pars), ncpus=2) as runner:
+        pids = [worker.pid for worker in runner.pool._pool]
+        results = runner.run([{'seed':1}, {'pars':{'beta':0.02}, 'seed':1}, ({'beta':0.02}, 1), 2])
+        stats = runner.run([{'seed':seed} for seed in range(4)], reduce=True)
+        sims = cv.multi_run(cv.Sim(pars), n_runs=2, executor=runner)
+        assert [worker.pid for worker in runner.pool._pool] == pids # The same workers were used throughout
+
+    base = cv.Sim(pars)
+    base.validate_pars()
+    base.set_seed()
+    base.popdict = cv.make_popdict(base)
+    sim = cv.Sim.from_template(base, keep_population=True)
+    sim.run(verbose=0)
+    cum_inf = [res['cum_infections'] for res in results]
+    assert np.array_equal(cum_inf[0], sim.results['cum_infections'].values) # Same as a run with a population created in advance
+    assert cum_inf[1][-1] > cum_inf[0][-1]
+    assert np.array_equal(cum_inf[1], cum_inf[2])
+    assert not np.array_equal(cum_inf[0], cum_inf[3])
+    assert stats.n == 4 and runner.n_jobs == 8
+    assert len(sims) == 2 and runner.pool is None
+
+    # Interventions that change nested parameters don't carry over from one job to the next
+    base = cv.Sim(pars, use_layers=True, interventions=cv.change_beta(days=5, changes=0.5, layers=['h', 'c']))
+    with cv.Runner(base, ncpus=1) as runner:
+        repeats = runner.run([1, 1, 1])
+    for res in repeats[1:]:
+        assert np.array_equal(res['cum_infections'], repeats[0]['cum_infections'])
+
+    return results
+
+
+def test_executors():
+    sc.heading('Executor backends')
+
+    sim = cv.Sim(pop_size=1000, n_days=20)
+    iterpars = {'beta':[0.01, 0.015, 0.02]}
+    with cv.SerialExecutor() as executor:
+        expected = [s.results['cum_infections'].values for s in cv.multi_run(sim, iterpars=iterpars, executor=executor)]
+
+    executors = [cv.ThreadExecutor(n_workers=3), cv.ProcessExecutor(ncpus=2), cv.SocketExecutor.local(n_workers=2)]
+    for executor in executors:
+        with executor:
+            sims = cv.multi_run(sim, iterpars=iterpars, executor=executor)
+            for s,values in zip(sims, expected):
+                assert np.array_equal(s.results['cum_infections'].values, values), f'{executor} gave different results'
+            stats = cv.multi_run(sim, iterpars=iterpars, executor=executor, reduce=True)
+            assert np.allclose(stats.mean('cum_infections'), np.mean(expected, axis=0))
+
+    # Single runs, scenarios, and errors on remote workers
+    with cv.SocketExecutor.local(n_workers=2) as executor:
+        single = cv.single_run(sim, ind=1, sim_args={'beta':0.015}, executor=executor)
+        assert np.array_equal(single.results['cum_infections'].values, expected[1])
+        scens = cv.Scenarios(sim=cv.Sim(pop_size=1000, n_days=20), metapars={'n_runs':2})
+        scens.run(executor=executor, verbose=0)
+        assert len(scens.sims['baseline']) == 2
+        with pytest.raises(RuntimeError):
+            cv.multi_run(sim, n_runs=2, sim_args={'not_a_parameter':1}, executor=executor)
+        assert len(executor.authkey) == 32 # A random key
+    assert not executor.processes
+    with pytest.raises(ValueError):
+        cv.SocketExecutor([('localhost', 6000)], authkey='') # There's no default key
+
+    return sims
+
+
+def test_memory_planning():
+    sc.heading('Sizing the number of workers to the memory')
+
+    small = cv.Sim(pop_size=1000)
+    large = cv.Sim(pop_size=100000, use_layers=True)
+    mem_small, mem_large = cv.estimate_memory(small), cv.estimate_memory(large, keep_people=True)
+    assert mem_small.worker < mem_large.worker
+    assert mem_small.kept == 0 and mem_large.kept > 0
+
+    budget = 4*mem_large.worker + 10*mem_large.kept
+    assert cv.plan_workers(small, n_runs=10, memory_budget=budget, ncpus=8) == 8
+    assert cv.plan_workers(small, n_runs=3, memory_budget=budget, ncpus=8) == 3
+    assert cv.plan_workers(large, n_runs=10, memory_budget=4*mem_large.worker, ncpus=8) == 4
+    assert cv.plan_workers(large, n_runs=10, keep_people=True, memory_budget=budget, ncpus=8) == 4
+    assert cv.plan_workers(large, n_runs=20, keep_people=True, memory_budget=budget, ncpus=8) == 1 # Too much to keep, but always at least one
+
+    # Workers limit their threads
+    with cv.ProcessExecutor(ncpus=2, threads_per_worker=1) as executor:
+        assert executor.map(os.getenv, ['OMP_NUM_THREADS']*2) == ['1', '1']
+
+    return mem_large
+
+
+def test_threads():
+    sc.heading('Running sims in threads')
+
+    # Each thread has its own random number stream
+    def draw(seed):
+        cv.set_seed(seed)
+        return cv.get_rng().random(3), cv.utils.bf(0.5, np.arange(10))
+    cv.set_seed(1)
+    main = draw(1)
+    with cv.ThreadExecutor(n_workers=4) as executor:
+        draws = executor.map(draw, [1]*8)
+    for thread_draw in draws:
+        assert np.array_equal(thread_draw[0], main[0]) and np.array_equal(thread_draw[1], main[1])
+
+    # Sims sharing a population in threads give the same results as in series
+    sim = cv.Sim(pop_size=2000, n_days=30, use_layers=True)
+    sim.validate_pars()
+    sim.set_seed()
+    sim.popdict = cv.make_popdict(sim)
+    with cv.ThreadExecutor(n_workers=4) as executor:
+        sims = cv.multi_run(sim, n_runs=4, keep_people=True, executor=executor)
+    with cv.SerialExecutor() as executor:
+        expected = cv.multi_run(sim, n_runs=4, keep_people=True, executor=executor)
+    for s1,s2 in zip(sims, expected):
+        assert np.array_equal(s1.results['cum_infections'].values, s2.results['cum_infections'].values)
+        assert s1.people[0].contacts is not s2.people[0].contacts
+        assert s1.people[0].contacts['h'] is sim.popdict['contacts'][0]['h'] # The arrays are shared, not copied
+    assert 'c' not in sim.popdict['contacts'][0] # Community contacts are stored in each person's own copy
+
+    return sims
+
+
+def test_ensemble():
+    sc.heading('Running replicates as one vectorized ensemble')
+
+    # The ensemble results should be distributed like the results of separate runs
+    sim = cv.Sim(pop_size=2000, n_days=40, verbose=0)
+    ens = cv.Ensemble(sim, n_runs=40)
+    ens.run()
+    assert ens.results['cum_infections'].values.shape == (sim.npts, 40)
+    assert sim.popdict is None and not sim.results # The sim itself isn't modified
+    sims = cv.multi_run(sim, n_runs=8, verbose=0)
+    for key in ['cum_infections', 'n_infectious', 'cum_symptomatic']:
+        ens_final = ens.results[key].values[-1]
+        sim_final = np.array([s.results[key].values[-1] for s in sims])
+        assert abs(ens_final.mean() - sim_final.mean()) < 3*np.sqrt(ens_final.var()/40 + sim_final.var()/8) + 1
+
+    # Scenarios can use the ensemble results directly
+    scens = cv.Scenarios(basepars={'pop_size':1000, 'n_days':20}, metapars={'n_runs':20})
+    scens.run(ensemble=True, verbose=0)
+    res = scens.results['cum_infections']['baseline']
+    assert np.all(res.low <= res.best) and np.all(res.best <= res.high)
+
+    # Interventions aren't supported
+    with pytest.raises(NotImplementedError):
+        cv.Ensemble(cv.Sim(interventions=cv.change_beta(days=10, changes=0.5))).initialize()
+
+    return ens
+
+
+def test_adaptive_runs():
+    sc.heading('Adding runs until the scenario results converge')
+
+    basepars = {'pop_size':1000, 'n_days':30}
+    scenarios = {
+        'quiet': {'name':'No transmission', 'pars':{'beta':0}},
+        'noisy': {'name':'Transmission', 'pars':{}},
+    }
+    metapars = {'n_runs':3, 'max_runs':12, 'rtol':0.01}
+    scens = cv.Scenarios(basepars=basepars, metapars=metapars, scenarios=scenarios)
+    scens.run(ncpus=2, verbose=0)
+    assert scens.n_runs_used['quiet'] == 6 # Converged after the second batch
+    assert scens.n_runs_used['noisy'] == 12 # Reached max_runs
+    assert [sim['rand_seed'] for sim in scens.sims['noisy']] == list(range(1, 13))
+
+    # Without keeping the sims, the same runs are summarized
+    stats_scens = cv.Scenarios(basepars=basepars, metapars=metapars, scenarios=scenarios)
+    stats_scens.run(ncpus=2, keep_sims=False, verbose=0)
+    assert stats_scens.n_runs_used == scens.n_runs_used
+    assert np.allclose(stats_scens.results['cum_infections']['noisy'].best, scens.results['cum_infections']['noisy'].best)
+
+    return scens
+
+
+def test_crn():
+    sc.heading('Common random numbers across scenarios')
+
+    # Random streams depend only on their seed, name, and keys
+    assert np.array_equal(cv.RandomStream(1, 'transmission', 3, 10).random(5), cv.RandomStream(1, 'transmission', 3, 10).random(5))
+    assert not np.array_equal(cv.RandomStream(1, 'transmission', 3, 10).random(5), cv.RandomStream(1, 'transmission', 3, 11).random(5))
+
+    # The keys of many streams can be computed at once, e.g. for everyone on a given day
+    keys = cv.RandomStream(1, 'transmission', 3).keys([10, 11])
+    assert keys[1] == cv.RandomStream(1, 'transmission', 3, 11).key
+    assert np.array_equal(cv.RandomStream.from_key(keys[0]).random(5), cv.RandomStream(1, 'transmission', 3, 10).random(5))
+
+    # Poisson and negative binomial numbers are also drawn from the stream itself
+    assert np.array_equal(cv.RandomStream(1, 'importation').poisson(3.0, size=5), cv.RandomStream(1, 'importation').poisson(3.0, size=5))
+    stream = cv.RandomStream(1, 'importation')
+    for lam in [0.5, 3.0, 50.0]: # Small and large means use different methods
+        samples = stream.poisson(lam, size=20000)
+        assert abs(samples.mean() - lam) < 0.05*lam and abs(samples.var() - lam) < 0.1*lam
+    samples = cv.utils.sample(dist='neg_binomial', par1=2, par2=0.25, size=20000, rng=stream) # Mean 6, variance 24
+    assert abs(samples.mean() - 6) < 0.3 and abs(samples.var() - 24) < 2.4
+
+    # With common random numbers, the differences between paired runs of two scenarios are less noisy
+    pars = dict(pop_size=2000, n_days=40, n_imports=1, use_layers=True, verbose=0)
+    base = cv.Sim(pars)
+    diffs = {}
+    for crn in [False, True]:
+        sims1 = cv.multi_run(base, n_runs=6, crn=crn, keep_people=True, verbose=0)
+        sims2 = cv.multi_run(cv.Sim(pars, beta=0.014), n_runs=6, crn=crn, keep_people=True, verbose=0)
+        diffs[crn] = np.array([s1.results['cum_infections'][-1] - s2.results['cum_infections'][-1] for s1,s2 in zip(sims1, sims2)])
+        if crn:
+            for s1,s2 in zip(sims1, sims2): # The populations and seed infections are the same...
+                assert [p.age for p in s1.people] == [p.age for p in s2.people]
+                assert [p.date_recovered for p in s1.people[:10]] == [p.date_recovered for p in s2.people[:10]]
+    assert diffs[True].std() < diffs[False].std() # ...so the differences are mostly due to beta
+    assert not base['crn'] # The sim passed to multi_run() isn't modified
+
+    # Scenarios can also use common random numbers
+    scens = cv.Scenarios(basepars={'pop_size':1000, 'n_days':20}, metapars={'n_runs':2, 'crn':True})
+    scens.run(verbose=0)
+    assert all(sim['crn'] for sim in scens.sims['baseline'])
+
+    return diffs
+
+
+def test_job_specs():
+    sc.heading('Sending compact job specs to the workers')
+
+    # The spec only has the parameters that differ from the defaults, and rebuilds the same sim
+    sim = cv.Sim(pop_size=1000, n_days=20, use_layers=True, contacts={'h':2, 's':10, 'w':10, 'c':5})
+    spec = cv.make_job_spec(sim)
+    assert {'pop_size', 'n_days', 'use_layers', 'contacts'} <= set(spec.pars.keys()) <= {'pop_size', 'n_days', 'use_layers', 'contacts', 'beta_layers', 'prognoses'}
+    new_sim = cv.sim_from_spec(spec)
+    assert new_sim['contacts'] == sim['contacts']
+    sim.run(verbose=0)
+    new_sim.run(verbose=0)
+    assert np.array_equal(sim.results['cum_infections'].values, new_sim.results['cum_infections'].values)
+
+    # With a shared population, the size of the spec doesn't depend on the population size
+    sizes = []
+    for pop_size in [1000, 4000]:
+        sim = cv.Sim(pop_size=pop_size, n_days=10)
+        sim.initialize()
+        with cv.SharedPopulation(sim.popdict) as population:
+            sizes.append(len(pickle.dumps(cv.make_job_spec(sim, population=population))))
+            sims = cv.multi_run(sim, n_runs=2, share_population=population, verbose=0)
+            assert sims[0].people is None # Only the results are sent back
+    assert abs(sizes[1] - sizes[0]) < 100
+
+    # Binary populations are referenced by their folder
+    sim = cv.Sim(pop_size=1000, n_days=10)
+    sim.initialize()
+    folder = tempfile.mkdtemp()
+    try:
+        sim.save_population(folder, binary=True)
+        loaded = cv.Sim(pop_size=1000, n_days=10, popfile=folder)
+        spec = cv.make_job_spec(loaded)
+        assert spec.population == folder
+        sims = cv.multi_run(loaded, n_runs=2, verbose=0)
+        assert sims[0]['rand_seed'] == 1 and sims[1]['rand_seed'] == 2
+    finally:
+        shutil.rmtree(folder)
+
+    return spec
+
+
 #%% Run as a script
 if __name__ == '__main__':
     T = sc.tic()
@@ -99,7 +477,18 @@ if __name__ == '__main__':
     sim2  = test_combine(do_plot=do_plot)
     sims1  = test_multirun(do_plot=do_plot)
     sims2 = test_combine(do_plot=do_plot)
+    sims3 = test_shared_population()
     scens = test_scenarios(do_plot=do_plot)
+    stats = test_replicate_stats()
+    scens = test_scenario_pool()
+    res   = test_runner()
+    sims4 = test_executors()
+    mem   = test_memory_planning()
+    sims5 = test_threads()
+    ens   = test_ensemble()
+    scens = test_adaptive_runs()
+    diffs = test_crn()
+    spec  = test_job_specs()
 
     sc.toc(T)
 
@@ -4,7 +4,9 @@ Simple example usage for the Covid-19 agent-based model
 
 #%% Imports and settings
 import os
+import shutil
 import pytest
+import numpy as np
 import sciris as sc
 import covasim as cv
 
@@ -95,6 +97,104 @@ def test_fileio():
     return json
 
 
+def test_population_binary():
+    sc.heading('Test binary population format')
+
+    obj_path = 'test_covasim.pop'
+    bin_path = 'test_covasim_pop'
+    pars = {'pop_size': 1000, 'pop_type': 'realistic', 'n_days': 20}
+
+    # Create a population and save it in both formats
+    sim = cv.Sim(pars)
+    sim.initialize()
+    sim.save_population(obj_path)
+    sim.save_population(bin_path, binary=True)
+
+    # Load the binary version back via memory-mapping and check it matches
+    sim1 = cv.Sim(pars, popfile=obj_path)
+    sim2 = cv.Sim(pars, popfile=bin_path)
+    assert isinstance(sim2.popdict['contacts'], cv.CSRContacts)
+    assert (sim2.popdict['age'] == sim1.popdict['age']).all()
+    for p in [0, 500, 999]:
+        for key in sim1.popdict['contact_keys']:
+            assert (sim2.popdict['contacts'][p][key] == sim1.popdict['contacts'][p][key]).all()
+
+    # Check that a sim runs identically from both copies
+    sim1.run(verbose=0)
+    sim2.run(verbose=0)
+    key = 'cum_infections'
+    assert (sim1.results[key][:] == sim2.results[key][:]).all(), 'Results from the binary population do not match'
+
+    print(f'Removing {obj_path} and {bin_path}')
+    os.remove(obj_path)
+    shutil.rmtree(bin_path)
+
+    return sim2
+
+
+def test_population_chunked():
+    sc.heading('Test out-of-core population generation')
+
+    pop_path = 'test_covasim_chunked_pop'
+    pop_size = 2500
+    chunk_size = 700 # Deliberately not a factor of the population size
+
+    # Generate the population in chunks, writing it to disk as it goes
+    sim = cv.Sim(pop_size=pop_size, pop_type='realistic', n_days=20)
+    sim.initialize(popfile=pop_path, chunk_size=chunk_size)
+    contacts = sim.popdict['contacts']
+    assert len(sim.people) == pop_size
+    assert isinstance(contacts[0], cv.ContactRow)
+
+    # Check the layers are consistent: households are symmetric, and only school-age people have school contacts
+    ages = sim.popdict['age']
+    for key in sim.contact_keys:
+        indptr, indices = contacts.layer(key)
+        assert indptr[-1] == len(indices)
+        assert len(indices) == 0 or indices.max() < pop_size
+    indptr, indices = contacts.layer('h')
+    for p in range(100):
+        for q in indices[indptr[p]:indptr[p+1]]:
+            assert p in indices[indptr[q]:indptr[q+1]], 'Household contacts are not symmetric'
+    indptr, indices = contacts.layer('s')
+    assert ((ages[indices] >= 6) * (ages[indices] < 18)).all()
+
+    sim.run(verbose=0)
+
+    print(f'Removing {pop_path}')
+    shutil.rmtree(pop_path)
+
+    return sim
+
+
+def test_synthpop_conversion():
+    sc.heading('Test conversion of synthpops populations')
+
+    # A tiny population in the synthpops format, with string UIDs
+    population = {
+        'x': {'age':35, 'sex':0, 'contacts':{'H':{'y', 'z'}, 'S':set(), 'W':{'w'}, 'C':set()}},
+        'y': {'age':8,  'sex':1, 'contacts':{'H':{'x', 'z'}, 'S':set(), 'W':set(), 'C':{'w'}}},
+        'z': {'age':6,  'sex':0, 'contacts':{'H':{'x', 'y'}, 'S':set(), 'W':set(), 'C':set()}},
+        'w': {'age':50, 'sex':1, 'contacts':{'H':set(),      'S':set(), 'W':{'x'}, 'C':{'y'}}},
+        }
+    popdict = cv.synthpop_to_popdict(population)
+    inds = {uid:i for i,uid in enumerate(population.keys())}
+
+    # Check that every contact was mapped to the right index
+    assert list(popdict['age']) == [35, 8, 6, 50]
+    for uid,person in population.items():
+        for sp_key,key in zip(['H', 'S', 'W', 'C'], ['h', 's', 'w', 'c']):
+            expected = sorted(inds[c] for c in person['contacts'][sp_key])
+            assert sorted(popdict['contacts'][inds[uid]][key]) == expected
+
+    # Contacts outside the population are an error
+    population['w']['contacts']['C'].add('nobody')
+    with pytest.raises(ValueError):
+        cv.synthpop_to_popdict(population)
+
+    return popdict
+
+
 def test_start_stop(): # If being run via pytest, turn off
     sc.heading('Test starting and stopping')
 
@@ -153,6 +253,65 @@ def test_dynamic_resampling(do_plot=False, do_show=False): # If being run via py
     return sim
 
 
+def test_reset():
+    sc.heading('Test resetting a sim for replicate runs')
+
+    pars = dict(pop_size=2000, n_days=40, interventions=cv.change_beta(days=20, changes=0.5))
+    sim = cv.Sim(pars)
+    beta = sim['beta']
+    sim.run(verbose=0)
+    people = sim.people
+    ages = [person.age for person in people]
+
+    results = []
+    for i in range(2):
+        sim.reset(seed=2, verbose=0)
+        assert sim['beta'] == beta # Check the intervention's change was undone
+        assert sim.people is people
+        assert sum(person.susceptible for person in sim.people) == sim['pop_size'] - sim['pop_infected']
+        sim.run(verbose=0)
+        results.append(sim.results['cum_infections'].values.copy())
+
+    assert np.array_equal(results[0], results[1])
+    assert [person.age for person in sim.people] == ages
+    sim.reset(seed=3, verbose=0)
+    sim.run(verbose=0)
+    assert not np.array_equal(results[0], sim.results['cum_infections'].values)
+
+    return sim
+
+
+def test_from_template():
+    sc.heading('Test creating sims from a template')
+
+    base = cv.Sim(pop_size=1000, n_days=30, use_layers=True, interventions=[cv.change_beta(days=10, changes=0.5)])
+    assert cv.git_info() == base.git_info # Cached, but still correct
+    assert cv.get_prognoses() is not cv.get_prognoses() # Each caller gets its own copy
+
+    sims = [cv.Sim.from_template(base, beta=beta) for beta in [0.01, 0.02]]
+    for sim in sims:
+        assert sim.pars is not base.pars
+        assert sim['contacts'] == base['contacts'] # Layers carried over, not reset to the defaults
+        assert sim['interventions'][0] is not base['interventions'][0]
+        sim.run(verbose=0)
+    assert base['beta'] == 0.015 # Unchanged by the new sims or their interventions
+    assert sims[0].results['cum_infections'][-1] < sims[1].results['cum_infections'][-1]
+
+    # Interventions that change nested parameters in place don't affect the template
+    base_layers = sc.dcp(base['beta_layers'])
+    base['interventions'] = [cv.change_beta(days=10, changes=0.5, layers=['h', 'c'])]
+    sim = cv.Sim.from_template(base)
+    sim.run(verbose=0)
+    assert sim['beta_layers']['h'] == 0.5*base_layers['h']
+    assert base['beta_layers'] == base_layers
+
+    # Templates can be parameter dicts too, and metaparameters still work
+    sim = cv.Sim.from_template(dict(pop_size=500, n_days=10), prog_by_age=False)
+    assert len(sim['prognoses']['age_cutoffs']) == 1
+    sim.run(verbose=0)
+
+    return sims
+
 
 #%% Run as a script
 if __name__ == '__main__':
@@ -162,9 +321,14 @@ if __name__ == '__main__':
     sim0  = test_microsim()
     sim1  = test_sim(do_plot=do_plot, do_save=do_save, do_show=do_show)
     json  = test_fileio()
+    sim3  = test_population_binary()
+    sim3b = test_population_chunked()
+    pop   = test_synthpop_conversion()
     sim4  = test_start_stop()
     sim5  = test_sim_data(do_plot=do_plot, do_show=do_show)
     sim6  = test_dynamic_resampling(do_plot=do_plot, do_show=do_show)
+    sim7  = test_reset()
+    sims  = test_from_template()
 
     sc.toc(T)
 
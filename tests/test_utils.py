@@ -119,6 +119,21 @@ def test_samples(doplot=False):
 
 
 
+def test_warmup():
+    sc.heading('Warm up and seeding')
+    elapsed = cova.warmup(verbose=True)
+    cova.set_seed(1)
+    x1 = cova.utils.rbt(0.5, 10)
+    cova.set_seed(1)
+    x2 = cova.utils.rbt(0.5, 10)
+    assert np.array_equal(x1, x2) # Numba's stream is seeded too
+    cova.set_seed(1)
+    cova.warmup()
+    x3 = cova.utils.rbt(0.5, 10)
+    assert np.array_equal(x1, x3) # Warming up doesn't use the stream
+    return elapsed
+
+
 def test_choose():
     sc.heading('Choose people')
     x1 = cova.choose(10, 5)
@@ -128,6 +143,26 @@ def test_choose():
     return x1
 
 
+def test_batch_sampling():
+    sc.heading('Batch sampling')
+    arr = np.arange(10, dtype=np.int64)
+    probs = np.array([0, 1]*5, dtype=np.float64)
+    assert np.array_equal(cova.binomial_filter(probs, arr), arr[1::2])
+    assert isinstance(cova.utils.bf(1.0, arr), np.ndarray)
+
+    rates = np.array([0, 2, 50], dtype=np.float64)
+    counts = np.array([cova.n_poisson(rates) for i in range(1000)])
+    assert np.all(counts[:,0] == 0) and np.allclose(counts.mean(axis=0), rates, rtol=0.1)
+
+    counts = np.array([3, 0, 10, 10], dtype=np.int64)
+    chosen = cova.choose_groups(10, counts)
+    groups = np.split(chosen, np.cumsum(counts)[:-1])
+    assert [len(set(group)) for group in groups] == list(counts) # Unique within groups
+    assert sorted(groups[2]) == list(range(10))
+    print(f'Groups chosen: {groups}')
+    return chosen
+
+
 def test_choose_weighted():
     sc.heading('Choose weighted people')
     n = 100
@@ -149,9 +184,33 @@ def test_choose_weighted():
     print(f'Weighted sample 0-99: x1 = {x1}, mean {x1.mean()}')
     print(f'All weight on 0: x2 = {x2}')
     print(f'All weight on 0 or 1: x3 = {x3}')
+
+    # If there aren't enough people with nonzero weight, the rest are chosen uniformly
+    x4 = cova.choose_weighted([0.5, 0.5, 0, 0, 0], 4)
+    assert sorted(x4[:2]) == [0,1] and len(set(x4)) == 4
+
+    # Check unique samples follow the weights: the heaviest item should almost always be chosen
+    w = np.ones(n)
+    w[0] = 1000
+    hits = sum(0 in cova.choose_weighted(w/w.sum(), 2) for i in range(100))
+    assert hits > 90
     return x1
 
 
+def test_alias_sampler():
+    sc.heading('Alias sampler')
+    weights = np.array([1, 2, 3, 4, 0])
+    sampler = cova.AliasSampler(weights)
+    samples = sampler.sample(100000)
+    freqs = np.bincount(samples, minlength=len(weights))/len(samples)
+    assert np.allclose(freqs, weights/weights.sum(), atol=0.01)
+    assert not sampler.update(weights.copy()) # Same weights, so not rebuilt
+    assert sampler.update([0, 0, 0, 0, 0]) # All zero, so uniform
+    assert set(sampler.sample(1000)) == set(range(5))
+    print(f'Alias sample frequencies: {freqs}')
+    return sampler
+
+
 def test_doubling_time():
 
     sim = cova.Sim()
@@ -181,7 +240,10 @@ if __name__ == '__main__':
     rnd2    = test_poisson()
     samples = test_samples(doplot=doplot)
     people1 = test_choose()
+    elapsed = test_warmup()
+    chosen  = test_batch_sampling()
     people2 = test_choose_weighted()
+    sampler = test_alias_sampler()
     dt = test_doubling_time()
 
     print('\n'*2)
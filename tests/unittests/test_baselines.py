@@ -2,6 +2,9 @@
 Compare current results to baseline
 """
 
+import os
+import sys
+import subprocess
 import sciris as sc
 import covasim as cv
 
@@ -9,6 +12,8 @@ do_save = True
 baseline_filename  = 'baseline.json'
 benchmark_filename = 'benchmark.json'
 baseline_key = 'summary'
+import_budget = 10.0 # Maximum time in seconds for "import covasim", once Numba's cache has been populated
+lazy_modules = ['scipy.stats'] # Modules that should only be imported when they're used
 
 
 def save_baseline(do_save=do_save):
@@ -116,11 +121,37 @@ def test_benchmark(do_save=do_save):
     return json
 
 
+def test_import_time(budget=import_budget):
+    ''' Check that importing Covasim in a fresh interpreter stays within the budget '''
+
+    print('Timing import...')
+
+    code = f"""
+import sys, time
+start = time.time()
+import covasim
+elapsed = time.time() - start
+loaded = [mod for mod in {lazy_modules} if mod in sys.modules]
+print(elapsed, *loaded)
+"""
+    env = sc.mergedicts(dict(os.environ), {'COVASIM_QUIET':'1'})
+    for attempt in range(2): # The first import may need to populate the Numba cache, so only the second one is timed
+        output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+    elapsed, *loaded = output.splitlines()[-1].split() # Other import messages may precede the timing
+    elapsed = float(elapsed)
+    print(f'Importing Covasim took {elapsed:0.2f} s (budget: {budget:0.2f} s)')
+
+    assert not loaded, f'Modules {loaded} should only be imported when used'
+    assert elapsed < budget, f'Importing Covasim took {elapsed:0.2f} s, which exceeds the budget of {budget:0.2f} s'
+
+    return elapsed
+
 
 
 if __name__ == '__main__':
 
     new  = test_baseline()
     json = test_benchmark(do_save=do_save)
+    t_import = test_import_time()
 
     print('Done.')
\ No newline at end of file